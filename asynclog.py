@@ -0,0 +1,144 @@
+"""Non-blocking log pipeline for the G.I.D server
+
+Relay code only appends (time, level, color, text) to a deque, which is
+lock-free in CPython. A background writer drains it every FLUSH_INTERVAL
+and renders the batch with one write to the terminal and one to the log
+file. Standard logging calls are funnelled into the same queue through a
+handler, so nothing on the relay path touches stdout or disk. If the
+writer falls behind (a backed-up stdout pipe), the oldest lines are
+dropped instead of slowing delivery down.
+"""
+import os
+import sys
+import time
+import shutil
+import atexit
+import logging
+import threading
+from collections import deque
+from colorama import Style
+
+FLUSH_INTERVAL = 0.05
+MAX_PENDING = 100000
+
+pending = deque(maxlen=MAX_PENDING)
+tallies = {}  # Route label -> [relayed, buffered] since the last summary
+settings = {"headless": False, "summary_interval": 0}
+log_file = None
+flush_lock = threading.Lock()
+last_summary = time.monotonic()
+stamp_cache = [0, ""]
+
+def emit(text, color="", level=logging.INFO):
+    """Queue a line for the terminal and the log file; safe to call on the hot path"""
+    pending.append((time.time(), level, color, text))
+
+def tally(label, buffered=False):
+    """Count a routed packet for the periodic summary instead of logging it"""
+    entry = tallies.get(label)
+    if entry is None:
+        entry = tallies.setdefault(label, [0, 0])
+    entry[1 if buffered else 0] += 1
+
+class PipelineHandler(logging.Handler):
+    """Logging handler that hands records to the background writer"""
+
+    def emit(self, record):
+        text = record.getMessage()
+        if record.exc_info:
+            text += "\n" + logging.Formatter().formatException(record.exc_info)
+        pending.append((record.created, record.levelno, None, text))
+
+def timestamp(created):
+    """Same layout as logging's default asctime, formatted once per second"""
+    second = int(created)
+    if stamp_cache[0] != second:
+        stamp_cache[0] = second
+        stamp_cache[1] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(second))
+    return f"{stamp_cache[1]},{int(created * 1000) % 1000:03d}"
+
+def summarize():
+    """Turn the route tallies into one summary line per label"""
+    global last_summary
+    now = time.monotonic()
+    if not settings["summary_interval"] or now - last_summary < settings["summary_interval"]:
+        return
+    elapsed = now - last_summary
+    last_summary = now
+    for label, entry in list(tallies.items()):
+        relayed, buffered = entry
+        if relayed or buffered:
+            entry[0] -= relayed
+            entry[1] -= buffered
+            emit(f"[{label}] {relayed} relayed, {buffered} buffered in the last {elapsed:.0f}s")
+
+def flush():
+    """Write out everything queued so far"""
+    with flush_lock:
+        summarize()
+        batch = []
+        while pending:
+            batch.append(pending.popleft())
+        if not batch:
+            return
+
+        if log_file is not None:
+            log_file.write("".join(
+                f"{timestamp(created)} - {logging.getLevelName(level)} - {text}\n"
+                for created, level, _, text in batch))
+            log_file.flush()
+
+        if not settings["headless"]:
+            try:
+                width = shutil.get_terminal_size().columns
+            except Exception:
+                width = 80
+            lines = []
+            for _, _, color, text in batch:
+                if color is None:
+                    continue  # Plain logging records only go to the file
+                padding = max(0, (width - len(text)) // 2)
+                lines.append(" " * padding + color + text + Style.RESET_ALL + "\n")
+            if lines:
+                sys.stdout.write("".join(lines))
+                sys.stdout.flush()
+
+def write_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            # Nowhere left to report this but stderr
+            sys.stderr.write(f"log writer error: {e}\n")
+
+def start_writer():
+    threading.Thread(target=write_loop, daemon=True).start()
+
+def restart_after_fork():
+    """A forked worker gets a copy of the queue but no writer thread"""
+    global flush_lock
+    flush_lock = threading.Lock()
+    pending.clear()
+    start_writer()
+
+def start(path, level=logging.INFO, headless=False, summary_interval=0):
+    """Route logging through the pipeline and start the background writer"""
+    global log_file
+    settings["headless"] = headless
+    settings["summary_interval"] = summary_interval
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    log_file = open(path, "a", encoding="utf-8")
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(PipelineHandler())
+    root.setLevel(level)
+
+    start_writer()
+    if hasattr(os, "register_at_fork"):
+        os.register_at_fork(after_in_child=restart_after_fork)
+    atexit.register(flush)
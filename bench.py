@@ -0,0 +1,436 @@
+"""Load generator and latency benchmark for server.py
+
+Starts a server (a subprocess by default, or in-process), connects N
+synthetic agents that do the real REGISTER handshake over the framed
+protocol, drives a weighted mix of traffic for a fixed time and writes a
+JSON report with throughput, delivery latency percentiles and server
+CPU/RSS so runs can be compared across changes.
+
+    python bench.py --agents 500 --duration 20 --rate 2 --mix msg=60,channel=10,file=5,typing=15,offline=10
+"""
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from colorama import Fore, Style, init
+from protocol import FrameDecoder, encode_frame
+
+init(autoreset=True)
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+MIX_KINDS = ("msg", "channel", "file", "typing", "offline")
+CHANNEL = "#bench"
+CONNECT_CONCURRENCY = 200
+
+class Results:
+    """Counters and latency samples shared by every synthetic agent"""
+
+    def __init__(self):
+        self.sent = dict.fromkeys(MIX_KINDS, 0)
+        self.delivered = dict.fromkeys(MIX_KINDS, 0)
+        self.latencies = {kind: [] for kind in MIX_KINDS}
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.agent_counts = []
+        self.channel_acks = 0
+        self.throttled = 0
+
+    def record(self, kind, sent_at):
+        self.delivered[kind] += 1
+        if sent_at is not None:
+            self.latencies[kind].append((time.perf_counter() - sent_at) * 1000)
+
+class BenchAgent:
+    """One synthetic agent: a framed connection plus a reader task"""
+    __slots__ = ("agent_id", "reader", "writer", "decoder", "results", "task")
+
+    def __init__(self, agent_id, results):
+        self.agent_id = agent_id
+        self.results = results
+        self.decoder = FrameDecoder()
+        self.reader = None
+        self.writer = None
+        self.task = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(encode_frame("REGISTER", f"{self.agent_id}|-----BEGIN PUBLIC KEY-----bench-{self.agent_id}"))
+        await self.writer.drain()
+        self.task = asyncio.ensure_future(self.read_loop())
+
+    async def send(self, command, payload):
+        data = encode_frame(command, payload)
+        self.results.bytes_sent += len(data)
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def read_loop(self):
+        try:
+            while True:
+                data = await self.reader.read(262144)
+                if not data:
+                    return
+                self.results.bytes_received += len(data)
+                for command, payload in self.decoder.feed(data):
+                    self.handle(command, payload)
+        except (ConnectionError, OSError):
+            pass
+
+    def handle(self, command, payload):
+        if command in ("INCOMING", "FILE_INCOMING"):
+            # "sender|kind:sent_at:padding", sender may be "#channel:agent"
+            blob = payload.split(b"|", 1)[1]
+            kind, sent_at, _ = blob.split(b":", 2)
+            self.results.record(kind.decode(), float(sent_at))
+        elif command == "PING":
+            self.writer.write(encode_frame("PONG", payload))
+        elif command == "THROTTLED":
+            self.results.throttled += 1
+        elif command == "TYPING_INDICATOR":
+            self.results.record("typing", None)
+        elif command == "AGENT_LIST":
+            self.results.agent_counts.append(len(payload.split(b"||")) if payload else 0)
+        elif command == "CHANNEL_STATUS" and b"|OK|" in payload:
+            self.results.channel_acks += 1
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        if self.task is not None:
+            self.task.cancel()
+
+# ==================== SERVER PROCESS ====================
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def write_server_config(directory, args, port):
+    config = {
+        "server": {"host": "127.0.0.1", "port": port, "mode": args.mode},
+        "cluster": {"workers": args.workers, "socket_dir": "data/cluster"},
+        "metrics": {"port": 0},
+        "logging": {"headless": True, "route_log": "off"},
+        "rate_limits": {"enabled": args.rate_limits},
+    }
+    with open(os.path.join(directory, "config.json"), "w") as f:
+        json.dump(config, f)
+
+def start_server(args):
+    """Launch a server in a scratch directory; returns (host, port, pid, process)
+
+    With --inprocess, process is the thread running the server.
+    """
+    directory = tempfile.mkdtemp(prefix="gid-bench-")
+    port = free_port()
+    write_server_config(directory, args, port)
+
+    if args.inprocess:
+        os.chdir(directory)
+        sys.path.insert(0, REPO_DIR)
+        import server
+        process = threading.Thread(target=server.run_server, daemon=True)
+        process.start()
+        pid = os.getpid()
+    else:
+        process = subprocess.Popen([sys.executable, os.path.join(REPO_DIR, "server.py")], cwd=directory,
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        pid = process.pid
+
+    deadline = time.time() + 15
+    while time.time() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.5).close()
+            return "127.0.0.1", port, pid, process
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError("server did not start listening")
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+
+class ResourceSampler:
+    """Samples CPU time and RSS of the server and its worker processes from /proc"""
+
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak_rss = 0
+        self.running = False
+
+    def processes(self):
+        pids = [self.pid]
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                try:
+                    with open(f"/proc/{entry}/stat") as f:
+                        if int(f.read().rsplit(")", 1)[1].split()[1]) == self.pid:
+                            pids.append(int(entry))
+                except (OSError, IndexError, ValueError):
+                    pass
+        return pids
+
+    def sample(self):
+        """(cpu_seconds, rss_bytes) summed over the server's processes"""
+        cpu = 0.0
+        rss = 0
+        ticks = os.sysconf("SC_CLK_TCK")
+        for pid in self.processes():
+            try:
+                with open(f"/proc/{pid}/stat") as f:
+                    fields = f.read().rsplit(")", 1)[1].split()
+                cpu += (int(fields[11]) + int(fields[12])) / ticks
+                rss += int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+            except (OSError, IndexError, ValueError):
+                pass
+        return cpu, rss
+
+    def start(self):
+        self.running = True
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while self.running:
+            self.peak_rss = max(self.peak_rss, self.sample()[1])
+            time.sleep(0.5)
+
+# ==================== LOAD ====================
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in MIX_KINDS:
+            raise ValueError(f"unknown mix entry {kind!r}, expected one of {', '.join(MIX_KINDS)}")
+        mix[kind] = float(weight or 1)
+    return mix
+
+def payload_for(kind, size):
+    head = f"{kind}:{time.perf_counter():.6f}:"
+    return head + "x" * max(0, size - len(head))
+
+async def connect_all(agents, host, port):
+    gate = asyncio.Semaphore(CONNECT_CONCURRENCY)
+
+    async def connect(agent):
+        async with gate:
+            await agent.connect(host, port)
+
+    await asyncio.gather(*(connect(agent) for agent in agents))
+
+async def wait_registered(agent, results, expected, timeout=30):
+    """Poll LIST_AGENTS until the server reports every agent"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        await agent.send("LIST_AGENTS", "")
+        await asyncio.sleep(0.2)
+        if results.agent_counts and results.agent_counts[-1] >= expected:
+            return True
+    return False
+
+async def drive(agent, peers, members, offline, mix, args, results, stop_at):
+    """Send traffic from one agent at args.rate packets per second until stop_at"""
+    kinds = list(mix)
+    weights = [mix[kind] for kind in kinds]
+    interval = 1.0 / args.rate
+    await asyncio.sleep(random.random() * interval)
+    while time.perf_counter() < stop_at:
+        kind = random.choices(kinds, weights)[0]
+        if kind == "channel" and agent not in members:
+            kind = "msg"
+        if kind == "offline" and not offline:
+            kind = "msg"
+
+        if kind == "msg":
+            await agent.send("MSG", f"{random.choice(peers).agent_id}|{payload_for(kind, args.msg_size)}")
+            results.sent[kind] += 1
+        elif kind == "channel":
+            await agent.send("MSG", f"{CHANNEL}|{payload_for(kind, args.msg_size)}")
+            results.sent[kind] += len(members) - 1
+        elif kind == "file":
+            await agent.send("FILE", f"{random.choice(peers).agent_id}|{payload_for(kind, args.file_size)}")
+            results.sent[kind] += 1
+        elif kind == "typing":
+            await agent.send("TYPING", random.choice(peers).agent_id)
+            results.sent[kind] += 1
+        else:
+            await agent.send("MSG", f"{random.choice(offline).agent_id}|{payload_for(kind, args.msg_size)}")
+            results.sent[kind] += 1
+        await asyncio.sleep(interval)
+
+def percentiles(samples):
+    if not samples:
+        return None
+    samples.sort()
+    pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))], 3)
+    return {"count": len(samples), "p50": pick(0.5), "p99": pick(0.99), "p999": pick(0.999),
+            "max": round(samples[-1], 3), "mean": round(sum(samples) / len(samples), 3)}
+
+async def run_benchmark(args, host, port, sampler):
+    results = Results()
+    mix = parse_mix(args.mix)
+    agents = [BenchAgent(f"BENCH-{i:05d}", results) for i in range(args.agents)]
+    offline = [BenchAgent(f"BENCH-OFF-{i:04d}", results) for i in range(args.offline_agents)]
+
+    print(f"{Fore.CYAN}[*] CONNECTING {len(agents) + len(offline)} AGENTS TO {host}:{port}")
+    started = time.perf_counter()
+    await connect_all(agents + offline, host, port)
+    if not await wait_registered(agents[0], results, len(agents) + len(offline)):
+        print(f"{Fore.YELLOW}[!] NOT EVERY AGENT SHOWED UP IN THE AGENT LIST")
+    connect_seconds = time.perf_counter() - started
+
+    # Offline recipients register once (so their keys exist) and then go away
+    for agent in offline:
+        await agent.close()
+
+    members = agents[:min(args.channel_size, len(agents))] if mix.get("channel") else []
+    if members:
+        await members[0].send("CHANNEL_CREATE", CHANNEL)
+        await asyncio.sleep(0.3)
+        for agent in members[1:]:
+            await agent.send("CHANNEL_JOIN", CHANNEL)
+        await asyncio.sleep(0.5)
+    member_set = set(members)
+
+    print(f"{Fore.CYAN}[*] DRIVING {args.rate}/s PER AGENT FOR {args.duration}s ({args.mix})")
+    cpu_before, _ = sampler.sample() if sampler else (0.0, 0)
+    load_started = time.perf_counter()
+    stop_at = load_started + args.duration
+    await asyncio.gather(*(
+        drive(agent, [peer for peer in agents if peer is not agent] or agents, member_set, offline, mix, args, results, stop_at)
+        for agent in agents))
+    load_seconds = time.perf_counter() - load_started
+    await asyncio.sleep(args.grace)
+    cpu_after, _ = sampler.sample() if sampler else (0.0, 0)
+
+    # Offline scenario: reconnect and time the mailbox drain
+    drain = None
+    if offline and results.sent["offline"]:
+        print(f"{Fore.CYAN}[*] RECONNECTING {len(offline)} OFFLINE AGENTS")
+        before = results.delivered["offline"]
+        drain_started = time.perf_counter()
+        reconnected = [BenchAgent(agent.agent_id, results) for agent in offline]
+        await connect_all(reconnected, host, port)
+        deadline = drain_started + args.drain_timeout
+        while results.delivered["offline"] < results.sent["offline"] and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        drain = {"seconds": round(time.perf_counter() - drain_started, 3),
+                 "delivered": results.delivered["offline"] - before}
+        offline = reconnected
+
+    for agent in agents + offline:
+        await agent.close()
+
+    delivered = sum(results.delivered[kind] for kind in MIX_KINDS if kind != "offline")
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": vars(args),
+        "connect_seconds": round(connect_seconds, 3),
+        "load_seconds": round(load_seconds, 3),
+        "sent": results.sent,
+        "delivered": results.delivered,
+        "throughput_per_sec": round(delivered / load_seconds, 1),
+        "bytes_sent": results.bytes_sent,
+        "bytes_received": results.bytes_received,
+        "latency_ms": {kind: percentiles(samples) for kind, samples in results.latencies.items() if samples},
+        "offline_drain": drain,
+        "throttled_replies": results.throttled,
+    }
+    if sampler:
+        cpu = cpu_after - cpu_before
+        report["server"] = {"cpu_seconds": round(cpu, 3), "cpu_percent": round(100 * cpu / (load_seconds + args.grace), 1),
+                            "peak_rss_mb": round(sampler.peak_rss / 1048576, 1)}
+    return report
+
+def print_report(report):
+    print(f"\n{Fore.GREEN}{Style.BRIGHT}=== BENCHMARK RESULTS ===")
+    print(f"Throughput: {report['throughput_per_sec']:,} deliveries/s over {report['load_seconds']}s")
+    for kind in MIX_KINDS:
+        if report["sent"][kind]:
+            line = f"{kind:>8}: {report['delivered'][kind]:,}/{report['sent'][kind]:,} delivered"
+            if kind == "typing":
+                line += " (start/stop changes)"
+            latency = report["latency_ms"].get(kind)
+            if latency:
+                line += f"  p50 {latency['p50']}ms  p99 {latency['p99']}ms  p999 {latency['p999']}ms"
+            print(line)
+    if report["offline_drain"]:
+        print(f"Offline drain: {report['offline_drain']['delivered']:,} packets in {report['offline_drain']['seconds']}s")
+    if report["throttled_replies"]:
+        print(f"{Fore.YELLOW}Throttled: {report['throttled_replies']:,} THROTTLED replies from the server")
+    if "server" in report:
+        server = report["server"]
+        print(f"Server: {server['cpu_percent']}% CPU, peak RSS {server['peak_rss_mb']} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the G.I.D server with synthetic agents")
+    parser.add_argument("--agents", type=int, default=200, help="number of online agents")
+    parser.add_argument("--offline-agents", type=int, default=20, help="agents that go offline and collect mail at the end")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of load")
+    parser.add_argument("--rate", type=float, default=2, help="packets per second per agent")
+    parser.add_argument("--mix", default="msg=70,channel=5,file=5,typing=15,offline=5", help="weighted traffic mix")
+    parser.add_argument("--msg-size", type=int, default=256, help="bytes per message payload")
+    parser.add_argument("--file-size", type=int, default=64 * 1024, help="bytes per file payload")
+    parser.add_argument("--channel-size", type=int, default=50, help="members of the fan-out channel")
+    parser.add_argument("--grace", type=float, default=2, help="seconds to wait for in-flight packets")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="seconds to wait for the offline drain")
+    parser.add_argument("--mode", choices=("threaded", "asyncio"), default="asyncio", help="server mode to start")
+    parser.add_argument("--workers", type=int, default=1, help="server worker processes")
+    parser.add_argument("--rate-limits", action="store_true", help="keep the server's default per-agent rate limits on")
+    parser.add_argument("--inprocess", action="store_true", help="run the server in this process instead of a subprocess")
+    parser.add_argument("--connect", help="benchmark an already running server at host:port")
+    parser.add_argument("--output", help="JSON report path (default bench_results/bench-<time>.json)")
+    args = parser.parse_args()
+
+    if args.inprocess and args.workers > 1:
+        parser.error("--inprocess cannot start multiple workers")
+    output = os.path.abspath(args.output or os.path.join("bench_results", time.strftime("bench-%Y%m%d-%H%M%S.json")))
+    raise_fd_limit()
+
+    process = None
+    sampler = None
+    if args.connect:
+        host, port = args.connect.rsplit(":", 1)
+        port = int(port)
+    else:
+        host, port, pid, process = start_server(args)
+        if os.path.isdir("/proc"):
+            sampler = ResourceSampler(pid)
+            sampler.start()
+
+    try:
+        report = asyncio.run(run_benchmark(args, host, port, sampler))
+    finally:
+        if isinstance(process, threading.Thread):
+            sys.modules["server"].stop_accepting()
+            process.join(10)
+        elif process is not None:
+            process.terminate()
+            process.wait(10)
+
+    print_report(report)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"{Fore.CYAN}[*] REPORT SAVED TO {output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,1100 +1,2052 @@
-import socket
-import threading
-import random
-import time
-import os
-import sys
-import shutil
-import hashlib
-import base64
-import json
-import logging
-from datetime import datetime
-from pathlib import Path
-from colorama import Fore, Style, init
-from cryptography.hazmat.primitives.asymmetric import rsa, padding
-from cryptography.hazmat.primitives import serialization, hashes
-from cryptography.fernet import Fernet
-
-# Voice recording imports (optional - graceful degradation)
-try:
-    import sounddevice as sd
-    import soundfile as sf
-    import numpy as np
-    VOICE_AVAILABLE = True
-except ImportError:
-    VOICE_AVAILABLE = False
-    logging.warning("Voice recording not available - install sounddevice, soundfile, numpy")
-
-init(autoreset=True)
-
-# Load configuration
-CONFIG_FILE = "config.json"
-DEFAULT_CONFIG = {
-    "server": {"host": "127.0.0.1", "port": 5555},
-    "client": {
-        "auto_reconnect": True,
-        "reconnect_delay": 5,
-        "max_reconnect_attempts": 10,
-        "save_history": True,
-        "typing_indicators": True,
-        "read_receipts": True
-    }
-}
-
-def load_config():
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return DEFAULT_CONFIG
-
-config = load_config()
-SERVER_IP = config["server"]["host"]
-SERVER_PORT = config["server"]["port"]
-IDENTITY_FILE = "identity.pem"
-DOWNLOADS_DIR = "downloads"
-HISTORY_DIR = "chat_history"
-BLOCKLIST_FILE = "blocklist.json"
-VOICE_DIR = "voice_notes"
-
-# Setup logging
-os.makedirs("logs", exist_ok=True)
-logging.basicConfig(
-    filename='logs/client.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
-client = None
-private_key = None
-public_key = None
-pem_public = None
-my_agent_id = None
-target_public_key_cache = None
-blocked_agents = set()
-session_stats = {
-    "messages_sent": 0,
-    "messages_received": 0,
-    "files_sent": 0,
-    "files_received": 0,
-    "bytes_sent": 0,
-    "bytes_received": 0,
-    "start_time": None
-}
-typing_timer = None
-last_typing_time = 0
-is_connected = False
-
-# ==================== UTILITY FUNCTIONS ====================
-
-def get_width():
-    try: 
-        return shutil.get_terminal_size().columns
-    except: 
-        return 80
-
-def clear_screen(): 
-    os.system('cls' if os.name == 'nt' else 'clear')
-
-def play_sound(): 
-    sys.stdout.write('\a')
-    sys.stdout.flush()
-
-def print_centered(text, color=Fore.WHITE, style=Style.NORMAL):
-    width = get_width()
-    padding = max(0, (width - len(text)) // 2)
-    print(" " * padding + color + style + text)
-
-def input_centered(prompt_text, color=Fore.YELLOW):
-    width = get_width()
-    padding = max(0, (width - len(prompt_text) - 10) // 2) 
-    sys.stdout.write(" " * padding + color + prompt_text)
-    sys.stdout.flush()
-    return input(Fore.WHITE)
-
-def get_timestamp():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-# ==================== MESSAGE HISTORY ====================
-
-def save_message_to_history(agent_id, message, direction="sent"):
-    """Save encrypted message to local history"""
-    if not config["client"]["save_history"]:
-        return
-    
-    try:
-        os.makedirs(HISTORY_DIR, exist_ok=True)
-        history_file = os.path.join(HISTORY_DIR, f"{agent_id}.log")
-        
-        timestamp = get_timestamp()
-        entry = f"[{timestamp}] [{direction.upper()}] {message}\n"
-        
-        with open(history_file, 'a', encoding='utf-8') as f:
-            f.write(entry)
-    except Exception as e:
-        logging.error(f"Error saving history: {e}")
-
-def load_message_history(agent_id, limit=50):
-    """Load message history for an agent"""
-    try:
-        history_file = os.path.join(HISTORY_DIR, f"{agent_id}.log")
-        if not os.path.exists(history_file):
-            return []
-        
-        with open(history_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
-        
-        return lines[-limit:] if len(lines) > limit else lines
-    except Exception as e:
-        logging.error(f"Error loading history: {e}")
-        return []
-
-# ==================== BLOCK SYSTEM ====================
-
-def load_blocklist():
-    """Load blocked agents from file"""
-    global blocked_agents
-    try:
-        if os.path.exists(BLOCKLIST_FILE):
-            with open(BLOCKLIST_FILE, 'r') as f:
-                blocked_agents = set(json.load(f))
-    except Exception as e:
-        logging.error(f"Error loading blocklist: {e}")
-        blocked_agents = set()
-
-def save_blocklist():
-    """Save blocked agents to file"""
-    try:
-        with open(BLOCKLIST_FILE, 'w') as f:
-            json.dump(list(blocked_agents), f, indent=2)
-    except Exception as e:
-        logging.error(f"Error saving blocklist: {e}")
-
-def block_agent(agent_id):
-    """Block an agent"""
-    blocked_agents.add(agent_id)
-    save_blocklist()
-    print_centered(f"[+] BLOCKED: {agent_id}", Fore.RED)
-
-def unblock_agent(agent_id):
-    """Unblock an agent"""
-    if agent_id in blocked_agents:
-        blocked_agents.remove(agent_id)
-        save_blocklist()
-        print_centered(f"[+] UNBLOCKED: {agent_id}", Fore.GREEN)
-    else:
-        print_centered(f"[!] {agent_id} IS NOT BLOCKED", Fore.YELLOW)
-
-def is_blocked(agent_id):
-    """Check if an agent is blocked"""
-    return agent_id in blocked_agents
-
-# ==================== STATISTICS ====================
-
-def update_stats(stat_type, value=1):
-    """Update session statistics"""
-    if stat_type in session_stats:
-        session_stats[stat_type] += value
-
-def get_uptime():
-    """Get session uptime"""
-    if session_stats["start_time"]:
-        elapsed = time.time() - session_stats["start_time"]
-        hours = int(elapsed // 3600)
-        minutes = int((elapsed % 3600) // 60)
-        seconds = int(elapsed % 60)
-        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
-    return "00:00:00"
-
-def show_statistics():
-    """Display session statistics"""
-    print("\n")
-    print_centered("=== SESSION STATISTICS ===", Fore.CYAN, Style.BRIGHT)
-    print_centered(f"Messages Sent: {session_stats['messages_sent']}", Fore.WHITE)
-    print_centered(f"Messages Received: {session_stats['messages_received']}", Fore.WHITE)
-    print_centered(f"Files Sent: {session_stats['files_sent']}", Fore.WHITE)
-    print_centered(f"Files Received: {session_stats['files_received']}", Fore.WHITE)
-    print_centered(f"Data Sent: {session_stats['bytes_sent']:,} bytes", Fore.WHITE)
-    print_centered(f"Data Received: {session_stats['bytes_received']:,} bytes", Fore.WHITE)
-    print_centered(f"Session Uptime: {get_uptime()}", Fore.WHITE)
-    print("\n")
-
-# ==================== EXPORT SYSTEM ====================
-
-def export_chat(agent_id, format_type="txt"):
-    """Export chat history to file"""
-    try:
-        history = load_message_history(agent_id, limit=None)
-        
-        if not history:
-            print_centered(f"[!] NO HISTORY FOUND FOR {agent_id}", Fore.YELLOW)
-            return
-        
-        export_dir = "exports"
-        os.makedirs(export_dir, exist_ok=True)
-        
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        
-        if format_type.lower() == "txt":
-            filename = os.path.join(export_dir, f"{agent_id}_{timestamp}.txt")
-            with open(filename, 'w', encoding='utf-8') as f:
-                f.write(f"Chat Export: {my_agent_id} <-> {agent_id}\n")
-                f.write(f"Exported: {get_timestamp()}\n")
-                f.write("=" * 60 + "\n\n")
-                f.writelines(history)
-            
-            print_centered(f"[+] CHAT EXPORTED: {filename}", Fore.GREEN)
-        
-        elif format_type.lower() == "json":
-            filename = os.path.join(export_dir, f"{agent_id}_{timestamp}.json")
-            export_data = {
-                "export_info": {
-                    "my_agent_id": my_agent_id,
-                    "target_agent_id": agent_id,
-                    "export_time": get_timestamp(),
-                    "message_count": len(history)
-                },
-                "messages": [line.strip() for line in history]
-            }
-            
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(export_data, f, indent=2, ensure_ascii=False)
-            
-            print_centered(f"[+] CHAT EXPORTED: {filename}", Fore.GREEN)
-        
-        else:
-            print_centered(f"[!] UNSUPPORTED FORMAT: {format_type}", Fore.RED)
-    
-    except Exception as e:
-        print_centered(f"[!] EXPORT ERROR: {e}", Fore.RED)
-        logging.error(f"Export error: {e}")
-
-# ==================== VOICE NOTES ====================
-
-def record_voice_note(duration=10, sample_rate=44100):
-    """Record voice note"""
-    if not VOICE_AVAILABLE:
-        print_centered("[!] VOICE RECORDING NOT AVAILABLE", Fore.RED)
-        print_centered("[*] Install: pip install sounddevice soundfile numpy", Fore.YELLOW)
-        return None
-    
-    try:
-        print_centered(f"[*] RECORDING FOR {duration} SECONDS...", Fore.CYAN)
-        print_centered("[*] SPEAK NOW", Fore.GREEN, Style.BRIGHT)
-        
-        # Record audio
-        recording = sd.rec(int(duration * sample_rate), samplerate=sample_rate, channels=1, dtype='float32')
-        sd.wait()
-        
-        # Save to temporary file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        temp_file = os.path.join(VOICE_DIR, f"voice_{timestamp}.wav")
-        sf.write(temp_file, recording, sample_rate)
-        
-        print_centered(f"[+] RECORDING COMPLETE: {os.path.getsize(temp_file)} bytes", Fore.GREEN)
-        return temp_file
-        
-    except Exception as e:
-        print_centered(f"[!] RECORDING ERROR: {e}", Fore.RED)
-        logging.error(f"Voice recording error: {e}")
-        return None
-
-def encrypt_voice_note(filepath, target_pub_pem):
-    """Encrypt voice note file"""
-    try:
-        with open(filepath, 'rb') as f:
-            audio_data = f.read()
-        
-        # Generate session key
-        session_key = Fernet.generate_key()
-        cipher_suite = Fernet(session_key)
-        encrypted_audio = cipher_suite.encrypt(audio_data)
-        
-        # Encrypt session key with recipient's public key
-        target_pub = serialization.load_pem_public_key(target_pub_pem.encode('utf-8'))
-        encrypted_session_key = target_pub.encrypt(
-            session_key,
-            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
-        )
-        
-        # Combine: encrypted_key||encrypted_audio
-        blob = encrypted_session_key.hex() + "||" + encrypted_audio.decode('utf-8')
-        
-        # Clean up temp file
-        os.remove(filepath)
-        
-        return blob
-        
-    except Exception as e:
-        print_centered(f"[!] VOICE ENCRYPTION ERROR: {e}", Fore.RED)
-        logging.error(f"Voice encryption error: {e}")
-        return None
-
-def decrypt_voice_note(blob, sender_id):
-    """Decrypt and save voice note"""
-    try:
-        encrypted_key_hex, encrypted_audio = blob.split("||", 1)
-        encrypted_session_key = bytes.fromhex(encrypted_key_hex)
-        
-        # Decrypt session key
-        session_key = private_key.decrypt(
-            encrypted_session_key,
-            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
-        )
-        
-        # Decrypt audio
-        cipher_suite = Fernet(session_key)
-        audio_data = cipher_suite.decrypt(encrypted_audio.encode('utf-8'))
-        
-        # Save file
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        save_path = os.path.join(VOICE_DIR, f"{sender_id}_voice_{timestamp}.wav")
-        
-        with open(save_path, 'wb') as f:
-            f.write(audio_data)
-        
-        return save_path, len(audio_data)
-        
-    except Exception as e:
-        print_centered(f"[!] VOICE DECRYPTION ERROR: {e}", Fore.RED)
-        logging.error(f"Voice decryption error: {e}")
-        return None, 0
-
-def play_voice_note(filepath):
-    """Play voice note"""
-    if not VOICE_AVAILABLE:
-        print_centered("[!] VOICE PLAYBACK NOT AVAILABLE", Fore.RED)
-        return
-    
-    try:
-        data, sample_rate = sf.read(filepath)
-        print_centered("[*] PLAYING VOICE NOTE...", Fore.CYAN)
-        sd.play(data, sample_rate)
-        sd.wait()
-        print_centered("[+] PLAYBACK COMPLETE", Fore.GREEN)
-        
-    except Exception as e:
-        print_centered(f"[!] PLAYBACK ERROR: {e}", Fore.RED)
-        logging.error(f"Voice playback error: {e}")
-
-# ==================== PERSISTENT IDENTITY ====================
-
-def derive_agent_id_from_key(pub_key):
-    """Generate consistent Agent ID from public key hash"""
-    key_bytes = pub_key.public_bytes(
-        encoding=serialization.Encoding.DER,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    )
-    hash_digest = hashlib.sha256(key_bytes).hexdigest()
-    return f"AGENT-{hash_digest[:12].upper()}"
-
-def save_identity(priv_key, password):
-    """Encrypt and save private key to file"""
-    try:
-        encryption_algorithm = serialization.BestAvailableEncryption(password.encode('utf-8'))
-        pem_private = priv_key.private_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PrivateFormat.PKCS8,
-            encryption_algorithm=encryption_algorithm
-        )
-        
-        with open(IDENTITY_FILE, 'wb') as f:
-            f.write(pem_private)
-        
-        print_centered(f"[+] IDENTITY SAVED TO {IDENTITY_FILE}", Fore.GREEN)
-        return True
-    except Exception as e:
-        print_centered(f"[!] ERROR SAVING IDENTITY: {e}", Fore.RED)
-        logging.error(f"Identity save error: {e}")
-        return False
-
-def load_identity(password):
-    """Load and decrypt private key from file"""
-    try:
-        with open(IDENTITY_FILE, 'rb') as f:
-            pem_private = f.read()
-        
-        priv_key = serialization.load_pem_private_key(
-            pem_private,
-            password=password.encode('utf-8')
-        )
-        
-        print_centered(f"[+] IDENTITY LOADED FROM {IDENTITY_FILE}", Fore.GREEN)
-        return priv_key
-    except FileNotFoundError:
-        return None
-    except Exception as e:
-        print_centered(f"[!] ERROR LOADING IDENTITY: {e}", Fore.RED)
-        logging.error(f"Identity load error: {e}")
-        return None
-
-def setup_identity():
-    """Setup or load persistent identity"""
-    global private_key, public_key, pem_public, my_agent_id
-    
-    if os.path.exists(IDENTITY_FILE):
-        print_centered("[*] EXISTING IDENTITY DETECTED", Fore.CYAN)
-        
-        import getpass
-        max_attempts = 3
-        for attempt in range(max_attempts):
-            password = getpass.getpass(" " * ((get_width() - 30) // 2) + Fore.YELLOW + "ENTER PASSWORD: " + Style.RESET_ALL)
-            
-            private_key = load_identity(password)
-            if private_key is None:
-                remaining = max_attempts - attempt - 1
-                if remaining > 0:
-                    print_centered(f"[!] INCORRECT PASSWORD ({remaining} attempts remaining)", Fore.RED)
-                    continue
-                else:
-                    print_centered("[!] MAXIMUM ATTEMPTS REACHED", Fore.RED)
-                    return False
-            else:
-                break
-    else:
-        print_centered("[*] NO IDENTITY FOUND - GENERATING NEW KEYPAIR", Fore.CYAN)
-        time.sleep(1)
-        
-        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
-        
-        import getpass
-        while True:
-            password = getpass.getpass(" " * ((get_width() - 35) // 2) + Fore.YELLOW + "CREATE PASSWORD (min 8 chars): " + Style.RESET_ALL)
-            
-            if len(password) < 8:
-                print_centered("[!] PASSWORD TOO SHORT (minimum 8 characters)", Fore.RED)
-                continue
-            
-            confirm = getpass.getpass(" " * ((get_width() - 30) // 2) + Fore.YELLOW + "CONFIRM PASSWORD: " + Style.RESET_ALL)
-            
-            if password != confirm:
-                print_centered("[!] PASSWORDS DO NOT MATCH", Fore.RED)
-                continue
-            
-            break
-        
-        if not save_identity(private_key, password):
-            return False
-    
-    public_key = private_key.public_key()
-    pem_public = public_key.public_bytes(
-        encoding=serialization.Encoding.PEM,
-        format=serialization.PublicFormat.SubjectPublicKeyInfo
-    ).decode('utf-8')
-    
-    my_agent_id = derive_agent_id_from_key(public_key)
-    
-    return True
-
-# ==================== SECURITY CHALLENGE ====================
-
-def binary_matrix_hack():
-    """Simple security verification - Access Code"""
-    print("\n")
-    print_centered("[!] SECURITY VERIFICATION PROTOCOL", Fore.RED, Style.BRIGHT)
-    print_centered("-" * 50, Fore.RED)
-    time.sleep(0.5)
-    
-    # Simple access code (can be customized)
-    access_code = input_centered("ENTER ACCESS CODE (default: 'SECURE'): ", Fore.YELLOW)
-    
-    if not access_code.strip():
-        access_code = "SECURE"
-    
-    print_centered("VERIFYING ACCESS...", Fore.BLUE)
-    time.sleep(1)
-    
-    # Always grant access (or you can add custom logic here)
-    return True
-
-
-# ==================== ENCRYPTION ====================
-
-def encrypt_message(message, target_pub_pem):
-    """Encrypt message using hybrid encryption (RSA + AES)"""
-    session_key = Fernet.generate_key()
-    cipher_suite = Fernet(session_key)
-    encrypted_text = cipher_suite.encrypt(message.encode('utf-8'))
-    
-    target_pub = serialization.load_pem_public_key(target_pub_pem.encode('utf-8'))
-    encrypted_session_key = target_pub.encrypt(
-        session_key,
-        padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
-    )
-    blob = encrypted_session_key.hex() + "||" + encrypted_text.decode('utf-8')
-    return blob
-
-def decrypt_message(blob):
-    """Decrypt message using hybrid decryption"""
-    try:
-        enc_sess_key_hex, enc_text_str = blob.split("||")
-        enc_sess_key = bytes.fromhex(enc_sess_key_hex)
-        session_key = private_key.decrypt(
-            enc_sess_key,
-            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
-        )
-        cipher_suite = Fernet(session_key)
-        return cipher_suite.decrypt(enc_text_str.encode('utf-8')).decode('utf-8')
-    except:
-        return "[ENCRYPTED DATA - CANNOT DECRYPT]"
-
-# ==================== FILE TRANSFER ====================
-
-def encrypt_file(filepath, target_pub_pem):
-    """Encrypt file for transfer"""
-    try:
-        with open(filepath, 'rb') as f:
-            file_data = f.read()
-        
-        filename = os.path.basename(filepath)
-        file_size = len(file_data)
-        
-        session_key = Fernet.generate_key()
-        cipher_suite = Fernet(session_key)
-        encrypted_data = cipher_suite.encrypt(file_data)
-        
-        target_pub = serialization.load_pem_public_key(target_pub_pem.encode('utf-8'))
-        encrypted_session_key = target_pub.encrypt(
-            session_key,
-            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
-        )
-        
-        blob = f"{filename}||{file_size}||{encrypted_session_key.hex()}||{base64.b64encode(encrypted_data).decode('utf-8')}"
-        return blob
-    except Exception as e:
-        print_centered(f"[!] FILE ENCRYPTION ERROR: {e}", Fore.RED)
-        logging.error(f"File encryption error: {e}")
-        return None
-
-def decrypt_file(blob, sender_id):
-    """Decrypt and save received file"""
-    try:
-        parts = blob.split("||")
-        filename = parts[0]
-        file_size = int(parts[1])
-        enc_sess_key_hex = parts[2]
-        encrypted_data_b64 = parts[3]
-        
-        enc_sess_key = bytes.fromhex(enc_sess_key_hex)
-        session_key = private_key.decrypt(
-            enc_sess_key,
-            padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
-        )
-        
-        cipher_suite = Fernet(session_key)
-        encrypted_data = base64.b64decode(encrypted_data_b64)
-        file_data = cipher_suite.decrypt(encrypted_data)
-        
-        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
-        save_path = os.path.join(DOWNLOADS_DIR, f"{sender_id}_{filename}")
-        
-        with open(save_path, 'wb') as f:
-            f.write(file_data)
-        
-        return save_path, file_size
-    except Exception as e:
-        print_centered(f"[!] FILE DECRYPTION ERROR: {e}", Fore.RED)
-        logging.error(f"File decryption error: {e}")
-        return None, 0
-
-# ==================== MESSAGING ====================
-
-def receive_messages():
-    """Background thread to receive messages and files"""
-    global target_public_key_cache, is_connected
-    
-    while is_connected:
-        try:
-            data = client.recv(65536)
-            if not data: 
-                break
-            packet = data.decode('utf-8', errors='ignore')
-            
-            # Handle agent list response
-            if packet.startswith("[AGENT_LIST]"):
-                agent_data = packet.split("]")[1]
-                if agent_data:
-                    agents = agent_data.split("||")
-                    print("\n")
-                    print_centered("=== ONLINE AGENTS ===", Fore.CYAN, Style.BRIGHT)
-                    for agent in agents:
-                        parts = agent.split("|")
-                        if len(parts) == 3:
-                            aid, status, last_seen = parts
-                            color = Fore.GREEN if status == "ONLINE" else Fore.YELLOW
-                            print_centered(f"{aid} [{status}] - Last seen: {last_seen}", color)
-                    print("\n")
-                else:
-                    print_centered("[*] NO AGENTS ONLINE", Fore.YELLOW)
-                continue
-            
-            # Handle key lookup responses
-            if packet.startswith("[KEY_FOUND]"):
-                target_public_key_cache = packet.split("]")[1]
-                continue
-            
-            if packet.startswith("[KEY_NOT_FOUND]"):
-                target_public_key_cache = "ERROR"
-                continue
-            
-            # Handle typing indicators
-            if packet.startswith("[TYPING_INDICATOR]"):
-                sender = packet.split("]")[1]
-                print(f"\r{' ' * get_width()}\r", end='')
-                print_centered(f"[TYPING] {sender} is typing...", Fore.CYAN)
-                time.sleep(2)
-                prompt = "[SECURE INPUT] >> "
-                padding = max(0, (get_width() - len(prompt) - 10) // 2)
-                sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
-                sys.stdout.flush()
-                continue
-
-            # Handle incoming messages
-            if packet.startswith("[INCOMING]"):
-                _, content = packet.split("]", 1)
-                sender, blob = content.split("|", 1)
-                
-                # Check if sender is blocked
-                if is_blocked(sender):
-                    logging.info(f"Blocked message from {sender}")
-                    continue
-                
-                play_sound()
-                msg_text = decrypt_message(blob)
-                
-                # Update statistics
-                update_stats("messages_received")
-                update_stats("bytes_received", len(blob))
-                
-                # Save to history
-                save_message_to_history(sender, msg_text, "received")
-                
-                print("\n")
-                print_centered(f"[MSG] FROM {sender} (E2EE)", Fore.CYAN)
-                print_centered(f">> {msg_text}", Fore.GREEN, Style.BRIGHT)
-                print_centered(f"[{get_timestamp()}]", Fore.BLUE)
-                print("\n")
-                
-                # Send read receipt
-                if config["client"]["read_receipts"]:
-                    try:
-                        client.send(f"[READ_RECEIPT]{sender}|{get_timestamp()}".encode('utf-8'))
-                    except:
-                        pass
-                
-                prompt = "[SECURE INPUT] >> "
-                padding = max(0, (get_width() - len(prompt) - 10) // 2)
-                sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
-                sys.stdout.flush()
-            
-            # Handle incoming files
-            if packet.startswith("[FILE_INCOMING]"):
-                _, content = packet.split("]", 1)
-                sender, file_blob = content.split("|", 1)
-                
-                # Check if sender is blocked
-                if is_blocked(sender):
-                    logging.info(f"Blocked file from {sender}")
-                    continue
-                
-                play_sound()
-                print("\n")
-                print_centered(f"[FILE] RECEIVING FROM {sender}...", Fore.MAGENTA)
-                
-                save_path, file_size = decrypt_file(file_blob, sender)
-                
-                if save_path:
-                    # Update statistics
-                    update_stats("files_received")
-                    update_stats("bytes_received", file_size)
-                    
-                    print_centered(f"[+] FILE SAVED: {save_path} ({file_size} bytes)", Fore.GREEN)
-                    save_message_to_history(sender, f"[FILE RECEIVED: {os.path.basename(save_path)}]", "received")
-                else:
-                    print_centered("[!] FILE RECEIVE FAILED", Fore.RED)
-                
-                print("\n")
-                prompt = "[SECURE INPUT] >> "
-                padding = max(0, (get_width() - len(prompt) - 10) // 2)
-                sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
-                sys.stdout.flush()
-            
-            # Handle incoming voice notes
-            if packet.startswith("[VOICE_INCOMING]"):
-                _, content = packet.split("]", 1)
-                sender, voice_blob = content.split("|", 1)
-                
-                # Check if sender is blocked
-                if is_blocked(sender):
-                    logging.info(f"Blocked voice note from {sender}")
-                    continue
-                
-                play_sound()
-                print("\n")
-                print_centered(f"[VOICE] RECEIVING FROM {sender}...", Fore.MAGENTA)
-                
-                save_path, voice_size = decrypt_voice_note(voice_blob, sender)
-                
-                if save_path:
-                    # Update statistics
-                    update_stats("files_received")
-                    update_stats("bytes_received", voice_size)
-                    
-                    print_centered(f"[+] VOICE NOTE SAVED: {save_path} ({voice_size} bytes)", Fore.GREEN)
-                    save_message_to_history(sender, "[VOICE NOTE RECEIVED]", "received")
-                    
-                    # Auto-play option
-                    if VOICE_AVAILABLE:
-                        play_voice_note(save_path)
-                else:
-                    print_centered("[!] VOICE NOTE RECEIVE FAILED", Fore.RED)
-                
-                print("\n")
-                prompt = "[SECURE INPUT] >> "
-                padding = max(0, (get_width() - len(prompt) - 10) // 2)
-                sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
-                sys.stdout.flush()
-
-        except Exception as e:
-            logging.error(f"Receive error: {e}")
-            if config["client"]["auto_reconnect"]:
-                print_centered("[!] CONNECTION LOST - ATTEMPTING RECONNECT...", Fore.YELLOW)
-                time.sleep(config["client"]["reconnect_delay"])
-            break
-
-def send_typing_indicator(target_code):
-    """Send typing indicator to target"""
-    if not config["client"]["typing_indicators"]:
-        return
-    
-    global last_typing_time
-    current_time = time.time()
-    
-    if current_time - last_typing_time > 3:  # Send every 3 seconds max
-        try:
-            client.send(f"[TYPING]{target_code}".encode('utf-8'))
-            last_typing_time = current_time
-        except:
-            pass
-
-def send_messages(target_code):
-    """Main message sending loop with command support"""
-    global target_public_key_cache
-    
-    print_centered("\n[COMMANDS] /agents | /block | /stats | /export | /help\n", Fore.CYAN)
-    
-    while is_connected:
-        prompt = "[SECURE INPUT] >> "
-        padding = max(0, (get_width() - len(prompt) - 10) // 2)
-        sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
-        sys.stdout.flush()
-        
-        msg = input("")
-        
-        # Handle commands
-        if msg.lower() in ['/exit', '/quit']:
-            print_centered("[*] DISCONNECTING...", Fore.YELLOW)
-            break
-        
-        if msg.lower() == '/clear':
-            clear_screen()
-            print_centered(f"[*] SECURE CHANNEL: {my_agent_id} → {target_code}", Fore.GREEN)
-            continue
-        
-        if msg.lower() == '/agents':
-            try:
-                client.send(b"[LIST_AGENTS]")
-                time.sleep(0.5)
-            except:
-                print_centered("[!] ERROR FETCHING AGENT LIST", Fore.RED)
-            continue
-        
-        if msg.lower().startswith('/history'):
-            parts = msg.split()
-            agent_id = parts[1] if len(parts) > 1 else target_code
-            history = load_message_history(agent_id)
-            
-            if history:
-                print("\n")
-                print_centered(f"=== CHAT HISTORY WITH {agent_id} ===", Fore.CYAN, Style.BRIGHT)
-                for line in history:
-                    print(line.strip())
-                print("\n")
-            else:
-                print_centered(f"[*] NO HISTORY FOUND FOR {agent_id}", Fore.YELLOW)
-            continue
-        
-        if msg.lower() == '/help':
-            print("\n")
-            print_centered("=== AVAILABLE COMMANDS ===", Fore.CYAN, Style.BRIGHT)
-            print_centered("/agents - List online agents", Fore.WHITE)
-            print_centered("/sendfile <filepath> - Send encrypted file", Fore.WHITE)
-            print_centered("/record [duration] - Record voice note (default 10s)", Fore.WHITE)
-            print_centered("/history [agent-id] - View chat history", Fore.WHITE)
-            print_centered("/block <agent-id> - Block an agent", Fore.WHITE)
-            print_centered("/unblock <agent-id> - Unblock an agent", Fore.WHITE)
-            print_centered("/blocklist - View blocked agents", Fore.WHITE)
-            print_centered("/stats - View session statistics", Fore.WHITE)
-            print_centered("/export <agent-id> [txt|json] - Export chat", Fore.WHITE)
-            print_centered("/clear - Clear screen", Fore.WHITE)
-            print_centered("/exit or /quit - Disconnect", Fore.WHITE)
-            print_centered("/help - Show this help", Fore.WHITE)
-            print("\n")
-            continue
-        
-        # Block system commands
-        if msg.lower().startswith('/block '):
-            agent_id = msg[7:].strip()
-            if agent_id:
-                block_agent(agent_id)
-            else:
-                print_centered("[!] USAGE: /block <agent-id>", Fore.YELLOW)
-            continue
-        
-        if msg.lower().startswith('/unblock '):
-            agent_id = msg[9:].strip()
-            if agent_id:
-                unblock_agent(agent_id)
-            else:
-                print_centered("[!] USAGE: /unblock <agent-id>", Fore.YELLOW)
-            continue
-        
-        if msg.lower() == '/blocklist':
-            if blocked_agents:
-                print("\n")
-                print_centered("=== BLOCKED AGENTS ===", Fore.RED, Style.BRIGHT)
-                for agent in blocked_agents:
-                    print_centered(f"[BLOCKED] {agent}", Fore.RED)
-                print("\n")
-            else:
-                print_centered("[*] NO BLOCKED AGENTS", Fore.YELLOW)
-            continue
-        
-        # Statistics command
-        if msg.lower() == '/stats':
-            show_statistics()
-            continue
-        
-        # Export command
-        if msg.lower().startswith('/export '):
-            parts = msg.split()
-            if len(parts) >= 2:
-                agent_id = parts[1]
-                format_type = parts[2] if len(parts) > 2 else "txt"
-                export_chat(agent_id, format_type)
-            else:
-                print_centered("[!] USAGE: /export <agent-id> [txt|json]", Fore.YELLOW)
-            continue
-        
-        # Voice recording command
-        if msg.lower().startswith('/record'):
-            parts = msg.split()
-            duration = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
-            
-            if duration > 60:
-                print_centered("[!] MAXIMUM DURATION IS 60 SECONDS", Fore.RED)
-                continue
-            
-            voice_file = record_voice_note(duration)
-            if voice_file:
-                print_centered(f"[*] ENCRYPTING VOICE NOTE...", Fore.YELLOW)
-                
-                # Get target public key
-                target_public_key_cache = None
-                client.send(f"[GET_KEY]{target_code}".encode('utf-8'))
-                
-                wait_timer = 0
-                while target_public_key_cache is None and wait_timer < 20:
-                    time.sleep(0.1)
-                    wait_timer += 1
-                
-                if target_public_key_cache and target_public_key_cache != "ERROR":
-                    voice_blob = encrypt_voice_note(voice_file, target_public_key_cache)
-                    
-                    if voice_blob:
-                        packet = f"[VOICE]{target_code}|{voice_blob}"
-                        client.send(packet.encode('utf-8'))
-                        
-                        # Update stats
-                        update_stats("files_sent")
-                        update_stats("bytes_sent", len(voice_blob))
-                        
-                        print_centered("[+] VOICE NOTE SENT", Fore.GREEN)
-                        save_message_to_history(target_code, "[VOICE NOTE SENT]", "sent")
-                    else:
-                        print_centered("[!] VOICE ENCRYPTION FAILED", Fore.RED)
-                else:
-                    print_centered("[!] TARGET AGENT NOT AVAILABLE", Fore.RED)
-            continue
-        
-        if msg.lower().startswith('/sendfile '):
-            filepath = msg[10:].strip()
-            
-            if not os.path.exists(filepath):
-                print_centered(f"[!] FILE NOT FOUND: {filepath}", Fore.RED)
-                continue
-            
-            print_centered(f"[*] ENCRYPTING FILE: {filepath}...", Fore.YELLOW)
-            
-            target_public_key_cache = None
-            client.send(f"[GET_KEY]{target_code}".encode('utf-8'))
-            
-            wait_timer = 0
-            while target_public_key_cache is None and wait_timer < 20:
-                time.sleep(0.1)
-                wait_timer += 1
-            
-            if target_public_key_cache == "ERROR" or target_public_key_cache is None:
-                print_centered("[!] ERROR: TARGET AGENT NOT AVAILABLE", Fore.RED)
-                continue
-            
-            encrypted_file_blob = encrypt_file(filepath, target_public_key_cache)
-            
-            if encrypted_file_blob:
-                packet = f"[FILE]{target_code}|{encrypted_file_blob}"
-                client.send(packet.encode('utf-8'))
-                print_centered(f"[+] FILE SENT: {os.path.basename(filepath)}", Fore.GREEN)
-                save_message_to_history(target_code, f"[FILE SENT: {os.path.basename(filepath)}]", "sent")
-            else:
-                print_centered("[!] FILE SEND FAILED", Fore.RED)
-            
-            continue
-        
-        # Regular message sending
-        if not msg.strip():
-            continue
-        
-        # Send typing indicator
-        send_typing_indicator(target_code)
-        
-        # Get target's public key
-        target_public_key_cache = None
-        client.send(f"[GET_KEY]{target_code}".encode('utf-8'))
-        
-        wait_timer = 0
-        while target_public_key_cache is None and wait_timer < 20:
-            time.sleep(0.1)
-            wait_timer += 1
-            
-        if target_public_key_cache == "ERROR" or target_public_key_cache is None:
-            print_centered("[!] ERROR: TARGET AGENT NOT AVAILABLE OR KEY INVALID.", Fore.RED)
-            continue
-
-        try:
-            encrypted_blob = encrypt_message(msg, target_public_key_cache)
-            packet = f"[MSG]{target_code}|{encrypted_blob}"
-            client.send(packet.encode('utf-8'))
-            
-            # Update statistics
-            update_stats("messages_sent")
-            update_stats("bytes_sent", len(encrypted_blob))
-            
-            # Save to history
-            save_message_to_history(target_code, msg, "sent")
-            
-            print_centered("[SENT] 2048-BIT ENCRYPTED PACKET.", Fore.GREEN)
-        except Exception as e:
-            print_centered(f"[ERROR] SEND FAILED: {e}", Fore.RED)
-            logging.error(f"Send error: {e}")
-
-# ==================== MAIN SYSTEM ====================
-
-def start_system():
-    """Main application entry point"""
-    global target_public_key_cache, client, is_connected
-    
-    clear_screen()
-    print("\n" * 2)
-    
-    # ASCII Banner
-    print_centered("╔═══════════════════════════════════════════════╗", Fore.GREEN, Style.BRIGHT)
-    print_centered("║      G.I.D SECURE TERMINAL v2.0 (E2EE)        ║", Fore.GREEN, Style.BRIGHT)
-    print_centered("╚═══════════════════════════════════════════════╝", Fore.GREEN, Style.BRIGHT)
-    print("\n")
-    
-    print_centered("INITIALIZING RSA-2048 CRYPTO ENGINE...", Fore.CYAN)
-    time.sleep(1)
-    
-    # Initialize session stats and load blocklist
-    session_stats["start_time"] = time.time()
-    load_blocklist()
-    
-    # Setup persistent identity
-    if not setup_identity():
-        print_centered("[!] IDENTITY SETUP FAILED", Fore.RED)
-        return
-    
-    # Security challenge
-    if not binary_matrix_hack():
-        print_centered("ACCESS DENIED.", Fore.RED)
-        return
-
-    # Connect to server
-    try:
-        print_centered(f"\n[*] CONNECTING TO {SERVER_IP}:{SERVER_PORT}...", Fore.CYAN)
-        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client.connect((SERVER_IP, SERVER_PORT))
-        client.send(f"[REGISTER]{my_agent_id}|{pem_public}".encode('utf-8'))
-        is_connected = True
-        logging.info(f"Connected to server as {my_agent_id}")
-    except Exception as e:
-        print_centered(f"[!] SERVER UNREACHABLE: {e}", Fore.RED)
-        logging.error(f"Connection error: {e}")
-        return
-
-    clear_screen()
-    print("\n" * 2)
-    print_centered(f"IDENTITY VERIFIED: {my_agent_id}", Fore.GREEN, Style.BRIGHT)
-    print_centered(f"PUBLIC KEY FINGERPRINT: {pem_public[50:80]}...", Fore.BLUE)
-    print_centered("-" * 50)
-    
-    # Start message receiver thread
-    threading.Thread(target=receive_messages, daemon=True).start()
-
-    # Get target agent
-    while True:
-        target_agent_code = input_centered("\nENTER TARGET AGENT ID (or /agents to list): ", Fore.MAGENTA)
-        
-        if target_agent_code.lower() == '/agents':
-            try:
-                client.send(b"[LIST_AGENTS]")
-                time.sleep(1)
-                continue
-            except:
-                print_centered("[!] ERROR FETCHING AGENT LIST", Fore.RED)
-                continue
-        
-        print_centered(f"[*] FETCHING KEY FOR {target_agent_code}...", Fore.YELLOW)
-        target_public_key_cache = None
-        client.send(f"[GET_KEY]{target_agent_code}".encode('utf-8'))
-        
-        waits = 0
-        while target_public_key_cache is None and waits < 15:
-            time.sleep(0.2)
-            waits += 1
-            
-        if target_public_key_cache == "ERROR":
-            print("\n")
-            print_centered(f"[!] AGENT '{target_agent_code}' NOT REGISTERED.", Fore.RED)
-            print_centered("    TARGET MUST LOGIN AT LEAST ONCE TO GENERATE KEYS.", Fore.RED)
-            print_centered("-" * 30, Fore.RED)
-        elif target_public_key_cache:
-            print_centered("[+] SECURE CHANNEL ESTABLISHED.", Fore.GREEN)
-            break 
-        else:
-            print_centered("[!] SERVER TIMEOUT.", Fore.RED)
-
-    # Start messaging
-    send_messages(target_agent_code)
-    is_connected = False
-
-if __name__ == "__main__":
-    try:
-        start_system()
-    except KeyboardInterrupt:
-        print_centered("\n\n[!] SESSION TERMINATED", Fore.RED)
-        logging.info("Session terminated by user")
-    except Exception as e:
-        print_centered(f"\n\n[!] CRITICAL ERROR: {e}", Fore.RED)
-        logging.error(f"Critical error: {e}")
\ No newline at end of file
+import socket
+import threading
+import random
+import time
+import os
+import sys
+import shutil
+import hashlib
+import base64
+import json
+import logging
+import re
+import uuid
+from datetime import datetime
+from pathlib import Path
+from colorama import Fore, Style, init
+from cryptography.hazmat.primitives.asymmetric import rsa, padding
+from cryptography.hazmat.primitives import serialization, hashes
+from cryptography.fernet import Fernet
+from protocol import FrameDecoder, encode_frame
+from compression import CODECS, SAMPLE_SIZE, choose_codec, common_codecs, compress, compress_with, decompress, parse_codecs
+
+# Voice recording imports (optional - graceful degradation)
+try:
+    import sounddevice as sd
+    import soundfile as sf
+    import numpy as np
+    VOICE_AVAILABLE = True
+except ImportError:
+    VOICE_AVAILABLE = False
+    logging.warning("Voice recording not available - install sounddevice, soundfile, numpy")
+
+init(autoreset=True)
+
+# Load configuration
+CONFIG_FILE = "config.json"
+DEFAULT_CONFIG = {
+    "server": {"host": "127.0.0.1", "port": 5555},
+    "client": {
+        "auto_reconnect": True,
+        "reconnect_delay": 5,
+        "max_reconnect_attempts": 10,
+        "save_history": True,
+        "typing_indicators": True,
+        "read_receipts": True
+    }
+}
+
+def load_config():
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            return json.load(f)
+    except:
+        return DEFAULT_CONFIG
+
+config = load_config()
+SERVER_IP = config["server"]["host"]
+SERVER_PORT = config["server"]["port"]
+IDENTITY_FILE = "identity.pem"
+DOWNLOADS_DIR = "downloads"
+HISTORY_DIR = "chat_history"
+BLOCKLIST_FILE = "blocklist.json"
+KNOWN_KEYS_FILE = "known_keys.json"
+VOICE_DIR = "voice_notes"
+TRANSFER_DIR = "transfers"
+OUTBOX_DIR = "outbox"
+DELIVERY_FILE = "delivery.json"
+CHUNK_SIZE = 256 * 1024
+TRANSFER_WINDOW = 4  # Chunks in flight before waiting for an ack
+TRANSFER_ACK_TIMEOUT = 5  # Seconds without ack progress before resending from the last acked chunk
+THROTTLE_PAUSE = 1.0  # Least time transfers wait after a THROTTLED; the server reports one drop a second at most
+TRANSFER_ID = re.compile(r"[0-9a-f]{16}")  # Peer-supplied ids end up in file names
+AGENT_PAGE_SIZE = 20
+MAX_INFLATED_SIZE = 64 * 1024 * 1024  # Largest a compressed message, voice note or inline file may expand to
+SEND_WINDOW = 64  # Unconfirmed messages in flight before sending waits
+ACK_TIMEOUT = 30  # Seconds before an unconfirmed message is sent again
+STATE_FLUSH_INTERVAL = 1.0  # Seconds between writes of delivery state changed by sending
+MAX_RETRIES = 5
+SEQUENCED_INCOMING = {"SEQ_INCOMING": "INCOMING", "SEQ_FILE_INCOMING": "FILE_INCOMING", "SEQ_VOICE_INCOMING": "VOICE_INCOMING"}
+MAX_OUT_OF_ORDER = 1024  # Sequence numbers remembered above a conversation's watermark
+EPOCH_SHIFT = 32  # Sequence numbers are (epoch << EPOCH_SHIFT) + count, with a random epoch per install
+TYPING_TTL = 6  # Seconds a typing notice stands without a stop, matching the server
+RECEIPT_DELAY = 1.0  # Seconds read receipts are held so each conversation sends one
+RECEIPT_WINDOW = 32  # Messages read in one conversation that send its receipt early
+
+# Setup logging
+os.makedirs("logs", exist_ok=True)
+logging.basicConfig(
+    filename='logs/client.log',
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+client = None
+private_key = None
+public_key = None
+pem_public = None
+my_agent_id = None
+target_public_key_cache = None
+channel_members_cache = None
+key_batch_cache = None
+known_keys = {}  # Agent ID -> {"fingerprint", "version", "pem", "codecs"} from the server's key directory
+agent_page_query = [""]  # Prefix of the last /agents listing, for the "more" hint
+blocked_agents = set()
+session_stats = {
+    "messages_sent": 0,
+    "messages_received": 0,
+    "files_sent": 0,
+    "files_received": 0,
+    "bytes_sent": 0,
+    "bytes_received": 0,
+    "payload_bytes": 0,  # Outgoing plaintext before compression
+    "compressed_bytes": 0,  # ... and after
+    "start_time": None
+}
+outbox = {}  # (target, seq) -> message awaiting DELIVERED or STORED from each recipient
+outbox_lock = threading.Condition()
+delivery_state = {"next": {}, "seen": {}}  # Our epoch; last seq sent per target; [watermark, [seqs above it]] per sender
+pending_acks = {}  # Sender -> seqs received in the current read, acked together
+delivery_dirty = False  # delivery_state changed since it was last written
+retired_outbox = []  # Outbox files to delete once delivery_state is written
+unreported_reads = {}  # Conversation -> messages read since its last receipt
+read_reported = {}  # Conversation -> highest seq we have told its sender we read
+peer_reads = {}  # (target, reader) -> highest of our seqs reader has read
+receipt_lock = threading.Lock()
+send_lock = threading.Lock()  # Transfer workers, the receive thread and watchers share one socket
+outgoing_transfers = {}
+incoming_transfers = {}
+transfer_lock = threading.Condition()
+typing_agents = {}  # Sender -> time.time() its typing notice was shown
+last_typing_time = 0
+is_connected = False
+
+# ==================== UTILITY FUNCTIONS ====================
+
+def get_width():
+    try: 
+        return shutil.get_terminal_size().columns
+    except: 
+        return 80
+
+def clear_screen(): 
+    os.system('cls' if os.name == 'nt' else 'clear')
+
+def play_sound(): 
+    sys.stdout.write('\a')
+    sys.stdout.flush()
+
+def print_centered(text, color=Fore.WHITE, style=Style.NORMAL):
+    width = get_width()
+    padding = max(0, (width - len(text)) // 2)
+    print(" " * padding + color + style + text)
+
+def input_centered(prompt_text, color=Fore.YELLOW):
+    width = get_width()
+    padding = max(0, (width - len(prompt_text) - 10) // 2) 
+    sys.stdout.write(" " * padding + color + prompt_text)
+    sys.stdout.flush()
+    return input(Fore.WHITE)
+
+def get_timestamp():
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+# ==================== MESSAGE HISTORY ====================
+
+def save_message_to_history(agent_id, message, direction="sent"):
+    """Save encrypted message to local history"""
+    if not config["client"]["save_history"]:
+        return
+    
+    try:
+        os.makedirs(HISTORY_DIR, exist_ok=True)
+        history_file = os.path.join(HISTORY_DIR, f"{agent_id}.log")
+        
+        timestamp = get_timestamp()
+        entry = f"[{timestamp}] [{direction.upper()}] {message}\n"
+        
+        with open(history_file, 'a', encoding='utf-8') as f:
+            f.write(entry)
+    except Exception as e:
+        logging.error(f"Error saving history: {e}")
+
+def load_message_history(agent_id, limit=50):
+    """Load message history for an agent"""
+    try:
+        history_file = os.path.join(HISTORY_DIR, f"{agent_id}.log")
+        if not os.path.exists(history_file):
+            return []
+        
+        with open(history_file, 'r', encoding='utf-8') as f:
+            lines = f.readlines()
+        
+        return lines[-limit:] if len(lines) > limit else lines
+    except Exception as e:
+        logging.error(f"Error loading history: {e}")
+        return []
+
+# ==================== BLOCK SYSTEM ====================
+
+def load_blocklist():
+    """Load blocked agents from file"""
+    global blocked_agents
+    try:
+        if os.path.exists(BLOCKLIST_FILE):
+            with open(BLOCKLIST_FILE, 'r') as f:
+                blocked_agents = set(json.load(f))
+    except Exception as e:
+        logging.error(f"Error loading blocklist: {e}")
+        blocked_agents = set()
+
+def save_blocklist():
+    """Save blocked agents to file"""
+    try:
+        with open(BLOCKLIST_FILE, 'w') as f:
+            json.dump(list(blocked_agents), f, indent=2)
+    except Exception as e:
+        logging.error(f"Error saving blocklist: {e}")
+
+def block_agent(agent_id):
+    """Block an agent"""
+    blocked_agents.add(agent_id)
+    save_blocklist()
+    print_centered(f"[+] BLOCKED: {agent_id}", Fore.RED)
+
+def unblock_agent(agent_id):
+    """Unblock an agent"""
+    if agent_id in blocked_agents:
+        blocked_agents.remove(agent_id)
+        save_blocklist()
+        print_centered(f"[+] UNBLOCKED: {agent_id}", Fore.GREEN)
+    else:
+        print_centered(f"[!] {agent_id} IS NOT BLOCKED", Fore.YELLOW)
+
+def is_blocked(agent_id):
+    """Check if an agent is blocked"""
+    return agent_id in blocked_agents
+
+# ==================== KNOWN KEYS ====================
+
+def load_known_keys():
+    """Load cached public keys from file"""
+    global known_keys
+    try:
+        if os.path.exists(KNOWN_KEYS_FILE):
+            with open(KNOWN_KEYS_FILE, 'r') as f:
+                known_keys = json.load(f)
+    except Exception as e:
+        logging.error(f"Error loading known keys: {e}")
+        known_keys = {}
+
+def save_known_keys():
+    """Save cached public keys to file"""
+    try:
+        with open(KNOWN_KEYS_FILE, 'w') as f:
+            json.dump(known_keys, f, indent=2)
+    except Exception as e:
+        logging.error(f"Error saving known keys: {e}")
+
+def remember_key(agent_id, fingerprint, version, codecs, pem):
+    """Cache a key from the server, warning if it replaces a different one"""
+    previous = known_keys.get(agent_id)
+    if previous and previous["fingerprint"] != fingerprint:
+        print_centered(f"[!] PUBLIC KEY FOR {agent_id} HAS CHANGED (VERSION {version})", Fore.RED, Style.BRIGHT)
+        logging.warning(f"Key for {agent_id} changed to version {version}, fingerprint {fingerprint}")
+    known_keys[agent_id] = {"fingerprint": fingerprint, "version": int(version or 0), "pem": pem, "codecs": codecs}
+    save_known_keys()
+
+def remember_codecs(agent_id, codecs):
+    """Update the codec list of a key we already hold"""
+    known = known_keys.get(agent_id)
+    if known is not None and known.get("codecs") != codecs:
+        known["codecs"] = codecs
+        save_known_keys()
+
+def negotiate_codecs(target_code, target_pub_pem):
+    """Codecs every recipient of target_pub_pem (PEM or {agent_id: PEM}) can decode"""
+    recipients = recipients_of(target_code, target_pub_pem)
+    return common_codecs([parse_codecs(known_keys.get(aid, {}).get("codecs", "")) for aid in recipients])
+
+# ==================== STATISTICS ====================
+
+def update_stats(stat_type, value=1):
+    """Update session statistics"""
+    if stat_type in session_stats:
+        session_stats[stat_type] += value
+
+def pack_payload(data, codecs):
+    """Compress outgoing plaintext for recipients that accept codecs; returns (codec, body)"""
+    codec, body = compress(data, codecs)
+    update_stats("payload_bytes", len(data))
+    update_stats("compressed_bytes", len(body))
+    return codec, body
+
+def get_uptime():
+    """Get session uptime"""
+    if session_stats["start_time"]:
+        elapsed = time.time() - session_stats["start_time"]
+        hours = int(elapsed // 3600)
+        minutes = int((elapsed % 3600) // 60)
+        seconds = int(elapsed % 60)
+        return f"{hours:02d}:{minutes:02d}:{seconds:02d}"
+    return "00:00:00"
+
+def show_statistics():
+    """Display session statistics"""
+    print("\n")
+    print_centered("=== SESSION STATISTICS ===", Fore.CYAN, Style.BRIGHT)
+    print_centered(f"Messages Sent: {session_stats['messages_sent']}", Fore.WHITE)
+    print_centered(f"Messages Received: {session_stats['messages_received']}", Fore.WHITE)
+    print_centered(f"Files Sent: {session_stats['files_sent']}", Fore.WHITE)
+    print_centered(f"Files Received: {session_stats['files_received']}", Fore.WHITE)
+    print_centered(f"Data Sent: {session_stats['bytes_sent']:,} bytes", Fore.WHITE)
+    print_centered(f"Data Received: {session_stats['bytes_received']:,} bytes", Fore.WHITE)
+    if session_stats["payload_bytes"]:
+        ratio = session_stats["payload_bytes"] / max(1, session_stats["compressed_bytes"])
+        print_centered(f"Compression: {session_stats['payload_bytes']:,} -> {session_stats['compressed_bytes']:,} bytes ({ratio:.2f}x)", Fore.WHITE)
+    print_centered(f"Awaiting Confirmation: {len(outbox)} messages", Fore.WHITE)
+    print_centered(f"Session Uptime: {get_uptime()}", Fore.WHITE)
+    print("\n")
+
+# ==================== EXPORT SYSTEM ====================
+
+def export_chat(agent_id, format_type="txt"):
+    """Export chat history to file"""
+    try:
+        history = load_message_history(agent_id, limit=None)
+        
+        if not history:
+            print_centered(f"[!] NO HISTORY FOUND FOR {agent_id}", Fore.YELLOW)
+            return
+        
+        export_dir = "exports"
+        os.makedirs(export_dir, exist_ok=True)
+        
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        
+        if format_type.lower() == "txt":
+            filename = os.path.join(export_dir, f"{agent_id}_{timestamp}.txt")
+            with open(filename, 'w', encoding='utf-8') as f:
+                f.write(f"Chat Export: {my_agent_id} <-> {agent_id}\n")
+                f.write(f"Exported: {get_timestamp()}\n")
+                f.write("=" * 60 + "\n\n")
+                f.writelines(history)
+            
+            print_centered(f"[+] CHAT EXPORTED: {filename}", Fore.GREEN)
+        
+        elif format_type.lower() == "json":
+            filename = os.path.join(export_dir, f"{agent_id}_{timestamp}.json")
+            export_data = {
+                "export_info": {
+                    "my_agent_id": my_agent_id,
+                    "target_agent_id": agent_id,
+                    "export_time": get_timestamp(),
+                    "message_count": len(history)
+                },
+                "messages": [line.strip() for line in history]
+            }
+            
+            with open(filename, 'w', encoding='utf-8') as f:
+                json.dump(export_data, f, indent=2, ensure_ascii=False)
+            
+            print_centered(f"[+] CHAT EXPORTED: {filename}", Fore.GREEN)
+        
+        else:
+            print_centered(f"[!] UNSUPPORTED FORMAT: {format_type}", Fore.RED)
+    
+    except Exception as e:
+        print_centered(f"[!] EXPORT ERROR: {e}", Fore.RED)
+        logging.error(f"Export error: {e}")
+
+# ==================== VOICE NOTES ====================
+
+def record_voice_note(duration=10, sample_rate=44100):
+    """Record voice note"""
+    if not VOICE_AVAILABLE:
+        print_centered("[!] VOICE RECORDING NOT AVAILABLE", Fore.RED)
+        print_centered("[*] Install: pip install sounddevice soundfile numpy", Fore.YELLOW)
+        return None
+    
+    try:
+        print_centered(f"[*] RECORDING FOR {duration} SECONDS...", Fore.CYAN)
+        print_centered("[*] SPEAK NOW", Fore.GREEN, Style.BRIGHT)
+        
+        # Record audio
+        recording = sd.rec(int(duration * sample_rate), samplerate=sample_rate, channels=1, dtype='float32')
+        sd.wait()
+        
+        # Save to temporary file
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        temp_file = os.path.join(VOICE_DIR, f"voice_{timestamp}.wav")
+        sf.write(temp_file, recording, sample_rate)
+        
+        print_centered(f"[+] RECORDING COMPLETE: {os.path.getsize(temp_file)} bytes", Fore.GREEN)
+        return temp_file
+        
+    except Exception as e:
+        print_centered(f"[!] RECORDING ERROR: {e}", Fore.RED)
+        logging.error(f"Voice recording error: {e}")
+        return None
+
+def encrypt_voice_note(filepath, target_pub_pem, codecs=()):
+    """Encrypt voice note file"""
+    try:
+        with open(filepath, 'rb') as f:
+            audio_data = f.read()
+        
+        # Generate session key
+        session_key = Fernet.generate_key()
+        cipher_suite = Fernet(session_key)
+        codec, audio_data = pack_payload(audio_data, codecs)
+        encrypted_audio = cipher_suite.encrypt(audio_data)
+        
+        # Encrypt session key with recipient's public key(s)
+        wrapped_key = wrap_session_key(session_key, target_pub_pem)
+        
+        # Combine: encrypted_key||encrypted_audio[||codec]
+        blob = wrapped_key + "||" + encrypted_audio.decode('utf-8')
+        if codec:
+            blob += "||" + codec
+        
+        # Clean up temp file
+        os.remove(filepath)
+        
+        return blob
+        
+    except Exception as e:
+        print_centered(f"[!] VOICE ENCRYPTION ERROR: {e}", Fore.RED)
+        logging.error(f"Voice encryption error: {e}")
+        return None
+
+def decrypt_voice_note(blob, sender_id):
+    """Decrypt and save voice note"""
+    try:
+        encrypted_key_hex, encrypted_audio, *codec = blob.split("||")
+        
+        # Decrypt session key
+        session_key = unwrap_session_key(encrypted_key_hex)
+        
+        # Decrypt audio
+        cipher_suite = Fernet(session_key)
+        audio_data = cipher_suite.decrypt(encrypted_audio.encode('utf-8'))
+        if codec:
+            audio_data = decompress(audio_data, codec[0], MAX_INFLATED_SIZE)
+        
+        # Save file
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        save_path = os.path.join(VOICE_DIR, f"{sender_id}_voice_{timestamp}.wav")
+        
+        with open(save_path, 'wb') as f:
+            f.write(audio_data)
+        
+        return save_path, len(audio_data)
+        
+    except Exception as e:
+        print_centered(f"[!] VOICE DECRYPTION ERROR: {e}", Fore.RED)
+        logging.error(f"Voice decryption error: {e}")
+        return None, 0
+
+def play_voice_note(filepath):
+    """Play voice note"""
+    if not VOICE_AVAILABLE:
+        print_centered("[!] VOICE PLAYBACK NOT AVAILABLE", Fore.RED)
+        return
+    
+    try:
+        data, sample_rate = sf.read(filepath)
+        print_centered("[*] PLAYING VOICE NOTE...", Fore.CYAN)
+        sd.play(data, sample_rate)
+        sd.wait()
+        print_centered("[+] PLAYBACK COMPLETE", Fore.GREEN)
+        
+    except Exception as e:
+        print_centered(f"[!] PLAYBACK ERROR: {e}", Fore.RED)
+        logging.error(f"Voice playback error: {e}")
+
+# ==================== PERSISTENT IDENTITY ====================
+
+def derive_agent_id_from_key(pub_key):
+    """Generate consistent Agent ID from public key hash"""
+    key_bytes = pub_key.public_bytes(
+        encoding=serialization.Encoding.DER,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    )
+    hash_digest = hashlib.sha256(key_bytes).hexdigest()
+    return f"AGENT-{hash_digest[:12].upper()}"
+
+def save_identity(priv_key, password):
+    """Encrypt and save private key to file"""
+    try:
+        encryption_algorithm = serialization.BestAvailableEncryption(password.encode('utf-8'))
+        pem_private = priv_key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.PKCS8,
+            encryption_algorithm=encryption_algorithm
+        )
+        
+        with open(IDENTITY_FILE, 'wb') as f:
+            f.write(pem_private)
+        
+        print_centered(f"[+] IDENTITY SAVED TO {IDENTITY_FILE}", Fore.GREEN)
+        return True
+    except Exception as e:
+        print_centered(f"[!] ERROR SAVING IDENTITY: {e}", Fore.RED)
+        logging.error(f"Identity save error: {e}")
+        return False
+
+def load_identity(password):
+    """Load and decrypt private key from file"""
+    try:
+        with open(IDENTITY_FILE, 'rb') as f:
+            pem_private = f.read()
+        
+        priv_key = serialization.load_pem_private_key(
+            pem_private,
+            password=password.encode('utf-8')
+        )
+        
+        print_centered(f"[+] IDENTITY LOADED FROM {IDENTITY_FILE}", Fore.GREEN)
+        return priv_key
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print_centered(f"[!] ERROR LOADING IDENTITY: {e}", Fore.RED)
+        logging.error(f"Identity load error: {e}")
+        return None
+
+def setup_identity():
+    """Setup or load persistent identity"""
+    global private_key, public_key, pem_public, my_agent_id
+    
+    if os.path.exists(IDENTITY_FILE):
+        print_centered("[*] EXISTING IDENTITY DETECTED", Fore.CYAN)
+        
+        import getpass
+        max_attempts = 3
+        for attempt in range(max_attempts):
+            password = getpass.getpass(" " * ((get_width() - 30) // 2) + Fore.YELLOW + "ENTER PASSWORD: " + Style.RESET_ALL)
+            
+            private_key = load_identity(password)
+            if private_key is None:
+                remaining = max_attempts - attempt - 1
+                if remaining > 0:
+                    print_centered(f"[!] INCORRECT PASSWORD ({remaining} attempts remaining)", Fore.RED)
+                    continue
+                else:
+                    print_centered("[!] MAXIMUM ATTEMPTS REACHED", Fore.RED)
+                    return False
+            else:
+                break
+    else:
+        print_centered("[*] NO IDENTITY FOUND - GENERATING NEW KEYPAIR", Fore.CYAN)
+        time.sleep(1)
+        
+        private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        
+        import getpass
+        while True:
+            password = getpass.getpass(" " * ((get_width() - 35) // 2) + Fore.YELLOW + "CREATE PASSWORD (min 8 chars): " + Style.RESET_ALL)
+            
+            if len(password) < 8:
+                print_centered("[!] PASSWORD TOO SHORT (minimum 8 characters)", Fore.RED)
+                continue
+            
+            confirm = getpass.getpass(" " * ((get_width() - 30) // 2) + Fore.YELLOW + "CONFIRM PASSWORD: " + Style.RESET_ALL)
+            
+            if password != confirm:
+                print_centered("[!] PASSWORDS DO NOT MATCH", Fore.RED)
+                continue
+            
+            break
+        
+        if not save_identity(private_key, password):
+            return False
+    
+    public_key = private_key.public_key()
+    pem_public = public_key.public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo
+    ).decode('utf-8')
+    
+    my_agent_id = derive_agent_id_from_key(public_key)
+    
+    return True
+
+# ==================== SECURITY CHALLENGE ====================
+
+def binary_matrix_hack():
+    """Simple security verification - Access Code"""
+    print("\n")
+    print_centered("[!] SECURITY VERIFICATION PROTOCOL", Fore.RED, Style.BRIGHT)
+    print_centered("-" * 50, Fore.RED)
+    time.sleep(0.5)
+    
+    # Simple access code (can be customized)
+    access_code = input_centered("ENTER ACCESS CODE (default: 'SECURE'): ", Fore.YELLOW)
+    
+    if not access_code.strip():
+        access_code = "SECURE"
+    
+    print_centered("VERIFYING ACCESS...", Fore.BLUE)
+    time.sleep(1)
+    
+    # Always grant access (or you can add custom logic here)
+    return True
+
+
+# ==================== ENCRYPTION ====================
+
+def wrap_session_key(session_key, target_pub_pem):
+    """Encrypt a session key for one recipient (PEM) or several ({agent_id: PEM})
+
+    Several recipients produce "agent_id:hexkey,agent_id:hexkey" so one
+    ciphertext can be fanned out to a whole channel.
+    """
+    if isinstance(target_pub_pem, dict):
+        return ",".join(f"{aid}:{wrap_session_key(session_key, pem)}" for aid, pem in target_pub_pem.items())
+    
+    target_pub = serialization.load_pem_public_key(target_pub_pem.encode('utf-8'))
+    encrypted_session_key = target_pub.encrypt(
+        session_key,
+        padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+    )
+    return encrypted_session_key.hex()
+
+def unwrap_session_key(wrapped_key):
+    """Decrypt a session key produced by wrap_session_key with our private key"""
+    if ":" in wrapped_key:
+        wrapped_key = dict(entry.split(":", 1) for entry in wrapped_key.split(","))[my_agent_id]
+    return private_key.decrypt(
+        bytes.fromhex(wrapped_key),
+        padding.OAEP(mgf=padding.MGF1(algorithm=hashes.SHA256()), algorithm=hashes.SHA256(), label=None)
+    )
+
+def encrypt_message(message, target_pub_pem, codecs=()):
+    """Encrypt message using hybrid encryption (RSA + AES), compressing it first if worthwhile"""
+    session_key = Fernet.generate_key()
+    cipher_suite = Fernet(session_key)
+    codec, plain = pack_payload(message.encode('utf-8'), codecs)
+    encrypted_text = cipher_suite.encrypt(plain)
+    
+    blob = wrap_session_key(session_key, target_pub_pem) + "||" + encrypted_text.decode('utf-8')
+    if codec:
+        blob += "||" + codec
+    return blob
+
+def decrypt_message(blob):
+    """Decrypt message using hybrid decryption"""
+    try:
+        enc_sess_key_hex, enc_text_str, *codec = blob.split("||")
+        session_key = unwrap_session_key(enc_sess_key_hex)
+        cipher_suite = Fernet(session_key)
+        plain = cipher_suite.decrypt(enc_text_str.encode('utf-8'))
+        if codec:
+            plain = decompress(plain, codec[0], MAX_INFLATED_SIZE)
+        return plain.decode('utf-8')
+    except:
+        return "[ENCRYPTED DATA - CANNOT DECRYPT]"
+
+# ==================== FILE TRANSFER ====================
+
+def encrypt_file(filepath, target_pub_pem, codecs=()):
+    """Encrypt file for transfer"""
+    try:
+        with open(filepath, 'rb') as f:
+            file_data = f.read()
+        
+        filename = os.path.basename(filepath)
+        file_size = len(file_data)
+        
+        session_key = Fernet.generate_key()
+        cipher_suite = Fernet(session_key)
+        codec, file_data = pack_payload(file_data, codecs)
+        encrypted_data = cipher_suite.encrypt(file_data)
+        
+        wrapped_key = wrap_session_key(session_key, target_pub_pem)
+        
+        blob = f"{filename}||{file_size}||{wrapped_key}||{base64.b64encode(encrypted_data).decode('utf-8')}"
+        if codec:
+            blob += f"||{codec}"
+        return blob
+    except Exception as e:
+        print_centered(f"[!] FILE ENCRYPTION ERROR: {e}", Fore.RED)
+        logging.error(f"File encryption error: {e}")
+        return None
+
+def decrypt_file(blob, sender_id):
+    """Decrypt and save received file"""
+    try:
+        parts = blob.split("||")
+        filename = parts[0]
+        file_size = int(parts[1])
+        enc_sess_key_hex = parts[2]
+        encrypted_data_b64 = parts[3]
+        codec = parts[4] if len(parts) > 4 else None
+        
+        session_key = unwrap_session_key(enc_sess_key_hex)
+        
+        cipher_suite = Fernet(session_key)
+        encrypted_data = base64.b64decode(encrypted_data_b64)
+        file_data = decompress(cipher_suite.decrypt(encrypted_data), codec, min(file_size, MAX_INFLATED_SIZE))
+        
+        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+        save_path = os.path.join(DOWNLOADS_DIR, f"{sender_id}_{filename}")
+        
+        with open(save_path, 'wb') as f:
+            f.write(file_data)
+        
+        return save_path, file_size
+    except Exception as e:
+        print_centered(f"[!] FILE DECRYPTION ERROR: {e}", Fore.RED)
+        logging.error(f"File decryption error: {e}")
+        return None, 0
+
+# ==================== CHUNKED TRANSFER ====================
+
+def transfer_state_path(direction, transfer_id, suffix="json"):
+    return os.path.join(TRANSFER_DIR, direction, f"{transfer_id}.{suffix}")
+
+def save_transfer_state(direction, state):
+    """Persist transfer progress so it can resume after a reconnect"""
+    try:
+        os.makedirs(os.path.join(TRANSFER_DIR, direction), exist_ok=True)
+        path = transfer_state_path(direction, state["id"])
+        with open(path + ".tmp", 'w') as f:
+            json.dump(state, f)
+        os.replace(path + ".tmp", path)
+    except Exception as e:
+        logging.error(f"Error saving transfer state: {e}")
+
+def remove_transfer_state(direction, transfer_id):
+    for suffix in ("json", "part"):
+        try:
+            os.remove(transfer_state_path(direction, transfer_id, suffix))
+        except FileNotFoundError:
+            pass
+
+def encrypt_chunk(cipher_suite, index, data, codec=None):
+    """Encrypt one chunk, binding its index so chunks cannot be reordered
+
+    With a codec each chunk carries a flag byte after the index saying
+    whether it was compressed, since some chunks will not shrink.
+    """
+    if codec:
+        used, body = compress_with(data, codec)
+        update_stats("payload_bytes", len(data))
+        update_stats("compressed_bytes", len(body))
+        data = (b"\1" if used else b"\0") + body
+    return cipher_suite.encrypt(index.to_bytes(8, 'big') + data).decode('utf-8')
+
+def decrypt_chunk(cipher_suite, index, token, codec=None, limit=CHUNK_SIZE):
+    plain = cipher_suite.decrypt(token.encode('utf-8'))
+    if int.from_bytes(plain[:8], 'big') != index:
+        raise ValueError(f"chunk {index} out of place")
+    if codec:
+        return decompress(plain[9:], codec if plain[8] else None, limit)
+    return plain[8:]
+
+def start_transfer(filepath, target_code, target_pub_pem, kind="file", cleanup=False):
+    """Offer a file to target_code and stream it in encrypted chunks from a background thread
+
+    Whether to compress is decided once from the start of the file.
+    """
+    file_size = os.path.getsize(filepath)
+    with open(filepath, 'rb') as f:
+        sample = f.read(SAMPLE_SIZE)
+    session_key = Fernet.generate_key()
+    state = {
+        "id": uuid.uuid4().hex[:16],
+        "kind": kind,
+        "path": os.path.abspath(filepath),
+        "target": target_code,
+        "filename": os.path.basename(filepath),
+        "size": file_size,
+        "chunk_size": CHUNK_SIZE,
+        "total_chunks": max(1, -(-file_size // CHUNK_SIZE)),
+        "session_key": session_key.decode('utf-8'),
+        "wrapped_key": wrap_session_key(session_key, target_pub_pem),
+        "codec": choose_codec(sample, file_size, negotiate_codecs(target_code, target_pub_pem)),
+        "acked": 0,
+        "rewind": False,
+        "cleanup": cleanup
+    }
+    with transfer_lock:
+        outgoing_transfers[state["id"]] = state
+    save_transfer_state("outgoing", state)
+    send_offer(state)
+    threading.Thread(target=transfer_worker, args=(state,), daemon=True).start()
+    return state["id"]
+
+def send_offer(state):
+    """Offer a transfer; a codec rides after the wrapped key as "|codec" """
+    offer = "|".join(str(state[k]) for k in ("target", "id", "kind", "filename", "size", "chunk_size", "wrapped_key"))
+    if state.get("codec"):
+        offer += f"|{state['codec']}"
+    send_packet("XFER_OFFER", offer)
+
+def transfer_worker(state):
+    """Send chunks while fewer than TRANSFER_WINDOW are unacknowledged"""
+    cipher_suite = Fernet(state["session_key"].encode('utf-8'))
+    next_index = state["acked"]
+    total = state["total_chunks"]
+    with transfer_lock:
+        state["progress_at"] = time.time()
+    
+    try:
+        with open(state["path"], 'rb') as f:
+            while True:
+                with transfer_lock:
+                    while is_connected and state["acked"] < total:
+                        now = time.time()
+                        if now < state.get("paused_until", 0):
+                            transfer_lock.wait(state["paused_until"] - now)
+                            continue
+                        if next_index > state["acked"] and now - state["progress_at"] > TRANSFER_ACK_TIMEOUT:
+                            # Acks stopped: the chunks in flight were lost, e.g. dropped by the rate limiter
+                            state["rewind"] = True
+                            state["progress_at"] = now
+                        if state["rewind"] or next_index < min(total, state["acked"] + TRANSFER_WINDOW):
+                            break
+                        transfer_lock.wait(1)
+                    if not is_connected or state["acked"] >= total:
+                        break
+                    if state["rewind"]:
+                        next_index = state["acked"]
+                        state["rewind"] = False
+                    next_index = max(next_index, state["acked"])
+                
+                f.seek(next_index * state["chunk_size"])
+                token = encrypt_chunk(cipher_suite, next_index, f.read(state["chunk_size"]), state.get("codec"))
+                send_packet("XFER_CHUNK", f"{state['target']}|{state['id']}|{next_index}|{token}")
+                update_stats("bytes_sent", len(token))
+                next_index += 1
+    except Exception as e:
+        logging.error(f"Transfer {state['id']} error: {e}")
+        return
+    
+    if state["acked"] >= total:
+        finish_outgoing(state)
+
+def finish_outgoing(state):
+    with transfer_lock:
+        outgoing_transfers.pop(state["id"], None)
+        remove_transfer_state("outgoing", state["id"])
+    if state["cleanup"]:
+        try:
+            os.remove(state["path"])
+        except OSError:
+            pass
+    
+    label = "VOICE NOTE" if state["kind"] == "voice" else f"FILE {state['filename']}"
+    update_stats("files_sent")
+    save_message_to_history(state["target"], f"[{label} SENT]", "sent")
+    print_centered(f"[+] {label} DELIVERED TO {state['target']}", Fore.GREEN)
+
+def handle_transfer_ack(receiver, transfer_id, next_index, resume=False):
+    """Record the receiver's progress; a resume ack may rewind the sender"""
+    with transfer_lock:
+        state = outgoing_transfers.get(transfer_id)
+        if state is None or state["target"] != receiver:
+            return
+        if resume:
+            state["acked"] = next_index
+            state["rewind"] = True
+            state["progress_at"] = time.time()
+        elif next_index > state["acked"]:
+            state["acked"] = next_index
+            state["progress_at"] = time.time()
+        save_transfer_state("outgoing", state)
+        transfer_lock.notify_all()
+
+def pause_transfers(delay):
+    """The server dropped a chunk over its rate limit: hold every outgoing transfer, then resend from its last ack"""
+    with transfer_lock:
+        until = time.time() + delay
+        for state in outgoing_transfers.values():
+            state["paused_until"] = until
+            state["rewind"] = True
+        transfer_lock.notify_all()
+
+def handle_transfer_offer(sender, transfer_id, kind, filename, size, chunk_size, wrapped_key):
+    """Accept an incoming transfer and prepare its partial file"""
+    with transfer_lock:
+        if transfer_id in incoming_transfers:
+            return
+    wrapped_key, _, codec = wrapped_key.partition("|")
+    size = int(size)
+    chunk_size = int(chunk_size)
+    state = {
+        "id": transfer_id,
+        "kind": kind,
+        "sender": sender,
+        "filename": os.path.basename(filename),
+        "size": size,
+        "chunk_size": chunk_size,
+        "total_chunks": max(1, -(-size // chunk_size)),
+        "wrapped_key": wrapped_key,
+        "codec": codec or None,
+        "next": 0
+    }
+    os.makedirs(os.path.join(TRANSFER_DIR, "incoming"), exist_ok=True)
+    open(transfer_state_path("incoming", transfer_id, "part"), 'wb').close()
+    save_transfer_state("incoming", state)
+    with transfer_lock:
+        incoming_transfers[transfer_id] = (state, Fernet(unwrap_session_key(wrapped_key)))
+    
+    label = "VOICE NOTE" if kind == "voice" else f"FILE {state['filename']}"
+    print_centered(f"[{kind.upper()}] RECEIVING {label} FROM {sender} ({size:,} bytes)...", Fore.MAGENTA)
+
+def handle_transfer_chunk(sender, transfer_id, index, token):
+    """Write one chunk at its offset, acknowledge it and finish the file when complete"""
+    with transfer_lock:
+        entry = incoming_transfers.get(transfer_id)
+    if entry is None:
+        return
+    state, cipher_suite = entry
+    if sender != state["sender"]:
+        return
+    
+    if index != state["next"]:
+        # Duplicate after a resume, or a gap: tell the sender where we are
+        send_packet("XFER_ACK", f"{sender}|{transfer_id}|{state['next']}|{'resume' if index > state['next'] else ''}")
+        return
+    
+    data = decrypt_chunk(cipher_suite, index, token, state.get("codec"), min(state["chunk_size"], CHUNK_SIZE))
+    with open(transfer_state_path("incoming", transfer_id, "part"), 'r+b') as f:
+        f.seek(index * state["chunk_size"])
+        f.write(data)
+    state["next"] = index + 1
+    update_stats("bytes_received", len(data))
+    save_transfer_state("incoming", state)
+    send_packet("XFER_ACK", f"{sender}|{transfer_id}|{state['next']}|")
+    
+    if state["next"] >= state["total_chunks"]:
+        finish_incoming(state)
+
+def finish_incoming(state):
+    """Move a completed transfer into downloads (or voice notes)"""
+    with transfer_lock:
+        incoming_transfers.pop(state["id"], None)
+    
+    if state["kind"] == "voice":
+        os.makedirs(VOICE_DIR, exist_ok=True)
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        save_path = os.path.join(VOICE_DIR, f"{state['sender']}_voice_{timestamp}.wav")
+    else:
+        os.makedirs(DOWNLOADS_DIR, exist_ok=True)
+        save_path = os.path.join(DOWNLOADS_DIR, f"{state['sender']}_{state['filename']}")
+    os.replace(transfer_state_path("incoming", state["id"], "part"), save_path)
+    remove_transfer_state("incoming", state["id"])
+    
+    update_stats("files_received")
+    play_sound()
+    print("\n")
+    if state["kind"] == "voice":
+        print_centered(f"[+] VOICE NOTE SAVED: {save_path} ({state['size']} bytes)", Fore.GREEN)
+        save_message_to_history(state["sender"], "[VOICE NOTE RECEIVED]", "received")
+        if VOICE_AVAILABLE:
+            play_voice_note(save_path)
+    else:
+        print_centered(f"[+] FILE SAVED: {save_path} ({state['size']} bytes)", Fore.GREEN)
+        save_message_to_history(state["sender"], f"[FILE RECEIVED: {os.path.basename(save_path)}]", "received")
+    print("\n")
+
+def handle_transfer_packet(command, content):
+    """Dispatch an XFER_* packet relayed by the server"""
+    try:
+        if command == "XFER_OFFER":
+            sender, transfer_id, kind, filename, size, chunk_size, wrapped_key = content.split("|", 6)
+            if TRANSFER_ID.fullmatch(transfer_id) and not is_blocked(sender):
+                handle_transfer_offer(sender, transfer_id, kind, filename, size, chunk_size, wrapped_key)
+        elif command == "XFER_CHUNK":
+            sender, transfer_id, index, token = content.split("|", 3)
+            if TRANSFER_ID.fullmatch(transfer_id):
+                handle_transfer_chunk(sender, transfer_id, int(index), token)
+        elif command == "XFER_ACK":
+            receiver, transfer_id, next_index, flag = content.split("|", 3)
+            if TRANSFER_ID.fullmatch(transfer_id):
+                handle_transfer_ack(receiver, transfer_id, int(next_index), flag == "resume")
+        elif command == "XFER_RESUME":
+            sender, transfer_id = content.split("|", 1)
+            if not TRANSFER_ID.fullmatch(transfer_id):
+                return
+            with transfer_lock:
+                entry = incoming_transfers.get(transfer_id)
+            if entry is not None and entry[0]["sender"] == sender:
+                send_packet("XFER_ACK", f"{sender}|{transfer_id}|{entry[0]['next']}|resume")
+    except Exception as e:
+        print_centered(f"[!] TRANSFER ERROR: {e}", Fore.RED)
+        logging.error(f"Transfer packet error: {e}")
+
+def resume_transfers():
+    """Reload unfinished transfers after connecting and pick up where they stopped"""
+    for direction in ("outgoing", "incoming"):
+        directory = os.path.join(TRANSFER_DIR, direction)
+        if not os.path.isdir(directory):
+            continue
+        for name in os.listdir(directory):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(directory, name), 'r') as f:
+                    state = json.load(f)
+                
+                if direction == "outgoing":
+                    state["rewind"] = False
+                    with transfer_lock:
+                        outgoing_transfers[state["id"]] = state
+                    # The offer may not have reached the receiver before we dropped
+                    if state["acked"] == 0:
+                        send_offer(state)
+                    send_packet("XFER_RESUME", f"{state['target']}|{state['id']}")
+                    threading.Thread(target=transfer_worker, args=(state,), daemon=True).start()
+                else:
+                    with transfer_lock:
+                        incoming_transfers[state["id"]] = (state, Fernet(unwrap_session_key(state["wrapped_key"])))
+                    send_packet("XFER_ACK", f"{state['sender']}|{state['id']}|{state['next']}|resume")
+                
+                print_centered(f"[*] RESUMING {direction.upper()} TRANSFER {state['id']}", Fore.YELLOW)
+            except Exception as e:
+                logging.error(f"Error resuming transfer {name}: {e}")
+
+def show_transfers():
+    """Display progress of unfinished transfers"""
+    with transfer_lock:
+        outgoing = list(outgoing_transfers.values())
+        incoming = [state for state, _ in incoming_transfers.values()]
+    
+    if not outgoing and not incoming:
+        print_centered("[*] NO ACTIVE TRANSFERS", Fore.YELLOW)
+        return
+    
+    print("\n")
+    print_centered("=== ACTIVE TRANSFERS ===", Fore.CYAN, Style.BRIGHT)
+    for state in outgoing:
+        percent = 100 * state["acked"] // state["total_chunks"]
+        print_centered(f"[OUT] {state['filename']} → {state['target']} {percent}%", Fore.WHITE)
+    for state in incoming:
+        percent = 100 * state["next"] // state["total_chunks"]
+        print_centered(f"[IN] {state['filename']} ← {state['sender']} {percent}%", Fore.WHITE)
+    print("\n")
+
+# ==================== RELIABLE DELIVERY ====================
+
+def load_delivery_state():
+    """Load sequence counters, received watermarks and the unconfirmed outbox"""
+    global delivery_state
+    try:
+        if os.path.exists(DELIVERY_FILE):
+            with open(DELIVERY_FILE, 'r') as f:
+                delivery_state = json.load(f)
+    except Exception as e:
+        logging.error(f"Error loading delivery state: {e}")
+    if "epoch" not in delivery_state:
+        # A new install (or one that lost this file) numbers its messages in a new epoch
+        delivery_state["epoch"] = random.randrange(1, 1 << 31)
+        with outbox_lock:
+            save_delivery_state()
+    if not os.path.isdir(OUTBOX_DIR):
+        return
+    for name in os.listdir(OUTBOX_DIR):
+        try:
+            with open(os.path.join(OUTBOX_DIR, name), 'r') as f:
+                entry = json.load(f)
+            outbox[(entry["target"], entry["seq"])] = entry
+        except Exception as e:
+            logging.error(f"Error loading outbox entry {name}: {e}")
+    # Messages sent after the last write are still in the outbox; never reuse their numbers
+    for target, seq in outbox:
+        delivery_state["next"][target] = max(delivery_state["next"].get(target, 0), seq)
+
+def save_delivery_state():
+    """Write delivery_state; caller holds outbox_lock. Use flush_delivery_state() instead"""
+    try:
+        with open(DELIVERY_FILE + ".tmp", 'w') as f:
+            json.dump(delivery_state, f)
+        os.replace(DELIVERY_FILE + ".tmp", DELIVERY_FILE)
+    except Exception as e:
+        logging.error(f"Error saving delivery state: {e}")
+
+def flush_delivery_state():
+    """Write delivery_state if it changed, then delete the outbox files it no longer needs
+
+    Sending and receiving only mark the state dirty. It is written once per
+    read (before that read is acked), every STATE_FLUSH_INTERVAL and on
+    exit. Confirmed messages keep their outbox file until then, so a crash
+    cannot lose a sequence number that was already used.
+    """
+    global delivery_dirty, retired_outbox
+    with outbox_lock:
+        if delivery_dirty:
+            save_delivery_state()
+            delivery_dirty = False
+        paths, retired_outbox = retired_outbox, []
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def outbox_path(entry):
+    digest = hashlib.sha256(entry["target"].encode('utf-8')).hexdigest()[:16]
+    return os.path.join(OUTBOX_DIR, f"{digest}-{entry['seq']}.json")
+
+def recipients_of(target_code, target_pub_pem):
+    """Agent IDs a payload for target_code is encrypted for"""
+    return list(target_pub_pem) if isinstance(target_pub_pem, dict) else [target_code]
+
+def send_sequenced(command, target_code, blob, recipients):
+    """Number a message within its conversation, keep it until every recipient confirms it, and send it
+
+    Blocks while SEND_WINDOW messages are unconfirmed. Returns the
+    message's sequence number.
+    """
+    global delivery_dirty
+    with outbox_lock:
+        while len(outbox) >= SEND_WINDOW and is_connected:
+            outbox_lock.wait(1)
+        seq = delivery_state["next"].get(target_code, 0) + 1
+        if seq >> EPOCH_SHIFT != delivery_state["epoch"]:
+            seq = (delivery_state["epoch"] << EPOCH_SHIFT) + 1
+        delivery_state["next"][target_code] = seq
+        delivery_dirty = True
+        entry = {"target": target_code, "seq": seq, "command": command, "blob": blob,
+                 "pending": sorted(recipients), "sent": time.time(), "tries": 1}
+        outbox[(target_code, seq)] = entry
+        try:
+            os.makedirs(OUTBOX_DIR, exist_ok=True)
+            with open(outbox_path(entry), 'w') as f:
+                json.dump(entry, f)
+        except Exception as e:
+            logging.error(f"Error saving outbox entry: {e}")
+    send_packet(f"SEQ_{command}", f"{target_code}|{seq}|{blob}")
+    return seq
+
+def confirm_delivery(target, seqs, recipient):
+    """Count a DELIVERED or STORED reply; a message leaves the outbox once all its recipients confirm it
+
+    Partial confirmations are not written to disk: after a restart the
+    message goes to everyone again and the repeat is dropped on arrival.
+    """
+    with outbox_lock:
+        for seq in seqs:
+            entry = outbox.get((target, seq))
+            if entry is None or recipient not in entry["pending"]:
+                continue
+            entry["pending"].remove(recipient)
+            if entry["pending"]:
+                continue
+            del outbox[(target, seq)]
+            retired_outbox.append(outbox_path(entry))
+        outbox_lock.notify_all()
+
+def resend_unconfirmed(timeout):
+    """Send again every message unconfirmed for timeout seconds, giving up after MAX_RETRIES tries"""
+    now = time.time()
+    resend = []
+    with outbox_lock:
+        for key in sorted(outbox):
+            entry = outbox[key]
+            if now - entry["sent"] < timeout:
+                continue
+            if entry["tries"] >= MAX_RETRIES:
+                del outbox[key]
+                retired_outbox.append(outbox_path(entry))
+                print_centered(f"[!] MESSAGE {entry['seq'] % (1 << EPOCH_SHIFT)} TO {entry['target']} NOT CONFIRMED BY {', '.join(entry['pending'])}", Fore.RED)
+                logging.warning(f"Gave up on message {entry['seq']} to {entry['target']}")
+                continue
+            entry["sent"] = now
+            entry["tries"] += 1
+            resend.append(entry)
+        outbox_lock.notify_all()
+    for entry in resend:
+        send_packet(f"SEQ_{entry['command']}", f"{entry['target']}|{entry['seq']}|{entry['blob']}")
+    if resend:
+        logging.info(f"Resent {len(resend)} unconfirmed messages")
+
+def watch_outbox():
+    """Write changed delivery state and resend messages whose acks have not arrived within ACK_TIMEOUT"""
+    last_resend = time.time()
+    while is_connected:
+        time.sleep(STATE_FLUSH_INTERVAL)
+        try:
+            flush_delivery_state()
+            if time.time() - last_resend >= ACK_TIMEOUT / 3:
+                last_resend = time.time()
+                resend_unconfirmed(ACK_TIMEOUT)
+        except Exception as e:
+            logging.error(f"Outbox error: {e}")
+
+def accept_sequenced(sender, seq):
+    """Record seq from sender ("agent" or "#channel:agent"); returns False if it was already received
+
+    A seq from a different epoch means the sender's numbering started
+    over, so the conversation's watermark starts over with it.
+    """
+    global delivery_dirty
+    with outbox_lock:
+        low, above = delivery_state["seen"].get(sender, (0, []))
+        if seq >> EPOCH_SHIFT != low >> EPOCH_SHIFT:
+            low, above = seq >> EPOCH_SHIFT << EPOCH_SHIFT, []
+        if seq <= low or seq in above:
+            return False
+        above = set(above)
+        above.add(seq)
+        if len(above) > MAX_OUT_OF_ORDER:
+            # Stop waiting for the oldest gap
+            low = min(above) - 1
+        while low + 1 in above:
+            low += 1
+            above.remove(low)
+        delivery_state["seen"][sender] = [low, sorted(above)]
+        delivery_dirty = True
+    return True
+
+def split_sequenced(content, sequenced):
+    """(sender, seq, blob) from "sender|seq|blob", or from "sender|blob" with seq None when unsequenced"""
+    sender, blob = content.split("|", 1)
+    if not sequenced:
+        return sender, None, blob
+    seq, _, rest = blob.partition("|")
+    if not seq.isdigit():
+        raise ValueError(f"bad sequence number from {sender}")
+    return sender, int(seq), rest
+
+def accept_incoming(content, sequenced):
+    """Ack a relayed message and drop repeats; returns (sender, seq, blob), or None for a duplicate"""
+    try:
+        sender, seq, blob = split_sequenced(content, sequenced)
+    except ValueError as e:
+        logging.warning(f"Dropped malformed relay: {e}")
+        return None
+    if seq is None:
+        return sender, None, blob
+    pending_acks.setdefault(sender, []).append(str(seq))
+    if not accept_sequenced(sender, seq):
+        logging.info(f"Dropped repeat of message {seq} from {sender}")
+        return None
+    return sender, seq, blob
+
+def flush_acks():
+    """Send the acks collected while handling one read, one packet per sender"""
+    while pending_acks:
+        sender, seqs = pending_acks.popitem()
+        send_packet("ACK", f"{sender}|{','.join(seqs)}")
+
+def mark_read(conversation):
+    """Count a shown message of conversation ("agent" or "#channel:agent") towards its next receipt"""
+    with receipt_lock:
+        unreported_reads[conversation] = unreported_reads.get(conversation, 0) + 1
+        full = unreported_reads[conversation] >= RECEIPT_WINDOW
+    if full:
+        flush_read_receipts()
+
+def flush_read_receipts():
+    """Send one cumulative "read up to N" for every conversation read since the last flush
+
+    Messages are shown as they arrive, so N is the conversation's
+    delivery watermark: everything up to it has been read.
+    """
+    entries = []
+    with receipt_lock:
+        for conversation in unreported_reads:
+            upto = delivery_state["seen"].get(conversation, (0,))[0]
+            if upto != read_reported.get(conversation, 0):
+                read_reported[conversation] = upto
+                entries.append(f"{conversation}|{upto}")
+        unreported_reads.clear()
+    if entries:
+        send_packet("READ_RECEIPT", "||".join(entries))
+
+def watch_read_receipts():
+    """Flush read receipts every RECEIPT_DELAY"""
+    while is_connected:
+        time.sleep(RECEIPT_DELAY)
+        try:
+            flush_read_receipts()
+        except Exception as e:
+            logging.error(f"Read receipt error: {e}")
+
+def record_receipts(content):
+    """Apply a RECEIPT "target|N|reader||..." batch; returns the direct conversations that moved"""
+    moved = []
+    for entry in content.split("||"):
+        parts = entry.split("|")
+        if len(parts) != 3 or not parts[1].isdigit():
+            continue  # Per-message receipt from an older client
+        target, upto, reader = parts[0], int(parts[1]), parts[2]
+        if upto > peer_reads.get((target, reader), 0):
+            peer_reads[(target, reader)] = upto
+            if target == reader:
+                moved.append((reader, upto))
+    return moved
+
+# ==================== MESSAGING ====================
+
+def send_packet(command, payload=""):
+    """Send one framed packet to the server"""
+    frame = encode_frame(command, payload)
+    with send_lock:
+        client.sendall(frame)
+
+def request_keys(agent_ids, max_waits=20, interval=0.1):
+    """Fetch several public keys in one round trip; returns {agent_id: PEM} or None on timeout
+
+    Keys already in known_keys are sent with their fingerprint, so the
+    server only returns PEMs that are new or have changed.
+    """
+    global key_batch_cache
+    key_batch_cache = None
+    wanted = []
+    for agent_id in agent_ids:
+        known = known_keys.get(agent_id)
+        wanted.append(f"{agent_id}:{known['fingerprint']}" if known else agent_id)
+    send_packet("GET_KEYS", ",".join(wanted))
+    
+    wait_timer = 0
+    while key_batch_cache is None and wait_timer < max_waits:
+        time.sleep(interval)
+        wait_timer += 1
+    if key_batch_cache is None:
+        return None
+    return {aid: known_keys[aid]["pem"] for aid in key_batch_cache if aid in known_keys}
+
+def request_channel_members(channel):
+    """Ask the server who is in a channel; returns a list of agent IDs or None"""
+    global channel_members_cache
+    channel_members_cache = None
+    send_packet("CHANNEL_MEMBERS", channel)
+    
+    wait_timer = 0
+    while channel_members_cache is None and wait_timer < 20:
+        time.sleep(0.1)
+        wait_timer += 1
+    if channel_members_cache in (None, "ERROR"):
+        return None
+    return channel_members_cache
+
+def fetch_target_key(target_code):
+    """Return the recipient key(s) for target_code, or None if unavailable
+
+    A #channel yields {agent_id: PEM} for every other member so the
+    payload can be encrypted once for the whole channel.
+    """
+    if not target_code.startswith("#"):
+        keys = request_keys([target_code])
+        return keys.get(target_code) if keys else None
+    
+    members = request_channel_members(target_code)
+    if members is None:
+        return None
+    
+    keys = request_keys([member for member in members if member != my_agent_id])
+    return keys or None
+
+def split_sender(sender):
+    """Split a "#channel:agent_id" sender into (conversation, agent_id, display label)"""
+    if sender.startswith("#") and ":" in sender:
+        channel, agent_id = sender.split(":", 1)
+        return channel, agent_id, f"{agent_id} @ {channel}"
+    return sender, sender, sender
+
+def list_agents(args=()):
+    """Request one page of online agents: /agents [prefix|*] [after]"""
+    prefix = args[0] if len(args) > 0 and args[0] != "*" else ""
+    after = args[1] if len(args) > 1 else ""
+    agent_page_query[0] = prefix
+    send_packet("LIST_PAGE", f"{prefix}|{after}|{AGENT_PAGE_SIZE}")
+
+def show_agent_entries(title, entries):
+    print("\n")
+    print_centered(title, Fore.CYAN, Style.BRIGHT)
+    for agent in entries:
+        parts = agent.split("|")
+        if len(parts) == 3:
+            aid, status, last_seen = parts
+            color = Fore.GREEN if status == "ONLINE" else Fore.YELLOW
+            print_centered(f"{aid} [{status}] - Last seen: {last_seen}", color)
+
+def watch_agents(agent_ids):
+    """Subscribe to presence updates for the given agents"""
+    agent_ids = [aid for aid in agent_ids if aid and not aid.startswith("#")]
+    if agent_ids:
+        send_packet("PRESENCE_SUBSCRIBE", ",".join(agent_ids))
+
+def handle_packet(command, content):
+    """Handle one packet received from the server"""
+    global target_public_key_cache, channel_members_cache, key_batch_cache
+    
+    # Answer server heartbeats so an idle session is not reaped
+    if command == "PING":
+        send_packet("PONG", content)
+        return
+    
+    # Sequenced relays carry "sender|seq|blob" and are otherwise handled like the plain ones
+    sequenced = command in SEQUENCED_INCOMING
+    if sequenced:
+        command = SEQUENCED_INCOMING[command]
+    
+    if command == "THROTTLED":
+        throttled, _, retry_ms = content.partition("|")
+        if throttled == "XFER_CHUNK":
+            pause_transfers(max(int(retry_ms) / 1000 if retry_ms.isdigit() else 0, THROTTLE_PAUSE))
+            logging.info(f"Transfers paused for {retry_ms}ms by the rate limiter")
+            return
+        print_centered(f"[!] SLOW DOWN: {throttled} IS RATE LIMITED, RETRY IN {retry_ms}ms", Fore.YELLOW)
+        return
+    
+    if command == "MAIL_DROPPED":
+        recipient, count, reason = content.split("|", 2)
+        print_centered(f"[!] {count} UNDELIVERED PACKET(S) TO {recipient} DROPPED FROM THE OFFLINE MAILBOX ({reason.upper()})", Fore.YELLOW)
+        return
+    
+    # Handle agent list response
+    if command == "AGENT_LIST":
+        if content:
+            agents = content.split("||")
+            print("\n")
+            print_centered("=== ONLINE AGENTS ===", Fore.CYAN, Style.BRIGHT)
+            for agent in agents:
+                parts = agent.split("|")
+                if len(parts) == 3:
+                    aid, status, last_seen = parts
+                    color = Fore.GREEN if status == "ONLINE" else Fore.YELLOW
+                    print_centered(f"{aid} [{status}] - Last seen: {last_seen}", color)
+            print("\n")
+        else:
+            print_centered("[*] NO AGENTS ONLINE", Fore.YELLOW)
+        return
+    
+    # Handle paged agent list response
+    if command == "AGENT_PAGE":
+        next_cursor, _, entries = content.partition("||")
+        if entries:
+            show_agent_entries("=== ONLINE AGENTS ===", entries.split("||"))
+            if next_cursor:
+                print_centered(f"[*] MORE: /agents {agent_page_query[0] or '*'} {next_cursor}", Fore.CYAN)
+            print("\n")
+        else:
+            print_centered("[*] NO AGENTS ONLINE", Fore.YELLOW)
+        return
+    
+    # Handle presence subscriptions
+    if command == "PRESENCE_SNAPSHOT":
+        if content:
+            show_agent_entries("=== WATCHED AGENTS ===", content.split("||"))
+            print("\n")
+        return
+    
+    if command == "PRESENCE_UPDATE":
+        parts = content.split("|")
+        if len(parts) == 3:
+            aid, status, _ = parts
+            color = Fore.GREEN if status == "ONLINE" else Fore.YELLOW
+            print_centered(f"[*] AGENT {aid} IS NOW {status}", color)
+        return
+    
+    # Handle key lookup responses
+    if command == "KEY_FOUND":
+        target_public_key_cache = content
+        return
+    
+    if command == "KEY_NOT_FOUND":
+        target_public_key_cache = "ERROR"
+        return
+    
+    if command == "KEYS":
+        found = set()
+        for entry in content.split("||") if content else []:
+            parts = entry.split("|", 5)
+            aid, state = parts[0], parts[1]
+            if state == "FOUND":
+                remember_key(aid, *parts[2:6])
+            elif state == "SAME":
+                remember_codecs(aid, parts[4])
+            if state in ("FOUND", "SAME"):
+                found.add(aid)
+            elif state == "NONE":
+                known_keys.pop(aid, None)
+        key_batch_cache = found
+        return
+    
+    # Handle batched read receipts for our messages
+    if command == "RECEIPT":
+        for reader, upto in record_receipts(content):
+            print_centered(f"[READ] {reader} HAS READ YOUR MESSAGES UP TO #{upto % (1 << EPOCH_SHIFT)}", Fore.BLUE)
+        return
+    
+    # Handle delivery confirmations for our sequenced messages
+    if command in ("DELIVERED", "STORED"):
+        target, seqs, recipient = content.split("|", 2)
+        confirm_delivery(target, [int(seq) for seq in seqs.split(",") if seq.isdigit()], recipient)
+        return
+    
+    if command == "KEY_CHANGED":
+        aid, fingerprint, version, codecs, pem = content.split("|", 4)
+        remember_key(aid, fingerprint, version, codecs, pem)
+        return
+    
+    # Handle chunked transfers
+    if command.startswith("XFER_"):
+        handle_transfer_packet(command, content)
+        return
+    
+    # Handle channel responses
+    if command == "CHANNEL_MEMBERS":
+        _, members = content.split("|", 1)
+        channel_members_cache = [m for m in members.split(",") if m]
+        return
+    
+    if command == "CHANNEL_STATUS":
+        channel, status, detail = content.split("|", 2)
+        if status == "OK":
+            print_centered(f"[+] {channel}: {detail.upper()}", Fore.GREEN)
+        else:
+            print_centered(f"[!] {channel}: {detail.upper()}", Fore.RED)
+            channel_members_cache = "ERROR"
+        return
+    
+    # Handle typing indicators: "sender|start" or "sender|stop", shown once per typing spell
+    if command == "TYPING_INDICATOR":
+        sender, _, state = content.partition("|")
+        now = time.time()
+        if state == "stop":
+            typing_agents.pop(sender, None)
+            return
+        if now - typing_agents.get(sender, 0) < TYPING_TTL:
+            return
+        typing_agents[sender] = now
+        print(f"\r{' ' * get_width()}\r", end='')
+        print_centered(f"[TYPING] {split_sender(sender)[2]} is typing...", Fore.CYAN)
+        prompt = "[SECURE INPUT] >> "
+        padding = max(0, (get_width() - len(prompt) - 10) // 2)
+        sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
+        sys.stdout.flush()
+        return
+
+    # Handle incoming messages
+    if command == "INCOMING":
+        received = accept_incoming(content, sequenced)
+        if received is None:
+            return
+        peer, seq, blob = received
+        typing_agents.pop(peer, None)
+        conversation, sender, origin = split_sender(peer)
+        
+        # Check if sender is blocked
+        if is_blocked(sender):
+            logging.info(f"Blocked message from {sender}")
+            return
+        
+        play_sound()
+        msg_text = decrypt_message(blob)
+        
+        # Update statistics
+        update_stats("messages_received")
+        update_stats("bytes_received", len(blob))
+        
+        # Save to history
+        save_message_to_history(conversation, msg_text, "received")
+        
+        print("\n")
+        print_centered(f"[MSG] FROM {origin} (E2EE)", Fore.CYAN)
+        print_centered(f">> {msg_text}", Fore.GREEN, Style.BRIGHT)
+        print_centered(f"[{get_timestamp()}]", Fore.BLUE)
+        print("\n")
+        
+        # Read receipts go out in batches, one per conversation
+        if config["client"]["read_receipts"] and seq is not None:
+            mark_read(peer)
+        
+        prompt = "[SECURE INPUT] >> "
+        padding = max(0, (get_width() - len(prompt) - 10) // 2)
+        sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
+        sys.stdout.flush()
+    
+    # Handle incoming files
+    if command == "FILE_INCOMING":
+        received = accept_incoming(content, sequenced)
+        if received is None:
+            return
+        sender, seq, file_blob = received
+        conversation, sender, origin = split_sender(sender)
+        
+        # Check if sender is blocked
+        if is_blocked(sender):
+            logging.info(f"Blocked file from {sender}")
+            return
+        
+        play_sound()
+        print("\n")
+        print_centered(f"[FILE] RECEIVING FROM {origin}...", Fore.MAGENTA)
+        
+        save_path, file_size = decrypt_file(file_blob, sender)
+        
+        if save_path:
+            # Update statistics
+            update_stats("files_received")
+            update_stats("bytes_received", file_size)
+            
+            print_centered(f"[+] FILE SAVED: {save_path} ({file_size} bytes)", Fore.GREEN)
+            save_message_to_history(conversation, f"[FILE RECEIVED: {os.path.basename(save_path)}]", "received")
+        else:
+            print_centered("[!] FILE RECEIVE FAILED", Fore.RED)
+        
+        print("\n")
+        prompt = "[SECURE INPUT] >> "
+        padding = max(0, (get_width() - len(prompt) - 10) // 2)
+        sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
+        sys.stdout.flush()
+    
+    # Handle incoming voice notes
+    if command == "VOICE_INCOMING":
+        received = accept_incoming(content, sequenced)
+        if received is None:
+            return
+        sender, seq, voice_blob = received
+        conversation, sender, origin = split_sender(sender)
+        
+        # Check if sender is blocked
+        if is_blocked(sender):
+            logging.info(f"Blocked voice note from {sender}")
+            return
+        
+        play_sound()
+        print("\n")
+        print_centered(f"[VOICE] RECEIVING FROM {origin}...", Fore.MAGENTA)
+        
+        save_path, voice_size = decrypt_voice_note(voice_blob, sender)
+        
+        if save_path:
+            # Update statistics
+            update_stats("files_received")
+            update_stats("bytes_received", voice_size)
+            
+            print_centered(f"[+] VOICE NOTE SAVED: {save_path} ({voice_size} bytes)", Fore.GREEN)
+            save_message_to_history(conversation, "[VOICE NOTE RECEIVED]", "received")
+            
+            # Auto-play option
+            if VOICE_AVAILABLE:
+                play_voice_note(save_path)
+        else:
+            print_centered("[!] VOICE NOTE RECEIVE FAILED", Fore.RED)
+        
+        print("\n")
+        prompt = "[SECURE INPUT] >> "
+        padding = max(0, (get_width() - len(prompt) - 10) // 2)
+        sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
+        sys.stdout.flush()
+
+def receive_messages():
+    """Background thread to receive messages and files"""
+    global is_connected
+    decoder = FrameDecoder()
+    
+    while is_connected:
+        try:
+            data = client.recv(65536)
+            if not data: 
+                break
+            
+            for command, payload in decoder.feed(data):
+                handle_packet(command, payload.decode('utf-8', errors='ignore'))
+            # What was received must be on disk before it is acked
+            flush_delivery_state()
+            flush_acks()
+
+        except Exception as e:
+            logging.error(f"Receive error: {e}")
+            if config["client"]["auto_reconnect"]:
+                print_centered("[!] CONNECTION LOST - ATTEMPTING RECONNECT...", Fore.YELLOW)
+                time.sleep(config["client"]["reconnect_delay"])
+            break
+
+def send_typing_indicator(target_code):
+    """Send typing indicator to target"""
+    if not config["client"]["typing_indicators"]:
+        return
+    
+    global last_typing_time
+    current_time = time.time()
+    
+    if current_time - last_typing_time > 3:  # Send every 3 seconds max
+        try:
+            send_packet("TYPING", target_code)
+            last_typing_time = current_time
+        except:
+            pass
+
+def send_messages(target_code):
+    """Main message sending loop with command support"""
+    print_centered("\n[COMMANDS] /agents | /join | /block | /stats | /export | /help\n", Fore.CYAN)
+    
+    while is_connected:
+        prompt = "[SECURE INPUT] >> "
+        padding = max(0, (get_width() - len(prompt) - 10) // 2)
+        sys.stdout.write(" " * padding + Fore.YELLOW + prompt)
+        sys.stdout.flush()
+        
+        msg = input("")
+        
+        # Handle commands
+        if msg.lower() in ['/exit', '/quit']:
+            print_centered("[*] DISCONNECTING...", Fore.YELLOW)
+            break
+        
+        if msg.lower() == '/clear':
+            clear_screen()
+            print_centered(f"[*] SECURE CHANNEL: {my_agent_id} → {target_code}", Fore.GREEN)
+            continue
+        
+        if msg.lower().split(' ')[0] == '/agents':
+            try:
+                list_agents(msg.split()[1:])
+                time.sleep(0.5)
+            except:
+                print_centered("[!] ERROR FETCHING AGENT LIST", Fore.RED)
+            continue
+        
+        if msg.lower().split(' ')[0] in ('/watch', '/unwatch'):
+            parts = msg.split()
+            if len(parts) < 2:
+                print_centered(f"[!] USAGE: {parts[0].lower()} <agent-id> [agent-id ...]", Fore.YELLOW)
+            elif parts[0].lower() == '/watch':
+                watch_agents(parts[1:])
+                time.sleep(0.3)
+            else:
+                send_packet("PRESENCE_UNSUBSCRIBE", ",".join(parts[1:]))
+                print_centered(f"[*] NO LONGER WATCHING: {', '.join(parts[1:])}", Fore.YELLOW)
+            continue
+        
+        if msg.lower() == '/transfers':
+            show_transfers()
+            continue
+        
+        if msg.lower().startswith('/history'):
+            parts = msg.split()
+            agent_id = parts[1] if len(parts) > 1 else target_code
+            history = load_message_history(agent_id)
+            
+            if history:
+                print("\n")
+                print_centered(f"=== CHAT HISTORY WITH {agent_id} ===", Fore.CYAN, Style.BRIGHT)
+                for line in history:
+                    print(line.strip())
+                print("\n")
+            else:
+                print_centered(f"[*] NO HISTORY FOUND FOR {agent_id}", Fore.YELLOW)
+            continue
+        
+        if msg.lower() == '/help':
+            print("\n")
+            print_centered("=== AVAILABLE COMMANDS ===", Fore.CYAN, Style.BRIGHT)
+            print_centered("/agents [prefix|*] [after] - List online agents, one page at a time", Fore.WHITE)
+            print_centered("/watch <agent-id ...> | /unwatch <agent-id ...> - Follow when agents go online or offline", Fore.WHITE)
+            print_centered("/create <#channel> - Create a group channel", Fore.WHITE)
+            print_centered("/join <#channel> | /leave <#channel> - Join or leave a channel", Fore.WHITE)
+            print_centered("/members [#channel] - List channel members", Fore.WHITE)
+            print_centered("/sendfile <filepath> - Send encrypted file", Fore.WHITE)
+            print_centered("/record [duration] - Record voice note (default 10s)", Fore.WHITE)
+            print_centered("/transfers - Show progress of file transfers", Fore.WHITE)
+            print_centered("/history [agent-id] - View chat history", Fore.WHITE)
+            print_centered("/block <agent-id> - Block an agent", Fore.WHITE)
+            print_centered("/unblock <agent-id> - Unblock an agent", Fore.WHITE)
+            print_centered("/blocklist - View blocked agents", Fore.WHITE)
+            print_centered("/stats - View session statistics", Fore.WHITE)
+            print_centered("/export <agent-id> [txt|json] - Export chat", Fore.WHITE)
+            print_centered("/clear - Clear screen", Fore.WHITE)
+            print_centered("/exit or /quit - Disconnect", Fore.WHITE)
+            print_centered("/help - Show this help", Fore.WHITE)
+            print("\n")
+            continue
+        
+        # Channel commands
+        if msg.lower().split(' ')[0] in ('/create', '/join', '/leave'):
+            parts = msg.split()
+            if len(parts) == 2:
+                command = {"/create": "CHANNEL_CREATE", "/join": "CHANNEL_JOIN", "/leave": "CHANNEL_LEAVE"}[parts[0].lower()]
+                send_packet(command, parts[1])
+                time.sleep(0.3)
+            else:
+                print_centered(f"[!] USAGE: {parts[0].lower()} <#channel>", Fore.YELLOW)
+            continue
+        
+        if msg.lower().startswith('/members'):
+            parts = msg.split()
+            channel = parts[1] if len(parts) > 1 else target_code
+            members = request_channel_members(channel)
+            if members is not None:
+                print("\n")
+                print_centered(f"=== MEMBERS OF {channel} ===", Fore.CYAN, Style.BRIGHT)
+                for member in members:
+                    print_centered(member, Fore.GREEN if member != my_agent_id else Fore.WHITE)
+                print("\n")
+            continue
+        
+        # Block system commands
+        if msg.lower().startswith('/block '):
+            agent_id = msg[7:].strip()
+            if agent_id:
+                block_agent(agent_id)
+            else:
+                print_centered("[!] USAGE: /block <agent-id>", Fore.YELLOW)
+            continue
+        
+        if msg.lower().startswith('/unblock '):
+            agent_id = msg[9:].strip()
+            if agent_id:
+                unblock_agent(agent_id)
+            else:
+                print_centered("[!] USAGE: /unblock <agent-id>", Fore.YELLOW)
+            continue
+        
+        if msg.lower() == '/blocklist':
+            if blocked_agents:
+                print("\n")
+                print_centered("=== BLOCKED AGENTS ===", Fore.RED, Style.BRIGHT)
+                for agent in blocked_agents:
+                    print_centered(f"[BLOCKED] {agent}", Fore.RED)
+                print("\n")
+            else:
+                print_centered("[*] NO BLOCKED AGENTS", Fore.YELLOW)
+            continue
+        
+        # Statistics command
+        if msg.lower() == '/stats':
+            show_statistics()
+            continue
+        
+        # Export command
+        if msg.lower().startswith('/export '):
+            parts = msg.split()
+            if len(parts) >= 2:
+                agent_id = parts[1]
+                format_type = parts[2] if len(parts) > 2 else "txt"
+                export_chat(agent_id, format_type)
+            else:
+                print_centered("[!] USAGE: /export <agent-id> [txt|json]", Fore.YELLOW)
+            continue
+        
+        # Voice recording command
+        if msg.lower().startswith('/record'):
+            parts = msg.split()
+            duration = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 10
+            
+            if duration > 60:
+                print_centered("[!] MAXIMUM DURATION IS 60 SECONDS", Fore.RED)
+                continue
+            
+            voice_file = record_voice_note(duration)
+            if voice_file:
+                print_centered(f"[*] ENCRYPTING VOICE NOTE...", Fore.YELLOW)
+                
+                # Get target public key
+                target_key = fetch_target_key(target_code)
+                
+                if target_key and not target_code.startswith("#"):
+                    # Direct voice notes go through the resumable chunked path
+                    start_transfer(voice_file, target_code, target_key, kind="voice", cleanup=True)
+                    print_centered("[*] SENDING VOICE NOTE...", Fore.YELLOW)
+                elif target_key:
+                    voice_blob = encrypt_voice_note(voice_file, target_key, negotiate_codecs(target_code, target_key))
+                    
+                    if voice_blob:
+                        send_sequenced("VOICE", target_code, voice_blob, recipients_of(target_code, target_key))
+                        
+                        # Update stats
+                        update_stats("files_sent")
+                        update_stats("bytes_sent", len(voice_blob))
+                        
+                        print_centered("[+] VOICE NOTE SENT", Fore.GREEN)
+                        save_message_to_history(target_code, "[VOICE NOTE SENT]", "sent")
+                    else:
+                        print_centered("[!] VOICE ENCRYPTION FAILED", Fore.RED)
+                else:
+                    print_centered("[!] TARGET AGENT NOT AVAILABLE", Fore.RED)
+            continue
+        
+        if msg.lower().startswith('/sendfile '):
+            filepath = msg[10:].strip()
+            
+            if not os.path.exists(filepath):
+                print_centered(f"[!] FILE NOT FOUND: {filepath}", Fore.RED)
+                continue
+            
+            print_centered(f"[*] ENCRYPTING FILE: {filepath}...", Fore.YELLOW)
+            
+            target_key = fetch_target_key(target_code)
+            
+            if target_key is None:
+                print_centered("[!] ERROR: TARGET AGENT NOT AVAILABLE", Fore.RED)
+                continue
+            
+            if not target_code.startswith("#"):
+                start_transfer(filepath, target_code, target_key)
+                print_centered(f"[*] SENDING FILE: {os.path.basename(filepath)} (/transfers for progress)", Fore.YELLOW)
+                continue
+            
+            encrypted_file_blob = encrypt_file(filepath, target_key, negotiate_codecs(target_code, target_key))
+            
+            if encrypted_file_blob:
+                send_sequenced("FILE", target_code, encrypted_file_blob, recipients_of(target_code, target_key))
+                print_centered(f"[+] FILE SENT: {os.path.basename(filepath)}", Fore.GREEN)
+                save_message_to_history(target_code, f"[FILE SENT: {os.path.basename(filepath)}]", "sent")
+            else:
+                print_centered("[!] FILE SEND FAILED", Fore.RED)
+            
+            continue
+        
+        # Regular message sending
+        if not msg.strip():
+            continue
+        
+        # Send typing indicator
+        send_typing_indicator(target_code)
+        
+        # Get target's public key (or every channel member's)
+        target_key = fetch_target_key(target_code)
+            
+        if target_key is None:
+            print_centered("[!] ERROR: TARGET AGENT NOT AVAILABLE OR KEY INVALID.", Fore.RED)
+            continue
+
+        try:
+            encrypted_blob = encrypt_message(msg, target_key, negotiate_codecs(target_code, target_key))
+            send_sequenced("MSG", target_code, encrypted_blob, recipients_of(target_code, target_key))
+            
+            # Update statistics
+            update_stats("messages_sent")
+            update_stats("bytes_sent", len(encrypted_blob))
+            
+            # Save to history
+            save_message_to_history(target_code, msg, "sent")
+            
+            print_centered("[SENT] 2048-BIT ENCRYPTED PACKET.", Fore.GREEN)
+        except Exception as e:
+            print_centered(f"[ERROR] SEND FAILED: {e}", Fore.RED)
+            logging.error(f"Send error: {e}")
+
+# ==================== MAIN SYSTEM ====================
+
+def start_system():
+    """Main application entry point"""
+    global client, is_connected
+    
+    clear_screen()
+    print("\n" * 2)
+    
+    # ASCII Banner
+    print_centered("╔═══════════════════════════════════════════════╗", Fore.GREEN, Style.BRIGHT)
+    print_centered("║      G.I.D SECURE TERMINAL v2.0 (E2EE)        ║", Fore.GREEN, Style.BRIGHT)
+    print_centered("╚═══════════════════════════════════════════════╝", Fore.GREEN, Style.BRIGHT)
+    print("\n")
+    
+    print_centered("INITIALIZING RSA-2048 CRYPTO ENGINE...", Fore.CYAN)
+    time.sleep(1)
+    
+    # Initialize session stats and load blocklist
+    session_stats["start_time"] = time.time()
+    load_blocklist()
+    load_known_keys()
+    load_delivery_state()
+    
+    # Setup persistent identity
+    if not setup_identity():
+        print_centered("[!] IDENTITY SETUP FAILED", Fore.RED)
+        return
+    
+    # Security challenge
+    if not binary_matrix_hack():
+        print_centered("ACCESS DENIED.", Fore.RED)
+        return
+
+    # Connect to server
+    try:
+        print_centered(f"\n[*] CONNECTING TO {SERVER_IP}:{SERVER_PORT}...", Fore.CYAN)
+        client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        client.connect((SERVER_IP, SERVER_PORT))
+        send_packet("REGISTER", f"{my_agent_id}|{pem_public}|{','.join(CODECS)}")
+        is_connected = True
+        logging.info(f"Connected to server as {my_agent_id}")
+    except Exception as e:
+        print_centered(f"[!] SERVER UNREACHABLE: {e}", Fore.RED)
+        logging.error(f"Connection error: {e}")
+        return
+
+    clear_screen()
+    print("\n" * 2)
+    print_centered(f"IDENTITY VERIFIED: {my_agent_id}", Fore.GREEN, Style.BRIGHT)
+    print_centered(f"PUBLIC KEY FINGERPRINT: {pem_public[50:80]}...", Fore.BLUE)
+    print_centered("-" * 50)
+    
+    # Start message receiver thread
+    threading.Thread(target=receive_messages, daemon=True).start()
+    resume_transfers()
+    # Anything still unconfirmed from the last session goes out again
+    resend_unconfirmed(0)
+    threading.Thread(target=watch_outbox, daemon=True).start()
+    threading.Thread(target=watch_read_receipts, daemon=True).start()
+
+    # Get target agent
+    while True:
+        target_agent_code = input_centered("\nENTER TARGET AGENT ID OR #CHANNEL (or /agents to list): ", Fore.MAGENTA)
+        
+        if target_agent_code.lower().split(' ')[0] == '/agents':
+            try:
+                list_agents(target_agent_code.split()[1:])
+                time.sleep(1)
+                continue
+            except:
+                print_centered("[!] ERROR FETCHING AGENT LIST", Fore.RED)
+                continue
+        
+        # Group channels are joined, or created if they do not exist yet
+        if target_agent_code.startswith("#"):
+            send_packet("CHANNEL_JOIN", target_agent_code)
+            if request_channel_members(target_agent_code) is None:
+                send_packet("CHANNEL_CREATE", target_agent_code)
+            if request_channel_members(target_agent_code) is not None:
+                print_centered("[+] SECURE GROUP CHANNEL ESTABLISHED.", Fore.GREEN)
+                break
+            continue
+        
+        print_centered(f"[*] FETCHING KEY FOR {target_agent_code}...", Fore.YELLOW)
+        keys = request_keys([target_agent_code], max_waits=15, interval=0.2)
+            
+        if keys is not None and target_agent_code not in keys:
+            print("\n")
+            print_centered(f"[!] AGENT '{target_agent_code}' NOT REGISTERED.", Fore.RED)
+            print_centered("    TARGET MUST LOGIN AT LEAST ONCE TO GENERATE KEYS.", Fore.RED)
+            print_centered("-" * 30, Fore.RED)
+        elif keys:
+            print_centered("[+] SECURE CHANNEL ESTABLISHED.", Fore.GREEN)
+            watch_agents([target_agent_code])
+            break 
+        else:
+            print_centered("[!] SERVER TIMEOUT.", Fore.RED)
+
+    # Start messaging
+    send_messages(target_agent_code)
+    is_connected = False
+
+if __name__ == "__main__":
+    try:
+        start_system()
+    except KeyboardInterrupt:
+        print_centered("\n\n[!] SESSION TERMINATED", Fore.RED)
+        logging.info("Session terminated by user")
+    except Exception as e:
+        print_centered(f"\n\n[!] CRITICAL ERROR: {e}", Fore.RED)
+        logging.error(f"Critical error: {e}")
+    finally:
+        flush_delivery_state()
\ No newline at end of file
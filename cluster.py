@@ -0,0 +1,155 @@
+"""Links between G.I.D server processes
+
+Each process keeps one outbound PeerLink per peer, carrying framed packets
+from its own queue and writer thread, and reads what its peers send on
+one thread per inbound connection. Addresses are either a Unix socket path
+(workers on the same box) or a (host, port) pair.
+"""
+import os
+import hmac
+import socket
+import threading
+import time
+import logging
+from collections import deque
+from protocol import FrameDecoder, ProtocolError, encode_parts, send_buffers, MAX_FRAME_SIZE
+
+PEER_QUEUE_BYTES = 64 * 1024 * 1024
+PEER_BATCH_BYTES = 256 * 1024
+RECONNECT_DELAY = 0.5
+
+def open_connection(address):
+    if isinstance(address, str):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address)
+        return sock
+    sock = socket.create_connection(address, timeout=5)
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+class PeerLink:
+    """Outbound connection to a peer with a bounded queue drained by a writer thread
+
+    Packets queued while the peer is unreachable are kept, up to max_bytes,
+    and flushed after greeting() on every (re)connect.
+    """
+    __slots__ = ("address", "greeting", "max_bytes", "queue", "queued_bytes", "ready")
+
+    def __init__(self, address, greeting, max_bytes=PEER_QUEUE_BYTES):
+        self.address = address
+        self.greeting = greeting
+        self.max_bytes = max_bytes
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.ready = threading.Condition()
+
+    def send(self, command, payload=b""):
+        """Queue a packet for the peer; returns False if the queue is full
+
+        payload may be a tuple of parts, which are written without joining.
+        """
+        data, size = encode_parts(command, payload)
+        with self.ready:
+            if self.queued_bytes + size > self.max_bytes:
+                return False
+            self.queue.append((data, size))
+            self.queued_bytes += size
+            self.ready.notify()
+        return True
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        """Keep a connection to the peer open and flush the queue over it"""
+        while True:
+            try:
+                sock = open_connection(self.address)
+            except OSError:
+                time.sleep(RECONNECT_DELAY)
+                continue
+            try:
+                sock.sendall(b"".join(self.greeting()))
+                self.write_loop(sock)
+            except OSError as e:
+                logging.warning(f"Peer link to {self.address} lost: {e}")
+            finally:
+                sock.close()
+
+    def write_loop(self, sock):
+        while True:
+            with self.ready:
+                while not self.queue:
+                    self.ready.wait()
+                chunks = []
+                size = 0
+                while self.queue and size < PEER_BATCH_BYTES:
+                    chunks.append(self.queue.popleft())
+                    size += chunks[-1][1]
+                self.queued_bytes -= size
+            try:
+                send_buffers(sock, [buffer for data, _ in chunks for buffer in data])
+            except OSError:
+                # Resend the whole batch on the next connection
+                with self.ready:
+                    self.queue.extendleft(reversed(chunks))
+                    self.queued_bytes += size
+                raise
+
+def serve_peers(address, on_packet, on_close, max_frame_size=MAX_FRAME_SIZE, secret=None):
+    """Accept peer connections in the background and feed their packets to on_packet(name, command, payload)
+
+    Every connection must open with PEER_HELLO carrying the peer's name,
+    followed by "|secret" when a secret is set; on_close(name) runs when
+    that connection goes away.
+    """
+    if isinstance(address, str):
+        if os.path.exists(address):
+            os.remove(address)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    else:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(address)
+    listener.listen(64)
+
+    def accept_loop():
+        while True:
+            try:
+                sock, _ = listener.accept()
+            except OSError as e:
+                logging.error(f"Peer listener stopped: {e}")
+                return
+            threading.Thread(target=read_peer, args=(sock, on_packet, on_close, max_frame_size, secret), daemon=True).start()
+
+    threading.Thread(target=accept_loop, daemon=True).start()
+    return listener
+
+def read_peer(sock, on_packet, on_close, max_frame_size, secret=None):
+    """Reader thread for one inbound peer connection"""
+    decoder = FrameDecoder(max_frame_size)
+    name = None
+    try:
+        while True:
+            data = sock.recv(262144)
+            if not data:
+                break
+            for command, payload in decoder.feed(data):
+                if name is None:
+                    if command != "PEER_HELLO":
+                        raise ProtocolError(f"expected PEER_HELLO, got {command}")
+                    hello = payload.decode('utf-8')
+                    if secret is not None:
+                        hello, _, given = hello.partition("|")
+                        if not hmac.compare_digest(given.encode('utf-8'), secret.encode('utf-8')):
+                            raise ProtocolError(f"peer {hello} sent a bad secret")
+                    name = hello
+                    continue
+                on_packet(name, command, payload)
+    except (OSError, ProtocolError) as e:
+        logging.error(f"Peer connection from {name or 'unknown'} failed: {e}")
+    finally:
+        sock.close()
+        if name is not None:
+            on_close(name)
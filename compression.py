@@ -0,0 +1,81 @@
+"""Payload compression for the G.I.D client
+
+Data is compressed before it is encrypted, since ciphertext does not
+compress. Each client lists the codecs it can decode when it registers,
+and the key directory hands that list out with its key. A sender only
+compresses for recipients that understand the result. Small payloads,
+and data that is already compressed, are sent as they are. Data counts
+as already compressed if its magic number says so, or if a trial run on
+a sample barely shrinks it.
+"""
+import lzma
+import zlib
+
+CODECS = ("lzma", "zlib")  # Preference order; also what this client advertises
+MIN_SIZE = 512  # Smaller payloads are not worth a codec header
+LZMA_MAX_SIZE = 4 * 1024 * 1024  # lzma wins on ratio but is slow, so large data uses zlib
+SAMPLE_SIZE = 64 * 1024
+MIN_SAVING = 0.1  # Send data raw unless compression saves at least this fraction
+
+# Formats whose contents are already compressed: (offset, magic)
+COMPRESSED_MAGIC = (
+    (0, b"PK\x03\x04"), (0, b"\x1f\x8b"), (0, b"BZh"), (0, b"\xfd7zXZ\x00"), (0, b"\x28\xb5\x2f\xfd"),
+    (0, b"7z\xbc\xaf\x27\x1c"), (0, b"Rar!"), (0, b"\x89PNG"), (0, b"\xff\xd8\xff"), (0, b"GIF8"),
+    (0, b"OggS"), (0, b"fLaC"), (0, b"ID3"), (0, b"\xff\xfb"), (4, b"ftyp"), (8, b"WEBP"),
+)
+
+COMPRESSORS = {
+    "zlib": lambda data: zlib.compress(data, 6),
+    "lzma": lambda data: lzma.compress(data, preset=6),
+}
+
+def parse_codecs(text):
+    """Codec list from its wire form ("lzma,zlib"; "" or "-" for none)"""
+    return [codec for codec in text.split(",") if codec in COMPRESSORS]
+
+def common_codecs(codec_lists):
+    """Codecs every one of codec_lists accepts, in our preference order"""
+    return [codec for codec in CODECS if all(codec in codecs for codecs in codec_lists)]
+
+def looks_compressed(data):
+    """True if data starts like a compressed format or a sample of it barely shrinks"""
+    head = bytes(data[:16])
+    if any(head[offset:offset + len(magic)] == magic for offset, magic in COMPRESSED_MAGIC):
+        return True
+    sample = bytes(data[:SAMPLE_SIZE])
+    return len(zlib.compress(sample, 1)) > len(sample) * (1 - MIN_SAVING)
+
+def choose_codec(sample, size, codecs):
+    """Codec worth using on size bytes of data that start with sample, or None"""
+    if not codecs or size < MIN_SIZE or looks_compressed(sample):
+        return None
+    if codecs[0] == "lzma" and size > LZMA_MAX_SIZE and "zlib" in codecs:
+        return "zlib"
+    return codecs[0]
+
+def compress_with(data, codec):
+    """Returns (codec, payload), or (None, data) when codec does not shrink data enough"""
+    if codec is None:
+        return None, data
+    body = COMPRESSORS[codec](data)
+    if len(body) > len(data) * (1 - MIN_SAVING):
+        return None, data
+    return codec, body
+
+def compress(data, codecs):
+    """Returns (codec, payload); codec is None when data is better sent as-is"""
+    return compress_with(data, choose_codec(data[:SAMPLE_SIZE], len(data), codecs))
+
+def decompress(data, codec, limit):
+    """Undo compress(); raises ValueError if the result would exceed limit bytes"""
+    if not codec or codec == "none":
+        return data
+    if codec == "zlib":
+        plain = zlib.decompressobj().decompress(data, limit + 1)
+    elif codec == "lzma":
+        plain = lzma.LZMADecompressor().decompress(data, max_length=limit + 1)
+    else:
+        raise ValueError(f"unknown codec {codec}")
+    if len(plain) > limit:
+        raise ValueError("decompressed payload exceeds its limit")
+    return plain
@@ -0,0 +1,137 @@
+"""Registration handshake stage for the threaded G.I.D server
+
+The accept loop only accepts. New sockets go to one thread that watches
+every pending handshake with a selector and reads whatever has arrived,
+so no single client can block it. When a connection's first packets
+decode, the socket is switched back to blocking mode and handed on for
+registration. Connections still silent after the timeout are closed.
+When too many are pending, the oldest is dropped to make room, so a
+trickle of idle connections cannot hold up real clients.
+"""
+import selectors
+import socket
+import threading
+import time
+import logging
+from collections import deque
+from protocol import PacketDecoder, ProtocolError
+
+SELECT_TIMEOUT = 0.25  # Upper bound on how late a timeout is noticed
+
+class HandshakeStage:
+    """Pending connections, read without blocking until they register"""
+
+    def __init__(self, on_ready, timeout, max_pending, max_frame_size, on_drop=None):
+        self.on_ready = on_ready  # on_ready(sock, address, decoder, packets) once packets decode
+        self.on_drop = on_drop  # on_drop(address, reason) for timeouts, evictions and bad data
+        self.timeout = timeout
+        self.max_pending = max_pending
+        self.max_frame_size = max_frame_size
+        self.selector = selectors.DefaultSelector()
+        self.pending = {}  # Socket -> (address, decoder, deadline), oldest first
+        self.incoming = deque()
+        self.waker, self.wakeup = socket.socketpair()
+        self.waker.setblocking(False)
+        self.wakeup.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        self.closed = False
+
+    def __len__(self):
+        return len(self.pending) + len(self.incoming)
+
+    def add(self, sock, address):
+        """Hand over an accepted connection; safe to call from any thread"""
+        self.incoming.append((sock, address))
+        self.wake()
+
+    def wake(self):
+        try:
+            self.waker.send(b"\0")
+        except OSError:
+            pass  # The wakeup buffer is full, so the stage is awake anyway
+
+    def start(self):
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def run(self):
+        while not self.closed:
+            for key, _ in self.selector.select(SELECT_TIMEOUT):
+                if key.fileobj is self.wakeup:
+                    try:
+                        self.wakeup.recv(4096)
+                    except OSError:
+                        pass
+                elif key.fileobj in self.pending:
+                    self.read(key.fileobj)
+            self.admit(time.monotonic())
+            self.expire(time.monotonic())
+        for sock in list(self.pending):
+            self.drop(sock, None)
+        while self.incoming:
+            self.incoming.popleft()[0].close()
+
+    def admit(self, now):
+        while self.incoming:
+            sock, address = self.incoming.popleft()
+            if len(self.pending) >= self.max_pending:
+                self.drop(next(iter(self.pending)), "evicted")
+            try:
+                sock.setblocking(False)
+                self.selector.register(sock, selectors.EVENT_READ)
+            except (OSError, ValueError):
+                sock.close()
+                continue
+            self.pending[sock] = (address, PacketDecoder(self.max_frame_size), now + self.timeout)
+
+    def read(self, sock):
+        address, decoder, _ = self.pending[sock]
+        try:
+            data = sock.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.drop(sock, "error")
+            return
+        if not data:
+            # Closed before registering, e.g. a health check probe
+            self.drop(sock, None)
+            return
+        try:
+            packets = decoder.feed(data)
+        except ProtocolError:
+            self.drop(sock, "invalid")
+            return
+        if not packets:
+            return
+
+        self.release(sock)
+        try:
+            sock.setblocking(True)
+            self.on_ready(sock, address, decoder, packets)
+        except Exception as e:
+            logging.error(f"Error during registration: {e}")
+            sock.close()
+
+    def expire(self, now):
+        """Close handshakes past their deadline; deadlines follow admission order"""
+        while self.pending:
+            sock = next(iter(self.pending))
+            if self.pending[sock][2] > now:
+                break
+            self.drop(sock, "timeout")
+
+    def release(self, sock):
+        self.selector.unregister(sock)
+        del self.pending[sock]
+
+    def drop(self, sock, reason):
+        address = self.pending[sock][0]
+        self.release(sock)
+        sock.close()
+        if reason is not None and self.on_drop is not None:
+            self.on_drop(address, reason)
+
+    def close(self):
+        """Stop the stage; handshakes still pending are closed"""
+        self.closed = True
+        self.wake()
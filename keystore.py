@@ -0,0 +1,89 @@
+"""Persistent public-key directory for the G.I.D server
+
+Keys live in a SQLite database in WAL mode, so the directory survives
+restarts and PEM text is only read from disk when a client actually needs
+it. Each key carries a fingerprint (SHA-256 of the PEM) that clients send
+back to skip keys they already hold, and a version that increases every
+time an agent registers a different key. Alongside the key is the list
+of payload codecs the agent's client can decode, so senders can pick a
+compression both ends understand. In memory only the (fingerprint,
+version) pair per agent is kept.
+"""
+import os
+import sqlite3
+import hashlib
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS keys (
+    agent_id TEXT PRIMARY KEY,
+    pem TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    version INTEGER NOT NULL,
+    codecs TEXT NOT NULL DEFAULT '',
+    updated REAL NOT NULL
+);
+"""
+
+def fingerprint(pem):
+    return hashlib.sha256(pem.encode('utf-8')).hexdigest()
+
+class KeyStore:
+    """Disk-backed map of agent ID -> (PEM, fingerprint, version, codecs)"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(keys)")]
+        if "codecs" not in columns:
+            self.db.execute("ALTER TABLE keys ADD COLUMN codecs TEXT NOT NULL DEFAULT ''")
+        self.index = {}
+        for agent_id, digest, version in self.db.execute("SELECT agent_id, fingerprint, version FROM keys"):
+            self.index[agent_id] = (digest, version)
+
+    def put(self, agent_id, pem, codecs=""):
+        """Store agent_id's key and codec list; returns (fingerprint, version, changed)
+
+        changed is True when this process previously knew a different key
+        for agent_id. The version only moves when the stored key differs,
+        so re-registering the same key, or several workers recording one
+        registration, leaves it alone. A new codec list is stored without
+        bumping the version.
+        """
+        digest = fingerprint(pem)
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO keys (agent_id, pem, fingerprint, version, codecs, updated) VALUES (?, ?, ?, 1, ?, ?) "
+                "ON CONFLICT(agent_id) DO UPDATE SET pem = excluded.pem, fingerprint = excluded.fingerprint, "
+                "version = version + (fingerprint != excluded.fingerprint), codecs = excluded.codecs, "
+                "updated = excluded.updated "
+                "WHERE fingerprint != excluded.fingerprint OR codecs != excluded.codecs",
+                (agent_id, pem, digest, codecs, time.time()))
+            version = self.db.execute("SELECT version FROM keys WHERE agent_id = ?", (agent_id,)).fetchone()[0]
+            known = self.index.get(agent_id)
+            self.index[agent_id] = (digest, version)
+        return digest, version, known is not None and known[0] != digest
+
+    def get(self, agent_id):
+        """(pem, fingerprint, version, codecs) for agent_id, or None"""
+        with self.lock:
+            return self.db.execute(
+                "SELECT pem, fingerprint, version, codecs FROM keys WHERE agent_id = ?", (agent_id,)).fetchone()
+
+    def __contains__(self, agent_id):
+        return agent_id in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
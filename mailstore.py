@@ -0,0 +1,203 @@
+"""Durable offline mailbox for the G.I.D server
+
+Undelivered packets are appended to a SQLite database in WAL mode instead
+of being held on the heap, so they survive restarts and server memory does
+not grow with the amount of queued mail. Only a per-recipient
+(count, bytes) index is kept in memory. Retention (TTL, quotas, a global
+cap) is enforced by the server's sweeper through expire(), trim() and
+shrink(), which each delete a bounded batch per call.
+"""
+import os
+import sqlite3
+import threading
+import time
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS mailbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    command TEXT NOT NULL,
+    payload BLOB NOT NULL,
+    size INTEGER NOT NULL,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS mailbox_recipient ON mailbox (recipient, id);
+CREATE INDEX IF NOT EXISTS mailbox_created ON mailbox (created);
+CREATE INDEX IF NOT EXISTS mailbox_size ON mailbox (size);
+"""
+
+HEAD_BYTES = 160  # Leading payload bytes returned for evicted packets, enough to name the sender
+EVICTION_ORDER = {"oldest": "id", "largest": "size DESC, id"}
+
+class MailboxStore:
+    """Append-only, disk-backed store of (command, payload) packets per recipient"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        self.index = {}
+        for recipient, count, size in self.db.execute(
+                "SELECT recipient, COUNT(*), SUM(size) FROM mailbox GROUP BY recipient"):
+            self.index[recipient] = [count, size]
+
+    def enqueue(self, recipient, command, payload):
+        """Append one packet for recipient"""
+        if isinstance(payload, str):
+            payload = payload.encode('utf-8')
+        size = len(payload)
+        with self.lock:
+            self.db.execute(
+                "INSERT INTO mailbox (recipient, command, payload, size, created) VALUES (?, ?, ?, ?, ?)",
+                (recipient, command, payload, size, time.time()))
+            entry = self.index.setdefault(recipient, [0, 0])
+            entry[0] += 1
+            entry[1] += size
+
+    def count(self, recipient):
+        entry = self.index.get(recipient)
+        return entry[0] if entry else 0
+
+    def size(self, recipient):
+        entry = self.index.get(recipient)
+        return entry[1] if entry else 0
+
+    def __contains__(self, recipient):
+        return recipient in self.index
+
+    def recipients(self):
+        return list(self.index)
+
+    def refresh(self, recipient):
+        """Reload recipient's index entry from disk and return its count
+
+        Needed when several processes share the database, since each one
+        only sees its own enqueues in memory.
+        """
+        with self.lock:
+            count, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM mailbox WHERE recipient = ?", (recipient,)).fetchone()
+            if count:
+                self.index[recipient] = [count, size]
+            else:
+                self.index.pop(recipient, None)
+        return count
+
+    def last_id(self, recipient):
+        """Highest packet id currently queued for recipient (0 if none)"""
+        with self.lock:
+            row = self.db.execute("SELECT MAX(id) FROM mailbox WHERE recipient = ?", (recipient,)).fetchone()
+        return row[0] or 0
+
+    def fetch(self, recipient, after_id=0, limit=100, upto_id=None):
+        """Return up to limit (id, command, payload) rows queued after after_id"""
+        query = "SELECT id, command, payload FROM mailbox WHERE recipient = ? AND id > ?"
+        params = [recipient, after_id]
+        if upto_id is not None:
+            query += " AND id <= ?"
+            params.append(upto_id)
+        query += " ORDER BY id LIMIT ?"
+        params.append(limit)
+        with self.lock:
+            return self.db.execute(query, params).fetchall()
+
+    def ack(self, recipient, upto_id):
+        """Delete every packet for recipient with id <= upto_id"""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM mailbox WHERE recipient = ? AND id <= ?",
+                (recipient, upto_id)).fetchone()
+            self.db.execute("DELETE FROM mailbox WHERE recipient = ? AND id <= ?", (recipient, upto_id))
+            entry = self.index.get(recipient)
+            if entry:
+                entry[0] -= row[0]
+                entry[1] -= row[1]
+                if entry[0] <= 0:
+                    del self.index[recipient]
+
+    def pages(self, recipient, page_size=100, upto_id=None):
+        """Stream queued packets one page at a time, deleting each page once consumed
+
+        Only the packets present when iteration starts are returned, so mail
+        that arrives meanwhile is left for the next drain.
+        """
+        if upto_id is None:
+            upto_id = self.last_id(recipient)
+        after_id = 0
+        while True:
+            rows = self.fetch(recipient, after_id, page_size, upto_id)
+            if not rows:
+                return
+            yield rows
+            after_id = rows[-1][0]
+            self.ack(recipient, after_id)
+
+    def total_size(self, exact=False):
+        """Bytes queued for every recipient; exact re-reads the database (other processes' mail)"""
+        if not exact:
+            return sum(entry[1] for entry in list(self.index.values()))
+        with self.lock:
+            return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM mailbox").fetchone()[0]
+
+    def remove(self, rows):
+        """Delete (id, recipient, size, command, head) rows and return [(recipient, command, head)]; caller holds self.lock"""
+        self.db.executemany("DELETE FROM mailbox WHERE id = ?", [(row[0],) for row in rows])
+        for _, recipient, size, _, _ in rows:
+            entry = self.index.get(recipient)
+            if entry:
+                entry[0] -= 1
+                entry[1] -= size
+                if entry[0] <= 0:
+                    del self.index[recipient]
+        return [(recipient, command, head) for _, recipient, _, command, head in rows]
+
+    def expire(self, before, limit=200):
+        """Delete up to limit packets queued before the time.time() value before"""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT id, recipient, size, command, substr(payload, 1, ?) FROM mailbox "
+                "WHERE created < ? ORDER BY created LIMIT ?", (HEAD_BYTES, before, limit)).fetchall()
+            return self.remove(rows)
+
+    def trim(self, recipient, max_count, max_bytes, policy="oldest", limit=200):
+        """Evict up to limit of recipient's packets, in policy order, until it is within both quotas"""
+        with self.lock:
+            count, size = self.db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM mailbox WHERE recipient = ?", (recipient,)).fetchone()
+            excess_count = count - max_count
+            excess_bytes = size - max_bytes
+            if excess_count <= 0 and excess_bytes <= 0:
+                return []
+            rows = []
+            for row in self.db.execute(
+                    "SELECT id, recipient, size, command, substr(payload, 1, ?) FROM mailbox "
+                    f"WHERE recipient = ? ORDER BY {EVICTION_ORDER[policy]} LIMIT ?", (HEAD_BYTES, recipient, limit)):
+                if excess_count <= 0 and excess_bytes <= 0:
+                    break
+                rows.append(row)
+                excess_count -= 1
+                excess_bytes -= row[2]
+            return self.remove(rows)
+
+    def shrink(self, excess_bytes, policy="oldest", limit=200):
+        """Evict up to limit packets across all recipients, in policy order, to free excess_bytes"""
+        with self.lock:
+            rows = []
+            for row in self.db.execute(
+                    "SELECT id, recipient, size, command, substr(payload, 1, ?) FROM mailbox "
+                    f"ORDER BY {EVICTION_ORDER[policy]} LIMIT ?", (HEAD_BYTES, limit)):
+                if excess_bytes <= 0:
+                    break
+                rows.append(row)
+                excess_bytes -= row[2]
+            return self.remove(rows)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
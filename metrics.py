@@ -0,0 +1,143 @@
+"""Lightweight metrics for the G.I.D server, exported in Prometheus text format
+
+Recording a sample is a dict lookup and a couple of integer updates with
+no locks, so metrics stay on in production. Under the threaded server two
+threads can occasionally race on the same counter and lose an increment,
+which is an acceptable trade for monitoring data. Gauges are sampled by
+collectors only when /metrics is scraped.
+"""
+import bisect
+import threading
+import logging
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+EVENTS = {
+    "registrations": "Agents registered",
+    "handshakes_dropped": "Connections closed before registering: timed out, evicted by the handshake limit or invalid",
+    "disconnects": "Agent connections closed",
+    "mailbox_spills": "Packets written to the offline mailbox",
+    "mailbox_evictions": "Offline packets expired, evicted or refused by retention limits",
+    "queue_overflows": "Packets refused by a full outbound queue",
+    "sessions_reaped": "Sessions closed after missing heartbeats",
+    "typing_dropped": "Typing changes skipped because the recipient's outbound queue was busy",
+}
+
+class Histogram:
+    """Fixed-bucket histogram; observe() is one bisect and two additions"""
+    __slots__ = ("bounds", "counts", "total")
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{format_labels({**labels, "le": bound})} {cumulative}')
+        cumulative += self.counts[-1]
+        lines.append(f'{name}_bucket{format_labels({**labels, "le": "+Inf"})} {cumulative}')
+        lines.append(f"{name}_sum{format_labels(labels)} {self.total}")
+        lines.append(f"{name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+packets = {}  # (direction, command) -> [packets, bytes]
+throttled = {}  # Command -> packets dropped by rate limiting
+events = dict.fromkeys(EVENTS, 0)
+latency = {"route": Histogram(), "flush": Histogram()}
+collectors = []
+
+def count_packet(direction, command, size):
+    """Record one packet of size bytes moving in direction ("in" or "out")"""
+    entry = packets.get((direction, command))
+    if entry is None:
+        entry = packets.setdefault((direction, command), [0, 0])
+    entry[0] += 1
+    entry[1] += size
+
+def count_throttled(command):
+    throttled[command] = throttled.get(command, 0) + 1
+
+def increment(event, value=1):
+    events[event] += value
+
+def observe(stage, seconds):
+    latency[stage].observe(seconds)
+
+def add_collector(collector):
+    """Register a callable returning [(name, type, help, [(labels, value), ...]), ...] at scrape time"""
+    collectors.append(collector)
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    pairs = []
+    for key, value in labels.items():
+        value = str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        pairs.append(f'{key}="{value}"')
+    return "{" + ",".join(pairs) + "}"
+
+def render_family(lines, name, kind, help_text, samples):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} {kind}")
+    for labels, value in samples:
+        lines.append(f"{name}{format_labels(labels)} {value}")
+
+def render():
+    """Every metric in Prometheus text exposition format"""
+    lines = []
+    snapshot = list(packets.items())
+    render_family(lines, "gid_packets_total", "counter", "Packets by direction and command",
+                  [({"direction": d, "command": c}, entry[0]) for (d, c), entry in snapshot])
+    render_family(lines, "gid_packet_bytes_total", "counter", "Bytes by direction and command (payload in, encoded packet out)",
+                  [({"direction": d, "command": c}, entry[1]) for (d, c), entry in snapshot])
+    render_family(lines, "gid_throttled_total", "counter", "Packets dropped by per-agent rate limits, by command",
+                  [({"command": c}, count) for c, count in list(throttled.items())])
+    for event, help_text in EVENTS.items():
+        render_family(lines, f"gid_{event}_total", "counter", help_text, [({}, events[event])])
+
+    lines.append("# HELP gid_relay_latency_seconds Time from receiving a packet to queueing it (route) and from queueing to writing it (flush)")
+    lines.append("# TYPE gid_relay_latency_seconds histogram")
+    for stage, histogram in latency.items():
+        lines.extend(histogram.render("gid_relay_latency_seconds", {"stage": stage}))
+
+    for collector in collectors:
+        try:
+            for name, kind, help_text, samples in collector():
+                render_family(lines, name, kind, help_text, samples)
+        except Exception as e:
+            logging.error(f"Metrics collector failed: {e}")
+    return "\n".join(lines) + "\n"
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """Serves GET /metrics"""
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = render().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def serve(host, port):
+    """Serve /metrics on its own port from a background thread"""
+    httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+    httpd.daemon_threads = True
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    return httpd
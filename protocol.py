@@ -0,0 +1,239 @@
+"""G.I.D wire protocol shared by the server and the client
+
+Every packet is a fixed 8-byte header followed by the payload:
+
+    magic (2 bytes) | opcode (1 byte) | flags (1 byte) | payload length (4 bytes, big-endian)
+
+The payload is the same text that follows the "[COMMAND]" prefix in the
+legacy protocol, so routing code only ever deals with (command, payload).
+Legacy clients that send bare "[COMMAND]payload" strings are detected from
+the first bytes of the connection and keep working unchanged.
+"""
+import struct
+
+MAGIC = b"\x00G"
+HEADER = struct.Struct("!2sBBI")
+HEADER_SIZE = HEADER.size
+MAX_FRAME_SIZE = 64 * 1024 * 1024
+
+COMMANDS = {
+    "REGISTER": 1,
+    "LIST_AGENTS": 2,
+    "AGENT_LIST": 3,
+    "GET_KEY": 4,
+    "KEY_FOUND": 5,
+    "KEY_NOT_FOUND": 6,
+    "TYPING": 7,
+    "TYPING_INDICATOR": 8,
+    "READ_RECEIPT": 9,
+    "RECEIPT": 10,
+    "MSG": 11,
+    "INCOMING": 12,
+    "FILE": 13,
+    "FILE_INCOMING": 14,
+    "VOICE": 15,
+    "VOICE_INCOMING": 16,
+    "CHANNEL_CREATE": 17,
+    "CHANNEL_JOIN": 18,
+    "CHANNEL_LEAVE": 19,
+    "CHANNEL_MEMBERS": 20,
+    "CHANNEL_STATUS": 21,
+    "XFER_OFFER": 22,
+    "XFER_CHUNK": 23,
+    "XFER_ACK": 24,
+    "XFER_RESUME": 25,
+    "PRESENCE_SUBSCRIBE": 32,
+    "PRESENCE_UNSUBSCRIBE": 33,
+    "PRESENCE_SNAPSHOT": 34,
+    "PRESENCE_UPDATE": 35,
+    "LIST_PAGE": 36,
+    "AGENT_PAGE": 37,
+    "GET_KEYS": 38,
+    "KEYS": 39,
+    "KEY_CHANGED": 40,
+    "PING": 41,
+    "PONG": 42,
+    "THROTTLED": 43,
+    "MAIL_DROPPED": 44,
+    "ACK": 45,
+    "DELIVERED": 46,
+    "STORED": 47,
+    # Sequenced forms of MSG/FILE/VOICE and their relays: "target|seq|blob" -> "sender|seq|blob"
+    "SEQ_MSG": 48,
+    "SEQ_FILE": 49,
+    "SEQ_VOICE": 50,
+    "SEQ_INCOMING": 51,
+    "SEQ_FILE_INCOMING": 52,
+    "SEQ_VOICE_INCOMING": 53,
+    # Server-to-server packets, see cluster.py
+    "PEER_HELLO": 26,
+    "PEER_REGISTER": 27,
+    "PEER_UNREGISTER": 28,
+    "PEER_ROUTE": 29,
+    "PEER_CHANNEL": 30,
+    "PEER_NUDGE": 31,
+}
+OPCODES = {opcode: command for command, opcode in COMMANDS.items()}
+
+GATHER_MIN = 16 * 1024  # Smaller payloads are copied behind their header; larger ones are sent as-is
+IOV_MAX = 512  # Buffers handed to one sendmsg() call
+
+class ProtocolError(Exception):
+    """Raised when a peer sends data that cannot be decoded"""
+
+def to_bytes(payload):
+    """Payload as one bytes object; a tuple of parts is joined"""
+    if isinstance(payload, str):
+        return payload.encode('utf-8')
+    if isinstance(payload, tuple):
+        return b"".join(payload)
+    return bytes(payload)
+
+def payload_size(payload):
+    """Length of a payload, which may be a tuple of byte-like parts"""
+    if isinstance(payload, tuple):
+        return sum(len(part) for part in payload)
+    return len(payload)
+
+def encode_parts(command, payload=b"", framed=True):
+    """Encode a packet as (buffers, size) without copying a large payload
+
+    payload may be text, any bytes-like object, or a tuple of parts such
+    as a short sender prefix plus a memoryview of a received frame. Large
+    payloads come back as separate buffers for a vectored write; small
+    ones are joined to their header so they go out as one buffer.
+    """
+    if isinstance(payload, tuple):
+        parts = payload
+    elif isinstance(payload, str):
+        parts = (payload.encode('utf-8'),)
+    else:
+        parts = (payload,)
+    length = sum(len(part) for part in parts)
+    if framed:
+        head = HEADER.pack(MAGIC, COMMANDS[command], 0, length)
+    else:
+        head = f"[{command}]".encode('utf-8')
+    if length < GATHER_MIN:
+        return [head + b"".join(parts)], len(head) + length
+    return [head, *parts], len(head) + length
+
+def send_buffers(sock, buffers):
+    """sendall() for a list of buffers, using vectored sendmsg() where the platform has it"""
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))
+        return
+    views = [memoryview(buffer) for buffer in buffers if len(buffer)]
+    index = 0
+    while index < len(views):
+        sent = sock.sendmsg(views[index:index + IOV_MAX])
+        # Skip what was written and resume inside a partially written buffer
+        while sent:
+            size = views[index].nbytes
+            if sent < size:
+                views[index] = views[index][sent:]
+                break
+            sent -= size
+            index += 1
+
+def encode_frame(command, payload=b"", flags=0):
+    """Build a framed packet for command"""
+    body = to_bytes(payload)
+    return HEADER.pack(MAGIC, COMMANDS[command], flags, len(body)) + body
+
+def parse_legacy(data):
+    """Split a legacy "[COMMAND]payload" packet into (command, payload)"""
+    end = data.find(b"]")
+    if not data.startswith(b"[") or end < 0:
+        raise ProtocolError("not a legacy packet")
+    return data[1:end].decode('utf-8', errors='ignore'), data[end + 1:]
+
+class FrameDecoder:
+    """Incremental decoder that turns a byte stream into (command, payload) frames
+
+    Bytes are appended to one buffer and consumed from a moving offset, so
+    each byte is looked at once no matter how the stream is split. Reads
+    that arrive with nothing pending are decoded in place, and only a
+    trailing partial frame is buffered.
+    """
+    __slots__ = ("buffer", "offset", "max_frame_size")
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.buffer = bytearray()
+        self.offset = 0
+        self.max_frame_size = max_frame_size
+
+    def feed(self, data):
+        """Consume data and return every frame it completes"""
+        if self.buffer:
+            self.buffer += data
+            buffer = self.buffer
+        else:
+            # Nothing pending: decode straight from data and buffer only its tail
+            buffer = data
+        frames = []
+        offset = self.offset
+        end = len(buffer)
+
+        with memoryview(buffer) as view:
+            while end - offset >= HEADER_SIZE:
+                magic, opcode, flags, length = HEADER.unpack_from(buffer, offset)
+                if magic != MAGIC:
+                    raise ProtocolError("bad frame magic")
+                if length > self.max_frame_size:
+                    raise ProtocolError(f"frame of {length} bytes exceeds limit")
+                if end - offset - HEADER_SIZE < length:
+                    break
+
+                start = offset + HEADER_SIZE
+                command = OPCODES.get(opcode)
+                if command is None:
+                    raise ProtocolError(f"unknown opcode {opcode}")
+                # Exactly one copy per payload, whichever buffer it sits in
+                frames.append((command, bytes(view[start:start + length])))
+                offset = start + length
+
+            if buffer is not self.buffer:
+                self.buffer += view[offset:]
+                offset = 0
+
+        # Drop consumed bytes once they dominate the buffer
+        buffer = self.buffer
+        end = len(buffer)
+        if offset == end:
+            buffer.clear()
+            offset = 0
+        elif offset > 65536 and offset > end // 2:
+            del buffer[:offset]
+            offset = 0
+        self.offset = offset
+        return frames
+
+class PacketDecoder:
+    """Detects framed vs legacy peers from the first bytes and decodes packets"""
+    __slots__ = ("framed", "frames")
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.framed = None
+        self.frames = FrameDecoder(max_frame_size)
+
+    def feed(self, data):
+        """Return the list of (command, payload) packets completed by data"""
+        if self.framed is None:
+            if len(data) < len(MAGIC) and MAGIC.startswith(bytes(data)):
+                # Too short to tell yet; keep it for the framed decoder
+                self.frames.buffer += data
+                return []
+            pending = bytes(self.frames.buffer) + bytes(data)
+            self.frames.buffer.clear()
+            self.framed = pending.startswith(MAGIC)
+            data = pending
+
+        if self.framed:
+            return self.frames.feed(data)
+
+        # Legacy peers have no framing, so each read is treated as one packet
+        try:
+            return [parse_legacy(bytes(data))]
+        except ProtocolError:
+            return []
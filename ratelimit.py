@@ -0,0 +1,93 @@
+"""Per-agent token-bucket rate limiting for the G.I.D server
+
+Every connection gets one bucket pair (packets/s, bytes/s) for the agent
+as a whole plus one per command that has its own limit in config.json.
+Buckets are created at registration; checking a packet refills and
+debits a handful of floats in place, so the hot path allocates nothing.
+A bucket holds burst_seconds worth of tokens. A single packet larger than
+the whole bucket is let through when the bucket is full and leaves it in
+debt, so big files are slowed down rather than refused outright.
+"""
+
+class TokenBucket:
+    """rate tokens per second, up to capacity, refilled lazily on each check"""
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate, burst_seconds, now):
+        self.rate = float(rate)
+        self.capacity = self.rate * burst_seconds
+        self.tokens = self.capacity
+        self.stamp = now
+
+    def refill(self, now):
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        self.tokens = tokens if tokens < self.capacity else self.capacity
+        self.stamp = now
+
+    def wait(self, cost):
+        """Seconds until cost can be taken (0.0 if it can be taken now); call after refill"""
+        needed = cost if cost < self.capacity else self.capacity
+        if self.tokens >= needed:
+            return 0.0
+        return (needed - self.tokens) / self.rate
+
+def parse_limits(settings):
+    """Turn the "rate_limits" config section into (agent_limit, {command: limit})
+
+    A limit is a (packets_per_second, bytes_per_second) pair where 0 means
+    unlimited; commands without an entry only count against the agent limit.
+    """
+    def limit(spec):
+        return (float(spec.get("packets", 0) or 0), float(spec.get("bytes", 0) or 0))
+    commands = {command: limit(spec) for command, spec in settings.get("commands", {}).items()}
+    return limit(settings.get("agent", {})), commands
+
+class RateLimiter:
+    """The buckets of one connection"""
+    __slots__ = ("agent", "commands")
+
+    def __init__(self, agent_limit, command_limits, burst_seconds, now):
+        self.agent = self.make_pair(agent_limit, burst_seconds, now)
+        self.commands = {command: self.make_pair(limit, burst_seconds, now)
+                         for command, limit in command_limits.items()}
+
+    @staticmethod
+    def make_pair(limit, burst_seconds, now):
+        packets, size = limit
+        return (TokenBucket(packets, burst_seconds, now) if packets else None,
+                TokenBucket(size, burst_seconds, now) if size else None)
+
+    def check(self, command, size, now):
+        """Debit one packet of size bytes; returns 0.0 if allowed, else seconds to wait
+
+        Nothing is debited from any bucket unless every bucket can pay.
+        """
+        packets, sizes = self.agent
+        pair = self.commands.get(command)
+        wait = 0.0
+        if packets is not None:
+            packets.refill(now)
+            wait = packets.wait(1)
+        if sizes is not None:
+            sizes.refill(now)
+            wait = max(wait, sizes.wait(size))
+        if pair is not None:
+            if pair[0] is not None:
+                pair[0].refill(now)
+                wait = max(wait, pair[0].wait(1))
+            if pair[1] is not None:
+                pair[1].refill(now)
+                wait = max(wait, pair[1].wait(size))
+        if wait:
+            return wait
+
+        if packets is not None:
+            packets.tokens -= 1
+        if sizes is not None:
+            sizes.tokens -= size
+        if pair is not None:
+            if pair[0] is not None:
+                pair[0].tokens -= 1
+            if pair[1] is not None:
+                pair[1].tokens -= size
+        return 0.0
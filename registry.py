@@ -0,0 +1,188 @@
+"""Agent session registry for the G.I.D server
+
+One compact record per known agent replaces the separate per-agent dicts
+the server used to keep (connection, remote holder, home node, status,
+last seen). Every change goes through the registry lock, so a listing
+never races a connect or disconnect. Lookups on the relay path are a
+single dict get with no lock. A sorted index of online agent IDs serves
+paged and prefix listings. IDs whose records changed are collected for
+the next state snapshot.
+"""
+import bisect
+import threading
+import time
+
+class AgentRecord:
+    """Everything the server tracks about one agent"""
+    __slots__ = ("agent_id", "connection", "holder", "node", "last_seen")
+
+    def __init__(self, agent_id):
+        self.agent_id = agent_id
+        self.connection = None  # Local AgentConnection while connected to this process
+        self.holder = None  # Worker or node link its connection is reached through
+        self.node = None  # Node it last registered on, kept while it is offline
+        self.last_seen = 0.0  # time.monotonic() of the last status change
+
+    @property
+    def online(self):
+        return self.connection is not None or self.holder is not None
+
+    def seen(self):
+        """Last activity: live connections report their latest read"""
+        connection = self.connection
+        return connection.last_active if connection is not None else self.last_seen or None
+
+class Registry:
+    """All agent records plus the sorted online index, guarded by one lock"""
+
+    def __init__(self):
+        self.records = {}
+        self.online = []
+        self.local = 0
+        self.remote = 0
+        self.dirty = set()  # Agent IDs changed since the last take_dirty()
+        self.lock = threading.Lock()
+
+    def get(self, agent_id):
+        return self.records.get(agent_id)
+
+    def connection(self, agent_id):
+        record = self.records.get(agent_id)
+        return record.connection if record is not None else None
+
+    def holder(self, agent_id):
+        record = self.records.get(agent_id)
+        return record.holder if record is not None else None
+
+    def record(self, agent_id):
+        """Existing or new record for agent_id; caller holds self.lock"""
+        record = self.records.get(agent_id)
+        if record is None:
+            record = self.records[agent_id] = AgentRecord(agent_id)
+        return record
+
+    def set_online(self, record):
+        """Keep the online index in step with record; caller holds self.lock"""
+        index = bisect.bisect_left(self.online, record.agent_id)
+        listed = index < len(self.online) and self.online[index] == record.agent_id
+        if record.online and not listed:
+            self.online.insert(index, record.agent_id)
+        elif not record.online and listed:
+            del self.online[index]
+        record.last_seen = time.monotonic()
+        self.dirty.add(record.agent_id)
+
+    def attach_local(self, agent_id, connection, node):
+        """Record a connection to this process; returns the connection it replaced, if any"""
+        with self.lock:
+            record = self.record(agent_id)
+            previous = record.connection
+            if previous is None:
+                self.local += 1
+            if record.holder is not None:
+                record.holder = None
+                self.remote -= 1
+            record.connection = connection
+            record.node = node
+            self.set_online(record)
+        return previous
+
+    def detach_local(self, agent_id, connection):
+        """Forget connection if it is still agent_id's active one; returns True if it was"""
+        with self.lock:
+            record = self.records.get(agent_id)
+            if record is None or record.connection is not connection:
+                return False
+            record.connection = None
+            self.local -= 1
+            self.set_online(record)
+        return True
+
+    def attach_remote(self, agent_id, holder, node):
+        """Record that agent_id is reached through the link to holder"""
+        with self.lock:
+            record = self.record(agent_id)
+            if record.holder is None:
+                self.remote += 1
+            record.holder = holder
+            record.node = node
+            self.set_online(record)
+
+    def detach_remote(self, agent_id, holder):
+        """Forget agent_id's remote holder if it is still holder; returns True if it was"""
+        with self.lock:
+            record = self.records.get(agent_id)
+            if record is None or record.holder != holder:
+                return False
+            record.holder = None
+            self.remote -= 1
+            self.set_online(record)
+        return True
+
+    def detach_holder(self, holder):
+        """Forget every agent reached through holder; returns their IDs"""
+        with self.lock:
+            dropped = [record for record in self.records.values() if record.holder == holder]
+            for record in dropped:
+                record.holder = None
+                self.remote -= 1
+                self.set_online(record)
+        return [record.agent_id for record in dropped]
+
+    def restore(self, rows):
+        """Recreate offline records from a snapshot: rows of (agent_id, node, last_seen)"""
+        records = self.records
+        with self.lock:
+            for agent_id, node, last_seen in rows:
+                record = records.get(agent_id)
+                if record is None:
+                    record = records[agent_id] = AgentRecord(agent_id)
+                elif record.online:
+                    continue
+                record.node = node
+                record.last_seen = last_seen
+
+    def take_dirty(self):
+        """[(agent_id, node, seen)] for every record changed since the last call"""
+        with self.lock:
+            changed = [self.records[agent_id] for agent_id in self.dirty]
+            self.dirty = set()
+            return [(r.agent_id, r.node, r.seen()) for r in changed]
+
+    def local_agents(self):
+        """[(agent_id, connection)] for every agent connected to this process"""
+        with self.lock:
+            return [(r.agent_id, r.connection) for r in self.records.values() if r.connection is not None]
+
+    def remote_agents(self):
+        """[(agent_id, holder, node)] for every agent reached through a peer link"""
+        with self.lock:
+            return [(r.agent_id, r.holder, r.node) for r in self.records.values() if r.holder is not None]
+
+    def entries(self, agent_ids=None):
+        """[(agent_id, online, seen)] for agent_ids, or for every online agent"""
+        with self.lock:
+            if agent_ids is None:
+                agent_ids = list(self.online)
+            entries = []
+            for agent_id in agent_ids:
+                record = self.records.get(agent_id)
+                if record is None:
+                    entries.append((agent_id, False, None))
+                else:
+                    entries.append((agent_id, record.online, record.seen()))
+            return entries
+
+    def page(self, prefix, after, limit):
+        """Up to limit + 1 online IDs starting with prefix, after the cursor after"""
+        with self.lock:
+            start = bisect.bisect_right(self.online, after) if after else bisect.bisect_left(self.online, prefix)
+            page = []
+            for agent_id in self.online[start:start + limit + 1]:
+                if not agent_id.startswith(prefix):
+                    break
+                page.append(agent_id)
+            return page
+
+    def __len__(self):
+        return len(self.records)
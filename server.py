@@ -1,261 +1,1770 @@
-import socket
-import threading
-import shutil
-import os
-import time
-import json
-import logging
-from datetime import datetime
-from colorama import Fore, Style, init
-
-init(autoreset=True)
-
-# Load configuration
-CONFIG_FILE = "config.json"
-DEFAULT_CONFIG = {
-    "server": {"host": "0.0.0.0", "port": 5555},
-    "client": {"auto_reconnect": True, "save_history": True}
-}
-
-def load_config():
-    try:
-        with open(CONFIG_FILE, 'r') as f:
-            return json.load(f)
-    except:
-        return DEFAULT_CONFIG
-
-config = load_config()
-HOST = config["server"]["host"]
-PORT = config["server"]["port"]
-
-# Setup logging
-os.makedirs("logs", exist_ok=True)
-logging.basicConfig(
-    filename='logs/server.log',
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s'
-)
-
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-server.bind((HOST, PORT))
-server.listen()
-
-active_agents = {}
-public_keys = {}
-offline_mailbox = {}
-agent_last_seen = {}  # Track last activity time
-agent_status = {}  # Track online/offline status
-
-def print_centered(text, color=Fore.WHITE):
-    try: 
-        width = shutil.get_terminal_size().columns
-    except: 
-        width = 80
-    padding = max(0, (width - len(text)) // 2)
-    print(" " * padding + color + text)
-    logging.info(text)
-
-def get_timestamp():
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-def handle_client(client, agent_id):
-    """Handle client connections and route messages/files"""
-    agent_status[agent_id] = "ONLINE"
-    agent_last_seen[agent_id] = get_timestamp()
-    
-    while True:
-        try:
-            data = client.recv(65536)
-            if not data: 
-                break
-            
-            agent_last_seen[agent_id] = get_timestamp()
-            command_packet = data.decode('utf-8', errors='ignore')
-            
-            # Handle agent list requests
-            if command_packet.startswith("[LIST_AGENTS]"):
-                agent_list = []
-                for aid in active_agents.keys():
-                    status = agent_status.get(aid, "OFFLINE")
-                    last_seen = agent_last_seen.get(aid, "Unknown")
-                    agent_list.append(f"{aid}|{status}|{last_seen}")
-                
-                response = f"[AGENT_LIST]{'||'.join(agent_list)}"
-                client.send(response.encode('utf-8'))
-                print_centered(f"[LIST] Sent agent list to {agent_id}", Fore.CYAN)
-            
-            # Handle public key requests
-            elif command_packet.startswith("[GET_KEY]"):
-                target_request = command_packet.split("]")[1]
-                if target_request in public_keys:
-                    response = f"[KEY_FOUND]{public_keys[target_request]}"
-                    client.send(response.encode('utf-8'))
-                else:
-                    client.send(b"[KEY_NOT_FOUND]")
-            
-            # Handle typing indicators
-            elif command_packet.startswith("[TYPING]"):
-                target_id = command_packet.split("]")[1]
-                if target_id in active_agents:
-                    try:
-                        packet = f"[TYPING_INDICATOR]{agent_id}"
-                        active_agents[target_id].send(packet.encode('utf-8'))
-                    except:
-                        pass
-            
-            # Handle read receipts
-            elif command_packet.startswith("[READ_RECEIPT]"):
-                _, content = command_packet.split("]", 1)
-                target_id, msg_id = content.split("|", 1)
-                if target_id in active_agents:
-                    try:
-                        packet = f"[RECEIPT]{agent_id}|{msg_id}"
-                        active_agents[target_id].send(packet.encode('utf-8'))
-                    except:
-                        pass
-            
-            # Handle regular messages
-            elif command_packet.startswith("[MSG]"):
-                _, content = command_packet.split("]", 1)
-                target_id, encrypted_blob = content.split("|", 1)
-                
-                # Support group messages (comma-separated IDs)
-                targets = [t.strip() for t in target_id.split(",")]
-                
-                for tid in targets:
-                    packet_to_send = f"[INCOMING]{agent_id}|{encrypted_blob}"
-                    
-                    if tid in active_agents:
-                        try:
-                            active_agents[tid].send(packet_to_send.encode('utf-8'))
-                            print_centered(f"[MSG] {agent_id} → {tid}", Fore.CYAN)
-                        except:
-                            if tid not in offline_mailbox: 
-                                offline_mailbox[tid] = []
-                            offline_mailbox[tid].append(packet_to_send)
-                            print_centered(f"[BUFFERED] {agent_id} → {tid}", Fore.YELLOW)
-                    else:
-                        if tid not in offline_mailbox: 
-                            offline_mailbox[tid] = []
-                        offline_mailbox[tid].append(packet_to_send)
-                        print_centered(f"[BUFFERED] {agent_id} → {tid}", Fore.YELLOW)
-            
-            # Handle file transfers
-            elif command_packet.startswith("[FILE]"):
-                _, content = command_packet.split("]", 1)
-                target_id, file_data = content.split("|", 1)
-                
-                targets = [t.strip() for t in target_id.split(",")]
-                
-                for tid in targets:
-                    packet_to_send = f"[FILE_INCOMING]{agent_id}|{file_data}"
-                    
-                    if tid in active_agents:
-                        try:
-                            active_agents[tid].send(packet_to_send.encode('utf-8'))
-                            print_centered(f"[FILE] {agent_id} → {tid}", Fore.MAGENTA)
-                        except:
-                            if tid not in offline_mailbox: 
-                                offline_mailbox[tid] = []
-                            offline_mailbox[tid].append(packet_to_send)
-                            print_centered(f"[FILE BUFFERED] {agent_id} → {tid}", Fore.YELLOW)
-                    else:
-                        if tid not in offline_mailbox: 
-                            offline_mailbox[tid] = []
-                        offline_mailbox[tid].append(packet_to_send)
-                        print_centered(f"[FILE BUFFERED] {agent_id} → {tid}", Fore.YELLOW)
-
-            # Handle voice notes
-            elif command_packet.startswith("[VOICE]"):
-                _, content = command_packet.split("]", 1)
-                target_id, voice_data = content.split("|", 1)
-                
-                targets = [t.strip() for t in target_id.split(",")]
-                
-                for tid in targets:
-                    packet_to_send = f"[VOICE_INCOMING]{agent_id}|{voice_data}"
-                    
-                    if tid in active_agents:
-                        try:
-                            active_agents[tid].send(packet_to_send.encode('utf-8'))
-                            print_centered(f"[VOICE] {agent_id} → {tid}", Fore.MAGENTA)
-                        except:
-                            if tid not in offline_mailbox: 
-                                offline_mailbox[tid] = []
-                            offline_mailbox[tid].append(packet_to_send)
-                            print_centered(f"[VOICE BUFFERED] {agent_id} → {tid}", Fore.YELLOW)
-                    else:
-                        if tid not in offline_mailbox: 
-                            offline_mailbox[tid] = []
-                        offline_mailbox[tid].append(packet_to_send)
-                        print_centered(f"[VOICE BUFFERED] {agent_id} → {tid}", Fore.YELLOW)
-
-        except Exception as e:
-            logging.error(f"Error handling client {agent_id}: {e}")
-            break
-    
-    # Cleanup on disconnect
-    agent_status[agent_id] = "OFFLINE"
-    agent_last_seen[agent_id] = get_timestamp()
-    
-    if agent_id in active_agents: 
-        del active_agents[agent_id]
-    client.close()
-    print_centered(f"[-] AGENT DISCONNECTED: {agent_id}", Fore.RED)
-
-def receive():
-    """Main server loop to accept connections"""
-    os.system('cls' if os.name == 'nt' else 'clear')
-    print("\n" * 2)
-    print_centered("╔═══════════════════════════════════════════════╗", Fore.GREEN)
-    print_centered("║   G.I.D SECURE TERMINAL SERVER v3.0 (E2EE)    ║", Fore.GREEN)
-    print_centered("╚═══════════════════════════════════════════════╝", Fore.GREEN)
-    print_centered("-" * 50, Fore.WHITE)
-    print_centered(f"[*] LISTENING ON {HOST}:{PORT}", Fore.CYAN)
-    print_centered("[*] WAITING FOR SECURE HANDSHAKES...", Fore.CYAN)
-    print_centered("-" * 50, Fore.WHITE)
-    print("\n")
-    logging.info(f"Server started on {HOST}:{PORT}")
-    
-    while True:
-        try:
-            client, address = server.accept()
-            try:
-                initial_data = client.recv(8192).decode('utf-8')
-                
-                if initial_data.startswith("[REGISTER]"):
-                    _, payload = initial_data.split("]", 1)
-                    agent_id, pub_key_pem = payload.split("|", 1)
-                    
-                    active_agents[agent_id] = client
-                    public_keys[agent_id] = pub_key_pem
-                    agent_status[agent_id] = "ONLINE"
-                    agent_last_seen[agent_id] = get_timestamp()
-                    
-                    print_centered(f"[+] REGISTERED: {agent_id} ({address[0]})", Fore.GREEN)
-                    logging.info(f"Agent registered: {agent_id} from {address[0]}")
-                    
-                    # Deliver offline messages
-                    if agent_id in offline_mailbox:
-                        print_centered(f"[*] DELIVERING {len(offline_mailbox[agent_id])} OFFLINE MESSAGES TO {agent_id}", Fore.YELLOW)
-                        for saved_msg in offline_mailbox[agent_id]:
-                            client.send(saved_msg.encode('utf-8'))
-                            time.sleep(0.2)
-                        del offline_mailbox[agent_id]
-
-                    thread = threading.Thread(target=handle_client, args=(client, agent_id))
-                    thread.daemon = True
-                    thread.start()
-            except Exception as e:
-                logging.error(f"Error during registration: {e}")
-                client.close()
-        except Exception as e:
-            logging.error(f"Error accepting connection: {e}")
-
-if __name__ == "__main__":
-    try:
-        receive()
-    except KeyboardInterrupt:
-        print_centered("\n[!] SERVER SHUTDOWN", Fore.RED)
+import socket
+import threading
+import asyncio
+import os
+import time
+import json
+import logging
+import re
+import signal
+import multiprocessing
+from collections import deque
+from datetime import datetime
+from colorama import Fore, Style, init
+from protocol import PacketDecoder, encode_parts, encode_frame, send_buffers, to_bytes, payload_size, MAX_FRAME_SIZE
+from mailstore import MailboxStore, HEAD_BYTES
+from keystore import KeyStore
+from cluster import PeerLink, serve_peers
+from timerwheel import TimerWheel
+from ratelimit import RateLimiter, parse_limits
+from registry import Registry
+from snapshot import StateSnapshot
+from handshake import HandshakeStage
+import metrics
+import asynclog
+
+init(autoreset=True)
+
+# Load configuration
+CONFIG_FILE = "config.json"
+DEFAULT_CONFIG = {
+    "server": {
+        "host": "0.0.0.0",
+        "port": 5555,
+        "mode": "threaded",
+        "backlog": 4096,
+        "max_frame_size": MAX_FRAME_SIZE,
+        "handshake": {"timeout": 10, "max_pending": 4096},
+        "outbound": {"max_packets": 1024, "max_bytes": 16 * 1024 * 1024, "overflow_policy": "mailbox"}
+    },
+    "mailbox": {
+        "path": "data/mailbox.db",
+        "ttl": 7 * 24 * 3600,
+        "max_messages": 1000,
+        "max_bytes": 64 * 1024 * 1024,
+        "max_total_bytes": 1024 * 1024 * 1024,
+        "eviction": "oldest",
+        "sweep_interval": 5
+    },
+    "keys": {"path": "data/keys.db"},
+    "snapshot": {"path": "data/state.db", "interval": 10, "drain_timeout": 5},
+    "heartbeat": {"interval": 30, "timeout": 90},
+    "rate_limits": {
+        "enabled": True,
+        "burst_seconds": 2,
+        "agent": {"packets": 200, "bytes": 8 * 1024 * 1024},
+        "commands": {
+            "TYPING": {"packets": 5},
+            "LIST_AGENTS": {"packets": 1},
+            "LIST_PAGE": {"packets": 10},
+            "GET_KEY": {"packets": 20},
+            "GET_KEYS": {"packets": 10},
+            "PRESENCE_SUBSCRIBE": {"packets": 5},
+            "CHANNEL_CREATE": {"packets": 2},
+            "FILE": {"bytes": 4 * 1024 * 1024},
+            "VOICE": {"bytes": 4 * 1024 * 1024}
+        }
+    },
+    "cluster": {"workers": 1, "socket_dir": "data/cluster"},
+    "federation": {"node": "", "listen": "", "secret": "", "peers": {}},
+    "metrics": {"host": "127.0.0.1", "port": 9555},
+    "logging": {"headless": False, "route_log": "all", "summary_interval": 10},
+    "client": {"auto_reconnect": True, "save_history": True}
+}
+
+def load_config():
+    try:
+        with open(CONFIG_FILE, 'r') as f:
+            return json.load(f)
+    except:
+        return DEFAULT_CONFIG
+
+config = load_config()
+HOST = config["server"]["host"]
+PORT = config["server"]["port"]
+SERVER_MODE = config["server"].get("mode", "threaded")
+BACKLOG = config["server"].get("backlog", 4096)
+MAX_FRAME = config["server"].get("max_frame_size", MAX_FRAME_SIZE)
+OUTBOUND = {**DEFAULT_CONFIG["server"]["outbound"], **config["server"].get("outbound", {})}
+HANDSHAKE = {**DEFAULT_CONFIG["server"]["handshake"], **config["server"].get("handshake", {})}
+OVERFLOW_POLICIES = ("mailbox", "drop", "disconnect")
+OVERFLOW_POLICY = OUTBOUND["overflow_policy"] if OUTBOUND["overflow_policy"] in OVERFLOW_POLICIES else "mailbox"
+WRITE_BATCH_BYTES = 256 * 1024
+MAILBOX = {**DEFAULT_CONFIG["mailbox"], **config.get("mailbox", {})}
+MAILBOX_PATH = MAILBOX["path"]
+MAILBOX_PAGE_SIZE = 100
+MAILBOX_MAX_MESSAGES = MAILBOX["max_messages"] or float("inf")  # Per-recipient quotas; 0 means no limit
+MAILBOX_MAX_BYTES = MAILBOX["max_bytes"] or float("inf")
+MAILBOX_EVICTION = MAILBOX["eviction"] if MAILBOX["eviction"] in ("oldest", "largest") else "oldest"
+SWEEP_BATCH = 200  # Packets evicted per database call, so the sweeper never holds the mailbox for long
+KEYS_PATH = config.get("keys", DEFAULT_CONFIG["keys"]).get("path", DEFAULT_CONFIG["keys"]["path"])
+MAX_KEYS_PER_REQUEST = 500
+SNAPSHOT = {**DEFAULT_CONFIG["snapshot"], **config.get("snapshot", {})}
+DRAIN_POLL = 0.05
+DRAIN_GRACE = 1.0  # Extra seconds for closed sessions to unregister after the drain
+CLUSTER = {**DEFAULT_CONFIG["cluster"], **config.get("cluster", {})}
+WORKERS = max(1, int(CLUSTER["workers"]))
+GATEWAY_WORKER = "0"  # The worker that links a multi-process node to other nodes
+FEDERATION = {**DEFAULT_CONFIG["federation"], **config.get("federation", {})}
+NODE_NAME = FEDERATION["node"] or socket.gethostname()
+NODE_PEERS = FEDERATION["peers"]  # Node name -> "host:port" of its federation listener
+PEER_FRAME_SIZE = MAX_FRAME + 1024
+METRICS = {**DEFAULT_CONFIG["metrics"], **config.get("metrics", {})}
+LOGGING = {**DEFAULT_CONFIG["logging"], **config.get("logging", {})}
+HEADLESS = LOGGING["headless"]
+ROUTE_LOG = LOGGING["route_log"]  # "all" (one line per packet), "summary" or "off"
+HEARTBEAT = {**DEFAULT_CONFIG["heartbeat"], **config.get("heartbeat", {})}
+HEARTBEAT_INTERVAL = HEARTBEAT["interval"]  # Idle seconds before a PING; 0 disables heartbeats
+HEARTBEAT_TIMEOUT = max(HEARTBEAT["timeout"], HEARTBEAT_INTERVAL)  # Idle seconds before the session is reaped
+RATE_LIMITS = {**DEFAULT_CONFIG["rate_limits"], **config.get("rate_limits", {})}
+RATE_LIMITS["commands"] = {**DEFAULT_CONFIG["rate_limits"]["commands"], **config.get("rate_limits", {}).get("commands", {})}
+AGENT_LIMIT, COMMAND_LIMITS = parse_limits(RATE_LIMITS)
+THROTTLE_NOTICE_INTERVAL = 1.0  # At most one THROTTLED reply per second per connection
+# Over-limit packets of these kinds are dropped without a THROTTLED reply
+QUIET_THROTTLE = {"TYPING", "READ_RECEIPT", "ACK", "PONG"}
+
+# Packets that are only meaningful while both agents are online
+EPHEMERAL_COMMANDS = {"TYPING_INDICATOR", "RECEIPT", "PRESENCE_UPDATE", "KEY_CHANGED", "MAIL_DROPPED", "STORED", "DELIVERED"}
+
+# Chunked transfer packets, relayed as "target|..." -> "sender|..."
+TRANSFER_COMMANDS = {"XFER_OFFER", "XFER_CHUNK", "XFER_ACK", "XFER_RESUME"}
+
+# Packets relayed without decoding their body: command -> (outgoing command, log label, colour)
+RELAY_COMMANDS = {
+    "MSG": ("INCOMING", "MSG", Fore.CYAN),
+    "FILE": ("FILE_INCOMING", "FILE", Fore.MAGENTA),
+    "VOICE": ("VOICE_INCOMING", "VOICE", Fore.MAGENTA),
+    "SEQ_MSG": ("SEQ_INCOMING", "MSG", Fore.CYAN),
+    "SEQ_FILE": ("SEQ_FILE_INCOMING", "FILE", Fore.MAGENTA),
+    "SEQ_VOICE": ("SEQ_VOICE_INCOMING", "VOICE", Fore.MAGENTA),
+}
+TARGET_SCAN_BYTES = 4096  # The "target|" prefix must end within this many bytes
+SEQ_DIGITS = 20  # Sequence numbers clients put after the target are at most this long
+# Relayed packets whose body starts with the sender's "seq|" -> the same packet for clients that predate sequence numbers
+SEQUENCED_COMMANDS = {"SEQ_INCOMING": "INCOMING", "SEQ_FILE_INCOMING": "FILE_INCOMING", "SEQ_VOICE_INCOMING": "VOICE_INCOMING"}
+# Sequenced packets count against the rate limits of the packets they number
+RATE_CLASS = {"SEQ_MSG": "MSG", "SEQ_FILE": "FILE", "SEQ_VOICE": "VOICE"}
+
+CHANNEL_NAME = re.compile(r"^#[A-Za-z0-9_-]{1,32}$")
+
+TYPING_TTL = 6.0  # Seconds a typing state lasts unless the sender refreshes it
+TYPING_BUSY = 8  # Typing changes skip recipients with more packets than this queued
+RECEIPT_DELAY = 0.5  # Seconds read receipts wait so those for the same sender go out together
+
+PAGE_SIZE = 50  # Default and maximum agents per LIST_PAGE response
+MAX_PAGE_SIZE = 200
+MAX_WATCHED = 1000  # Agents one subscriber may watch
+
+# Setup logging; lines are written by a background thread, never on the relay path
+asynclog.start("logs/server.log", headless=HEADLESS,
+               summary_interval=LOGGING["summary_interval"] if ROUTE_LOG == "summary" else 0)
+
+# Without a shared secret any host could join the federation and replace agents' public keys
+if (NODE_PEERS or FEDERATION["listen"]) and not FEDERATION["secret"]:
+    logging.error("Federation is configured without a secret; not linking to other nodes")
+    NODE_PEERS = {}
+
+server = None
+
+agents = Registry()  # Every known agent: local connection, remote holder, home node, last seen
+key_directory = KeyStore(KEYS_PATH)
+offline_mailbox = MailboxStore(MAILBOX_PATH)
+state_snapshot = StateSnapshot(SNAPSHOT["path"])
+channels = {}  # Channel name -> set of member agent IDs
+dirty_channels = set()  # Channels changed since the last snapshot
+shutting_down = threading.Event()
+handshake_stage = None  # Threaded mode: connections waiting to register
+async_handshakes = {}  # Asyncio mode: writer -> None for connections waiting to register, oldest first
+channel_lock = threading.Lock()
+watchers = {}  # Agent ID -> set of agent IDs subscribed to its presence
+subscriptions = {}  # Subscriber agent ID -> set of agent IDs it watches
+presence_lock = threading.Lock()
+heartbeat_wheel = TimerWheel()
+typing_state = {}  # (sender, target) -> time.monotonic() at which the typing state lapses
+typing_lock = threading.Lock()
+typing_wheel = TimerWheel(tick=0.5, slots=64)
+pending_receipts = {}  # Sender -> {(conversation, reader): highest seq read} waiting to be sent
+receipt_lock = threading.Lock()
+receipt_wheel = TimerWheel(tick=0.25, slots=16)
+
+# Multi-process and federated modes: each worker or node holds some agents and replicates the directory
+worker_name = None  # This process's name in the cluster, None when running alone
+peers = {}  # Worker or node name -> PeerLink
+mailbox_handoffs = set()  # Agents whose mail is being forwarded to another node
+mailbox_over_quota = set()  # Recipients the sweeper should trim back to their quota
+event_loop = None
+async_stop = None  # Asyncio mode: set to begin shutdown
+
+def print_centered(text, color=Fore.WHITE):
+    asynclog.emit(text, color)
+
+def log_route(label, text, color, buffered=False):
+    """Log one routed packet, or just count it when route logs are summarized"""
+    if ROUTE_LOG == "all":
+        print_centered(text, color)
+    elif ROUTE_LOG == "summary":
+        asynclog.tally(label, buffered)
+
+def wall_clock(seen):
+    """Convert a time.monotonic() value to time.time()"""
+    return time.time() - (time.monotonic() - seen)
+
+def format_seen(seen):
+    """Render a time.monotonic() value from the registry as wall-clock time"""
+    if seen is None:
+        return "Unknown"
+    return datetime.fromtimestamp(wall_clock(seen)).strftime("%Y-%m-%d %H:%M:%S")
+
+class AgentConnection:
+    """Agent connection with a bounded outbound queue drained by a dedicated writer thread
+
+    Routing code only ever queues packets, so a slow recipient stalls its
+    own writer instead of the sender's read loop.
+    """
+    __slots__ = ("sock", "framed", "agent_id", "queue", "queued_bytes", "high_water", "overflows", "closed", "draining", "ready", "last_active",
+                 "limiter", "throttle_notice", "writing")
+
+    def __init__(self, sock, framed=True):
+        self.sock = sock
+        self.framed = framed
+        self.agent_id = None
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.high_water = 0
+        self.overflows = 0
+        self.closed = False
+        self.draining = False
+        self.ready = threading.Condition()
+        self.last_active = time.monotonic()
+        self.throttle_notice = 0.0
+        self.writing = False
+        if RATE_LIMITS["enabled"]:
+            self.limiter = RateLimiter(AGENT_LIMIT, COMMAND_LIMITS, RATE_LIMITS["burst_seconds"], time.perf_counter())
+        else:
+            self.limiter = None
+
+    def append(self, command, payload, data, size):
+        """Add an encoded packet (a list of buffers) to the queue; caller holds self.ready"""
+        self.queue.append((command, payload, data, size, time.perf_counter()))
+        self.queued_bytes += size
+        metrics.count_packet("out", command, size)
+        self.high_water = max(self.high_water, len(self.queue))
+        self.ready.notify_all()
+
+    def has_room(self, size):
+        """True while the queue is below half capacity, leaving headroom for live traffic"""
+        if not self.queue:
+            return True
+        return len(self.queue) < OUTBOUND["max_packets"] // 2 and self.queued_bytes + size <= OUTBOUND["max_bytes"] // 2
+
+    def encode(self, command, payload):
+        """(buffers, size) for a packet in this peer's format; legacy peers never see sequence numbers"""
+        if not self.framed and command in SEQUENCED_COMMANDS:
+            command, payload = SEQUENCED_COMMANDS[command], strip_sequence(payload)
+        elif not self.framed and command == "TYPING_INDICATOR":
+            payload = to_bytes(payload).rpartition(b"|")[0]
+        return encode_parts(command, payload, self.framed)
+
+    def send_packet(self, command, payload="", encoded=None):
+        """Queue a packet for the writer; returns False if it was not accepted
+
+        encoded is an optional {framed: (buffers, size)} cache shared by
+        every recipient of a fan-out, so each wire format is built only once.
+        Large payloads are queued as references, never copied.
+        """
+        if not self.framed and command == "TYPING_INDICATOR" and to_bytes(payload).endswith(b"|stop"):
+            # Legacy clients only know "agent is typing" and let it fade on their own
+            return False
+        if encoded is None:
+            data, size = self.encode(command, payload)
+        else:
+            entry = encoded.get(self.framed)
+            if entry is None:
+                entry = encoded[self.framed] = self.encode(command, payload)
+            data, size = entry
+        with self.ready:
+            if self.closed:
+                return False
+            full = len(self.queue) >= OUTBOUND["max_packets"] or self.queued_bytes + size > OUTBOUND["max_bytes"]
+            if full:
+                self.overflows += 1
+                metrics.increment("queue_overflows")
+            else:
+                self.append(command, payload, data, size)
+        
+        if full and OVERFLOW_POLICY == "disconnect" and command not in EPHEMERAL_COMMANDS:
+            logging.warning(f"Outbound queue full for {self.agent_id}, disconnecting")
+            self.abort()
+        return not full
+
+    def take_batch(self):
+        """Pop queued packets for one vectored write (one packet at a time for legacy peers)
+
+        Returns the list of buffers and the times their packets were queued.
+        """
+        buffers = []
+        stamps = []
+        size = 0
+        while self.queue and size < WRITE_BATCH_BYTES:
+            _, _, data, length, queued_at = self.queue.popleft()
+            buffers.extend(data)
+            stamps.append(queued_at)
+            size += length
+            if not self.framed:
+                break
+        self.queued_bytes -= size
+        return buffers, stamps
+
+    def push_backlog(self, command, payload):
+        """Queue a mailbox packet, blocking until the writer has made room"""
+        data, size = self.encode(command, payload)
+        with self.ready:
+            while not self.closed and not self.has_room(size):
+                self.ready.wait()
+            if self.closed:
+                return False
+            self.append(command, payload, data, size)
+        return True
+
+    def take_undelivered(self):
+        """Remove and return (command, payload) for every packet still queued"""
+        with self.ready:
+            pending = [(command, payload) for command, payload, _, _, _ in self.queue]
+            self.queue.clear()
+            self.queued_bytes = 0
+        return pending
+
+    def flushed(self):
+        """True once everything queued has been handed to the kernel"""
+        return not self.queue and not self.writing
+
+    def start_writer(self):
+        threading.Thread(target=self.write_loop, daemon=True).start()
+
+    def write_loop(self):
+        """Writer thread: owns the socket and flushes the queue with vectored writes"""
+        while True:
+            with self.ready:
+                while not self.queue and not self.closed:
+                    self.ready.wait()
+                if self.closed:
+                    return
+                batch, stamps = self.take_batch()
+                self.writing = True
+                # Wake a mailbox drain waiting for room
+                self.ready.notify_all()
+            try:
+                send_buffers(self.sock, batch)
+            except OSError as e:
+                logging.error(f"Write error for {self.agent_id}: {e}")
+                self.abort()
+                return
+            finally:
+                self.writing = False
+            record_flush(stamps)
+
+    def abort(self):
+        """Tear the connection down so the reader notices and unregisters"""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+            self.ready.notify_all()
+        self.sock.close()
+
+def record_flush(stamps):
+    """Observe queue-to-socket latency for a batch that has just been written"""
+    now = time.perf_counter()
+    for queued_at in stamps:
+        metrics.observe("flush", now - queued_at)
+
+def buffer_offline(tid, command, payload):
+    """Store a packet for an agent that is not currently reachable
+
+    Mail for IDs that never registered a key is refused, as is anything
+    that could never fit the recipient's quota or that arrives while the
+    recipient is already twice over it. Smaller overruns are trimmed by
+    the sweeper.
+    """
+    if command in EPHEMERAL_COMMANDS:
+        return
+    size = payload_size(payload)
+    if (tid not in key_directory or size > MAILBOX_MAX_BYTES
+            or offline_mailbox.count(tid) >= 2 * MAILBOX_MAX_MESSAGES
+            or offline_mailbox.size(tid) + size > 2 * MAILBOX_MAX_BYTES):
+        # Relayed payloads start with their sender prefix, which is all the report needs
+        head = payload[0] if isinstance(payload, tuple) else payload
+        report_dropped([(tid, command, to_bytes(head[:HEAD_BYTES]))], "refused")
+        return
+    offline_mailbox.enqueue(tid, command, to_bytes(payload))
+    metrics.increment("mailbox_spills")
+    confirm_stored(tid, command, payload)
+    if offline_mailbox.count(tid) > MAILBOX_MAX_MESSAGES or offline_mailbox.size(tid) > MAILBOX_MAX_BYTES:
+        mailbox_over_quota.add(tid)
+
+def sequence_of(payload):
+    """(sender prefix, seq) of a sequenced "sender|seq|blob" payload, or None if its seq is malformed"""
+    if isinstance(payload, tuple):
+        head = to_bytes(payload[0]) + to_bytes(payload[1][:SEQ_DIGITS + 1])
+    else:
+        head = to_bytes(payload[:HEAD_BYTES])
+    sender, _, rest = head.partition(b"|")
+    seq, sep, _ = rest.partition(b"|")
+    if not sep or not seq.isdigit() or len(seq) > SEQ_DIGITS:
+        return None
+    return sender.decode('utf-8', errors='ignore'), seq.decode('ascii')
+
+def strip_sequence(payload):
+    """A relayed "sender|seq|blob" payload as "sender|blob", for clients that predate sequence numbers"""
+    sequenced = sequence_of(payload)
+    if sequenced is None:
+        return payload
+    skip = len(sequenced[1]) + 1
+    if isinstance(payload, tuple):
+        prefix, blob = payload
+        return prefix, blob[skip:]
+    body = to_bytes(payload)
+    cut = body.index(b"|") + 1
+    return body[:cut] + body[cut + skip:]
+
+def confirm_stored(tid, command, payload):
+    """Tell the sender of a sequenced message that tid's copy is safe in the mailbox
+
+    The sender counts this like a delivery ack, so an offline recipient
+    does not hold up its send window.
+    """
+    sequenced = sequence_of(payload) if command in SEQUENCED_COMMANDS else None
+    if sequenced is None:
+        return
+    sender, seq = sequenced
+    channel, _, sender = sender.rpartition(":")
+    deliver(sender, "STORED", f"{channel or tid}|{seq}|{tid}")
+
+def deliver(tid, command, payload, encoded=None, arrived_from=None):
+    """Queue a packet for tid; returns True if it went to a live connection
+
+    Agents held by another worker or node get the packet forwarded over
+    that peer link, and mail for an offline agent goes to its home node.
+    Packets that cannot be queued are spilled to the offline mailbox
+    unless they are ephemeral or the overflow policy says to drop them.
+    """
+    record = agents.get(tid)
+    conn = record.connection if record is not None else None
+    if conn is None and record is not None:
+        holder = record.holder
+        if holder is not None:
+            if may_route(arrived_from, holder) and route_to_peer(holder, tid, command, payload):
+                return True
+        elif record.node not in (None, NODE_NAME) and command not in EPHEMERAL_COMMANDS:
+            hop = next_hop(record.node)
+            if hop is not None and may_route(arrived_from, hop) and route_to_peer(hop, tid, command, payload):
+                # Its home node keeps the mail until it reconnects
+                return False
+    if conn is not None and conn.draining and command not in EPHEMERAL_COMMANDS:
+        # Keep ordering behind the backlog that is still being replayed
+        with conn.ready:
+            if conn.draining:
+                buffer_offline(tid, command, payload)
+                return False
+    if conn is not None and conn.send_packet(command, payload, encoded):
+        return True
+    if command in EPHEMERAL_COMMANDS:
+        return False
+    if conn is not None and not conn.closed and OVERFLOW_POLICY == "drop":
+        return False
+    buffer_offline(tid, command, payload)
+    return False
+
+def relay_to_targets(agent_id, target_id, command, blob, label, color):
+    """Deliver a packet to a channel or to every comma-separated target, buffering offline ones"""
+    if target_id.startswith("#"):
+        relay_to_channel(agent_id, target_id, command, blob, label, color)
+        return
+    
+    targets = [t.strip() for t in target_id.split(",")]
+    payload = (f"{agent_id}|".encode('utf-8'), blob)
+    encoded = {}
+    
+    for tid in targets:
+        if deliver(tid, command, payload, encoded):
+            log_route(label, f"[{label}] {agent_id} → {tid}", color)
+        else:
+            log_route(label, f"[{label} BUFFERED] {agent_id} → {tid}", Fore.YELLOW, buffered=True)
+
+def relay_to_channel(agent_id, channel, command, blob, label, color):
+    """Fan a packet out to every channel member except the sender, encoding it once"""
+    with channel_lock:
+        members = channels.get(channel)
+        if members is None or agent_id not in members:
+            members = None
+        else:
+            members = list(members)
+    
+    if members is None:
+        deliver(agent_id, "CHANNEL_STATUS", f"{channel}|ERROR|not a member")
+        return
+    
+    # Receivers see the sender as "#channel:agent_id"
+    payload = (f"{channel}:{agent_id}|".encode('utf-8'), blob)
+    encoded = {}
+    live = 0
+    for tid in members:
+        if tid != agent_id and deliver(tid, command, payload, encoded):
+            live += 1
+    log_route(label, f"[{label}] {agent_id} → {channel} ({live}/{len(members) - 1} live)", color)
+
+def handle_channel_command(agent_id, command, name, client):
+    """Create, join, leave or list a server-managed channel"""
+    if not name.startswith("#"):
+        name = "#" + name
+    if not CHANNEL_NAME.match(name):
+        client.send_packet("CHANNEL_STATUS", f"{name}|ERROR|invalid channel name")
+        return
+    
+    with channel_lock:
+        members = channels.get(name)
+        if command == "CHANNEL_CREATE":
+            if members is not None:
+                result = "ERROR|channel exists"
+            else:
+                channels[name] = {agent_id}
+                result = "OK|created"
+        elif members is None:
+            result = "ERROR|no such channel"
+        elif command == "CHANNEL_JOIN":
+            members.add(agent_id)
+            result = "OK|joined"
+        elif command == "CHANNEL_LEAVE":
+            members.discard(agent_id)
+            if not members:
+                del channels[name]
+            result = "OK|left"
+        else:
+            client.send_packet("CHANNEL_MEMBERS", f"{name}|{','.join(sorted(members))}")
+            return
+        if result.startswith("OK"):
+            dirty_channels.add(name)
+    
+    if result.startswith("OK"):
+        broadcast("PEER_CHANNEL", f"{command}|{name}|{agent_id}")
+    client.send_packet("CHANNEL_STATUS", f"{name}|{result}")
+    print_centered(f"[CHANNEL] {agent_id} {command.split('_')[1].lower()} {name}: {result}", Fore.CYAN)
+
+def apply_channel_update(command, name, agent_id):
+    """Mirror a channel change made on another worker"""
+    with channel_lock:
+        dirty_channels.add(name)
+        if command == "CHANNEL_LEAVE":
+            members = channels.get(name)
+            if members is not None:
+                members.discard(agent_id)
+                if not members:
+                    del channels[name]
+        else:
+            channels.setdefault(name, set()).add(agent_id)
+
+def outbound_queue_stats():
+    """Snapshot of (agent_id, depth, queued_bytes, high_water, overflows) per live connection"""
+    return [
+        (aid, len(conn.queue), conn.queued_bytes, conn.high_water, conn.overflows)
+        for aid, conn in agents.local_agents()
+    ]
+
+# ==================== MAILBOX RETENTION ====================
+
+def mail_sender(head):
+    """Agent ID at the start of a stored payload ("sender|..." or "#channel:sender|...")"""
+    sender = head.split(b"|", 1)[0].decode('utf-8', errors='ignore')
+    if sender.startswith("#"):
+        sender = sender.partition(":")[2]
+    return sender
+
+def report_dropped(dropped, reason):
+    """Tell each sender that is still online how many of its packets were dropped, per recipient"""
+    metrics.increment("mailbox_evictions", len(dropped))
+    counts = {}
+    for recipient, _, head in dropped:
+        key = (mail_sender(head), recipient)
+        counts[key] = counts.get(key, 0) + 1
+    for (sender, recipient), count in counts.items():
+        record = agents.get(sender)
+        if record is not None and record.online:
+            deliver(sender, "MAIL_DROPPED", f"{recipient}|{count}|{reason}")
+    if dropped:
+        logging.info(f"Mailbox dropped {len(dropped)} packets ({reason})")
+
+def sweep_mailbox():
+    """One retention pass: expired mail, then over-quota recipients, then the global cap
+
+    Each step deletes at most SWEEP_BATCH packets per call and yields in
+    between, so relaying and mailbox drains are never held up for long.
+    Expiry and the global cap are shared by every worker, so only the
+    gateway worker applies them.
+    """
+    shared = worker_name in (None, GATEWAY_WORKER)
+    if shared and MAILBOX["ttl"]:
+        before = time.time() - MAILBOX["ttl"]
+        while True:
+            dropped = offline_mailbox.expire(before, SWEEP_BATCH)
+            if not dropped:
+                break
+            dispatch(report_dropped, dropped, "expired")
+            time.sleep(0)
+    
+    for recipient in list(mailbox_over_quota):
+        mailbox_over_quota.discard(recipient)
+        if agents.connection(recipient) is not None:
+            continue  # Being drained right now
+        while True:
+            dropped = offline_mailbox.trim(recipient, MAILBOX_MAX_MESSAGES, MAILBOX_MAX_BYTES,
+                                           MAILBOX_EVICTION, SWEEP_BATCH)
+            if not dropped:
+                break
+            dispatch(report_dropped, dropped, "quota")
+            time.sleep(0)
+    
+    if shared and MAILBOX["max_total_bytes"]:
+        while True:
+            excess = offline_mailbox.total_size(exact=WORKERS > 1) - MAILBOX["max_total_bytes"]
+            dropped = offline_mailbox.shrink(excess, MAILBOX_EVICTION, SWEEP_BATCH) if excess > 0 else []
+            if not dropped:
+                break
+            dispatch(report_dropped, dropped, "capacity")
+            time.sleep(0)
+
+def sweep_loop():
+    while True:
+        time.sleep(MAILBOX["sweep_interval"])
+        try:
+            sweep_mailbox()
+        except Exception as e:
+            logging.error(f"Mailbox sweep failed: {e}")
+
+def start_mailbox_sweeper():
+    if MAILBOX["sweep_interval"]:
+        threading.Thread(target=sweep_loop, daemon=True).start()
+
+# ==================== PRESENCE ====================
+
+def presence_entry(agent_id, online, seen):
+    return f"{agent_id}|{'ONLINE' if online else 'OFFLINE'}|{format_seen(seen)}"
+
+def presence_entries(agent_ids=None):
+    """Formatted entries for agent_ids, or for every online agent"""
+    return [presence_entry(*entry) for entry in agents.entries(agent_ids)]
+
+def publish_presence(agent_id):
+    """Send a PRESENCE_UPDATE to every local subscriber watching agent_id"""
+    subscribers = watchers.get(agent_id)
+    if not subscribers:
+        return
+    with presence_lock:
+        subscribers = list(subscribers)
+    entry = presence_entries([agent_id])[0]
+    encoded = {}
+    for subscriber in subscribers:
+        deliver(subscriber, "PRESENCE_UPDATE", entry, encoded)
+
+def subscribe_presence(agent_id, payload, client):
+    """Add comma-separated agents to agent_id's interest list and reply with their current state"""
+    wanted = [aid.strip() for aid in payload.split(",") if aid.strip()]
+    with presence_lock:
+        watched = subscriptions.setdefault(agent_id, set())
+        wanted = [aid for aid in wanted if aid in watched or len(watched) < MAX_WATCHED]
+        for aid in wanted:
+            watched.add(aid)
+            watchers.setdefault(aid, set()).add(agent_id)
+    client.send_packet("PRESENCE_SNAPSHOT", "||".join(presence_entries(wanted)))
+
+def unsubscribe_presence(agent_id, payload=""):
+    """Drop agents from agent_id's interest list, or all of them when payload is empty"""
+    with presence_lock:
+        watched = subscriptions.get(agent_id)
+        if not watched:
+            return
+        dropped = [aid.strip() for aid in payload.split(",") if aid.strip()] or list(watched)
+        for aid in dropped:
+            watched.discard(aid)
+            subscribers = watchers.get(aid)
+            if subscribers is not None:
+                subscribers.discard(agent_id)
+                if not subscribers:
+                    del watchers[aid]
+        if not watched:
+            del subscriptions[agent_id]
+
+def list_page(payload, client):
+    """Reply with one page of online agents: "prefix|after|limit" -> "next||entries..."
+
+    Pages are keyed by the last agent ID returned, so each request costs
+    O(log N + limit) however many agents are online.
+    """
+    fields = payload.split("|")
+    prefix = fields[0]
+    after = fields[1] if len(fields) > 1 else ""
+    try:
+        limit = min(MAX_PAGE_SIZE, max(1, int(fields[2]))) if len(fields) > 2 and fields[2] else PAGE_SIZE
+    except ValueError:
+        limit = PAGE_SIZE
+    
+    page = agents.page(prefix, after, limit)
+    next_cursor = page[limit - 1] if len(page) > limit else ""
+    entries = presence_entries(page[:limit])
+    client.send_packet("AGENT_PAGE", "||".join([next_cursor] + entries))
+
+# ==================== TYPING ====================
+
+def set_typing(agent_id, target_id, typing):
+    """Record that agent_id started or stopped typing to an agent or channel
+
+    Only changes reach the target. Refreshes while the state is live just
+    push its deadline out, and a state that is not refreshed within
+    TYPING_TTL lapses into a stop from the typing wheel.
+    """
+    key = (agent_id, target_id)
+    with typing_lock:
+        was_typing = key in typing_state
+        if typing:
+            typing_state[key] = time.monotonic() + TYPING_TTL
+        else:
+            typing_state.pop(key, None)
+    if typing and not was_typing:
+        typing_wheel.schedule(TYPING_TTL, key)
+    if typing != was_typing:
+        send_typing(agent_id, target_id, "start" if typing else "stop")
+
+def clear_typing(agent_id, target_id):
+    """Forget a typing state without a stop; the message being relayed ends it on the client"""
+    if typing_state:
+        with typing_lock:
+            typing_state.pop((agent_id, target_id), None)
+
+def lapse_typing(due):
+    """Typing wheel callback: stop the states that were not refreshed in time"""
+    now = time.monotonic()
+    for key in due:
+        with typing_lock:
+            deadline = typing_state.get(key)
+            if deadline is None:
+                continue
+            if deadline > now:
+                typing_wheel.schedule(deadline - now, key)
+                continue
+            del typing_state[key]
+        send_typing(*key, "stop")
+
+def send_typing(agent_id, target_id, state):
+    """Deliver a typing change, skipping recipients whose outbound queue is busy with real traffic"""
+    if target_id.startswith("#"):
+        with channel_lock:
+            members = channels.get(target_id)
+            recipients = [m for m in members if m != agent_id] if members and agent_id in members else []
+        payload = f"{target_id}:{agent_id}|{state}"
+    else:
+        recipients = [target_id]
+        payload = f"{agent_id}|{state}"
+    encoded = {}
+    for tid in recipients:
+        conn = agents.connection(tid)
+        if conn is not None and (conn.draining or len(conn.queue) > TYPING_BUSY):
+            metrics.increment("typing_dropped")
+            continue
+        deliver(tid, "TYPING_INDICATOR", payload, encoded)
+
+def start_typing():
+    typing_wheel.start(lambda due: dispatch(lapse_typing, due))
+
+# ==================== READ RECEIPTS ====================
+
+def read_receipts(agent_id, payload):
+    """Take cumulative receipts "conversation|N||..." from agent_id, who has read up to N
+
+    conversation is the sender as agent_id saw it ("agent" or
+    "#channel:agent"). Older clients send "sender|msg_id" for each
+    message, which is passed straight on.
+    """
+    for entry in payload.split("||"):
+        conversation, _, upto = entry.partition("|")
+        if not upto.isdigit():
+            deliver(conversation, "RECEIPT", f"{agent_id}|{upto}")
+            continue
+        channel, _, sender = conversation.rpartition(":")
+        queue_receipt(sender, channel or agent_id, agent_id, int(upto))
+
+def queue_receipt(sender, conversation, reader, upto):
+    """Merge a receipt into those waiting for sender; a conversation keeps only its highest N"""
+    key = (conversation, reader)
+    with receipt_lock:
+        pending = pending_receipts.get(sender)
+        if pending is None:
+            pending = pending_receipts[sender] = {}
+            receipt_wheel.schedule(RECEIPT_DELAY, sender)
+        if upto > pending.get(key, 0):
+            pending[key] = upto
+
+def flush_receipts(due):
+    """Receipt wheel callback: one RECEIPT "conversation|N|reader||..." per sender"""
+    for sender in due:
+        with receipt_lock:
+            pending = pending_receipts.pop(sender, None)
+        if pending:
+            deliver(sender, "RECEIPT", "||".join(f"{conversation}|{upto}|{reader}"
+                                                 for (conversation, reader), upto in pending.items()))
+
+def start_receipts():
+    receipt_wheel.start(lambda due: dispatch(flush_receipts, due))
+
+# ==================== KEY DIRECTORY ====================
+
+def store_key(agent_id, pem, codecs=""):
+    """Record agent_id's key and codec list and tell its watchers if the key rotated"""
+    digest, version, changed = key_directory.put(agent_id, pem, codecs)
+    if changed:
+        print_centered(f"[!] KEY ROTATED: {agent_id} (version {version})", Fore.YELLOW)
+        logging.info(f"Key rotated for {agent_id}: version {version}, fingerprint {digest}")
+        subscribers = watchers.get(agent_id)
+        if subscribers:
+            with presence_lock:
+                subscribers = list(subscribers)
+            encoded = {}
+            for subscriber in subscribers:
+                deliver(subscriber, "KEY_CHANGED", f"{agent_id}|{digest}|{version}|{codecs or '-'}|{pem}", encoded)
+
+def get_keys(payload, client):
+    """Answer a bulk key request: "aid[:fingerprint],..." -> KEYS "aid|state[|fingerprint|version|codecs[|pem]]||..."
+
+    state is FOUND (all fields), SAME (the client's fingerprint still
+    matches, so the PEM is left out) or NONE (no key registered). codecs
+    is "-" when the agent's client cannot decode compressed payloads.
+    """
+    entries = []
+    for item in payload.split(",")[:MAX_KEYS_PER_REQUEST]:
+        aid, _, known = item.strip().partition(":")
+        if not aid:
+            continue
+        row = key_directory.get(aid)
+        if row is None:
+            entries.append(f"{aid}|NONE")
+        elif known == row[1]:
+            entries.append(f"{aid}|SAME|{row[1]}|{row[2]}|{row[3] or '-'}")
+        else:
+            entries.append(f"{aid}|FOUND|{row[1]}|{row[2]}|{row[3] or '-'}|{row[0]}")
+    client.send_packet("KEYS", "||".join(entries))
+
+def key_fields(agent_id):
+    """"codecs|pem" for agent_id as carried by PEER_REGISTER"""
+    row = key_directory.get(agent_id)
+    return f"{row[3]}|{row[0]}" if row else "|"
+
+# ==================== RATE LIMITING ====================
+
+def throttle(agent_id, command, wait, client, now):
+    """Drop an over-limit packet and tell the sender when to retry"""
+    metrics.count_throttled(command)
+    if command in QUIET_THROTTLE or now - client.throttle_notice < THROTTLE_NOTICE_INTERVAL:
+        return
+    client.throttle_notice = now
+    client.send_packet("THROTTLED", f"{command}|{int(wait * 1000) + 1}")
+    log_route("THROTTLED", f"[THROTTLED] {agent_id} {command} (retry in {wait:.2f}s)", Fore.YELLOW)
+
+# ==================== SNAPSHOTS AND SHUTDOWN ====================
+
+def restore_snapshot():
+    """Reload known agents and channels from the last snapshot before accepting connections"""
+    started = time.perf_counter()
+    rows, saved_channels = state_snapshot.load()
+    now, clock = time.time(), time.monotonic()
+    agents.restore([(aid, node, clock - (now - seen) if seen is not None else 0.0) for aid, node, seen in rows])
+    with channel_lock:
+        for name, members in saved_channels.items():
+            channels.setdefault(name, set()).update(members)
+    logging.info(f"Restored {len(rows)} agents and {len(saved_channels)} channels in {time.perf_counter() - started:.3f}s")
+
+def save_snapshot():
+    """Write the agents and channels that changed since the last snapshot"""
+    rows = [(aid, node, wall_clock(seen) if seen is not None else None) for aid, node, seen in agents.take_dirty()]
+    with channel_lock:
+        changed = {name: set(channels.get(name, ())) for name in dirty_channels}
+        dirty_channels.clear()
+    state_snapshot.save(rows, changed)
+
+def snapshot_loop():
+    while not shutting_down.wait(SNAPSHOT["interval"]):
+        try:
+            save_snapshot()
+        except Exception as e:
+            logging.error(f"State snapshot failed: {e}")
+
+def start_snapshots():
+    """Every process loads the snapshot, but only one per node writes it"""
+    if SNAPSHOT["interval"] and worker_name in (None, GATEWAY_WORKER):
+        threading.Thread(target=snapshot_loop, daemon=True).start()
+
+def stop_accepting(signum=None, frame=None):
+    """SIGTERM handler: stop taking new connections so the serving loop drains and exits
+
+    Also safe to call from any thread, for servers run where signals cannot reach them.
+    """
+    if not shutting_down.is_set():
+        shutting_down.set()
+        print_centered("[!] SHUTTING DOWN, DRAINING SESSIONS", Fore.YELLOW)
+        logging.info("Shutdown requested, draining sessions")
+    if server is not None:
+        try:
+            server.shutdown(socket.SHUT_RDWR)  # Wakes an accept() blocked in another thread
+        except OSError:
+            pass
+        server.close()
+    if async_stop is not None:
+        event_loop.call_soon_threadsafe(async_stop.set)
+
+def unflushed_sessions():
+    return [conn for _, conn in agents.local_agents() if not conn.closed and not conn.flushed()]
+
+def close_sessions():
+    """Shut every local session down; each reader then unregisters it and spills what is left to the mailbox"""
+    for _, conn in agents.local_agents():
+        conn.abort()
+
+def drain_sessions():
+    """Give outbound queues up to drain_timeout to flush, then close every session
+
+    Returns True if every queue was flushed in time.
+    """
+    deadline = time.monotonic() + SNAPSHOT["drain_timeout"]
+    while unflushed_sessions() and time.monotonic() < deadline:
+        time.sleep(DRAIN_POLL)
+    flushed = not unflushed_sessions()
+    close_sessions()
+    while agents.local and time.monotonic() < deadline + DRAIN_GRACE:
+        time.sleep(DRAIN_POLL)
+    return flushed
+
+async def drain_sessions_async():
+    """Event-loop version of drain_sessions"""
+    deadline = time.monotonic() + SNAPSHOT["drain_timeout"]
+    while unflushed_sessions() and time.monotonic() < deadline:
+        await asyncio.sleep(DRAIN_POLL)
+    flushed = not unflushed_sessions()
+    close_sessions()
+    while agents.local and time.monotonic() < deadline + DRAIN_GRACE:
+        await asyncio.sleep(DRAIN_POLL)
+    return flushed
+
+def finish_shutdown(flushed):
+    """Write the final snapshot after the drain"""
+    if not flushed:
+        logging.warning("Drain timed out; unsent packets went to the offline mailbox")
+    if worker_name in (None, GATEWAY_WORKER):
+        try:
+            save_snapshot()
+        except Exception as e:
+            logging.error(f"Final state snapshot failed: {e}")
+    print_centered(f"[!] SERVER SHUTDOWN{'' if flushed else ' (DRAIN TIMED OUT)'}", Fore.RED)
+    logging.info("Server shut down")
+    asynclog.flush()
+
+# ==================== HEARTBEATS ====================
+
+def watch_session(client):
+    """Put a new connection on the heartbeat wheel
+
+    Legacy "[CMD]payload" clients cannot answer PING, so they are left to
+    TCP keepalive instead.
+    """
+    enable_keepalive(client.sock)
+    if HEARTBEAT_INTERVAL and client.framed:
+        heartbeat_wheel.schedule(HEARTBEAT_INTERVAL, client)
+
+def enable_keepalive(sock):
+    """Let the kernel probe idle connections too, for clients without heartbeats"""
+    if not HEARTBEAT_INTERVAL or sock is None:
+        return
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(HEARTBEAT_INTERVAL)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, int(HEARTBEAT_INTERVAL)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, max(1, int(HEARTBEAT_TIMEOUT // HEARTBEAT_INTERVAL)))
+    except OSError as e:
+        logging.warning(f"Could not enable TCP keepalive: {e}")
+
+def check_session(client):
+    """Called when a connection's timer comes due: reschedule, ping or reap it"""
+    if client.closed:
+        return
+    idle = time.monotonic() - client.last_active
+    if idle < HEARTBEAT_INTERVAL:
+        heartbeat_wheel.schedule(HEARTBEAT_INTERVAL - idle, client)
+    elif idle < HEARTBEAT_TIMEOUT:
+        client.send_packet("PING", str(int(idle)))
+        heartbeat_wheel.schedule(min(HEARTBEAT_INTERVAL, HEARTBEAT_TIMEOUT - idle), client)
+    else:
+        # The reader sees the shutdown and unregisters; queued packets go to the mailbox
+        print_centered(f"[-] REAPING IDLE SESSION: {client.agent_id} ({idle:.0f}s silent)", Fore.YELLOW)
+        logging.warning(f"Reaping {client.agent_id}: no traffic for {idle:.0f}s")
+        metrics.increment("sessions_reaped")
+        client.abort()
+
+def check_sessions(due):
+    for client in due:
+        check_session(client)
+
+def start_heartbeats():
+    if HEARTBEAT_INTERVAL:
+        heartbeat_wheel.start(lambda due: dispatch(check_sessions, due))
+
+def collect_metrics():
+    """Gauges sampled when /metrics is scraped"""
+    queues = outbound_queue_stats()
+    mailbox = [(r, offline_mailbox.count(r), offline_mailbox.size(r)) for r in offline_mailbox.recipients()]
+    return [
+        ("gid_active_sessions", "gauge", "Agents connected to this process", [({}, agents.local)]),
+        ("gid_remote_agents", "gauge", "Agents reached through other workers or nodes", [({}, agents.remote)]),
+        ("gid_known_agents", "gauge", "Agents in the registry, online or not", [({}, len(agents))]),
+        ("gid_pending_handshakes", "gauge", "Connections accepted but not yet registered", [({}, pending_handshakes())]),
+        ("gid_presence_subscribers", "gauge", "Agents with a presence interest list", [({}, len(subscriptions))]),
+        ("gid_registered_keys", "gauge", "Public keys in the key directory", [({}, len(key_directory))]),
+        ("gid_heartbeat_timers", "gauge", "Sessions waiting on the heartbeat wheel", [({}, len(heartbeat_wheel))]),
+        ("gid_outbound_queue_depth", "gauge", "Packets waiting in each live agent's outbound queue",
+         [({"agent": aid}, depth) for aid, depth, _, _, _ in queues]),
+        ("gid_outbound_queue_bytes", "gauge", "Bytes waiting in each live agent's outbound queue",
+         [({"agent": aid}, size) for aid, _, size, _, _ in queues]),
+        ("gid_outbound_queue_high_water", "gauge", "Most packets each live agent's outbound queue has held",
+         [({"agent": aid}, high_water) for aid, _, _, high_water, _ in queues]),
+        ("gid_outbound_queue_overflows", "gauge", "Packets refused by each live agent's outbound queue",
+         [({"agent": aid}, overflows) for aid, _, _, _, overflows in queues]),
+        ("gid_mailbox_depth", "gauge", "Offline packets waiting per recipient",
+         [({"recipient": recipient}, count) for recipient, count, _ in mailbox]),
+        ("gid_mailbox_bytes", "gauge", "Offline bytes waiting per recipient",
+         [({"recipient": recipient}, size) for recipient, _, size in mailbox]),
+    ]
+
+def start_metrics():
+    """Serve /metrics on the configured port (offset by worker index in multi-process mode)"""
+    if not METRICS["port"]:
+        return
+    port = METRICS["port"] + (int(worker_name) if worker_name is not None else 0)
+    try:
+        metrics.add_collector(collect_metrics)
+        metrics.serve(METRICS["host"], port)
+        logging.info(f"Metrics on http://{METRICS['host']}:{port}/metrics")
+    except OSError as e:
+        logging.error(f"Could not start metrics endpoint on port {port}: {e}")
+
+def process_packet(agent_id, command, payload, client):
+    """Route a single (command, payload) packet sent by agent_id over connection client"""
+    # Handle agent list requests
+    if command == "LIST_AGENTS":
+        client.send_packet("AGENT_LIST", '||'.join(presence_entries()))
+        log_route("LIST", f"[LIST] Sent agent list to {agent_id}", Fore.CYAN)
+    
+    # Handle paged, prefix-filtered agent listing
+    elif command == "LIST_PAGE":
+        list_page(payload, client)
+    
+    # Handle presence interest lists
+    elif command == "PRESENCE_SUBSCRIBE":
+        subscribe_presence(agent_id, payload, client)
+    
+    elif command == "PRESENCE_UNSUBSCRIBE":
+        unsubscribe_presence(agent_id, payload)
+    
+    # Handle public key requests
+    elif command == "GET_KEY":
+        row = key_directory.get(payload)
+        if row:
+            client.send_packet("KEY_FOUND", row[0])
+        else:
+            client.send_packet("KEY_NOT_FOUND")
+    
+    elif command == "GET_KEYS":
+        get_keys(payload, client)
+    
+    # Handle typing indicators: "target" or "target|stop"
+    elif command == "TYPING":
+        target_id, _, state = payload.partition("|")
+        set_typing(agent_id, target_id, state != "stop")
+    
+    # Handle delivery acks: "conversation|seq,..." where conversation is the
+    # sender ("agent" or "#channel:agent") as the acking agent saw it
+    elif command == "ACK":
+        conversation, _, seqs = payload.partition("|")
+        channel, _, sender = conversation.rpartition(":")
+        deliver(sender, "DELIVERED", f"{channel or agent_id}|{seqs}|{agent_id}")
+    
+    # Handle read receipts
+    elif command == "READ_RECEIPT":
+        read_receipts(agent_id, payload)
+    
+    # Handle channel management
+    elif command in ("CHANNEL_CREATE", "CHANNEL_JOIN", "CHANNEL_LEAVE", "CHANNEL_MEMBERS"):
+        handle_channel_command(agent_id, command, payload.strip(), client)
+    
+    # Heartbeat replies; reading the packet already refreshed last_active
+    elif command == "PONG":
+        pass
+
+def relay_packet(agent_id, command, payload):
+    """Relay a message, file, voice note or transfer packet without decoding its body
+
+    Only the target before the first "|" is decoded. The rest stays a
+    memoryview over the received frame and is written out behind a new
+    header and sender prefix, so a relay costs one copy into the kernel
+    per recipient.
+    """
+    sep = payload.find(b"|", 0, TARGET_SCAN_BYTES)
+    if sep < 0:
+        raise ValueError(f"{command} packet without a target")
+    target_id = payload[:sep].decode('utf-8', errors='ignore')
+    body = memoryview(payload)[sep + 1:]
+
+    # Handle chunked file/voice transfers; only one chunk is ever held in memory
+    if command in TRANSFER_COMMANDS:
+        queued = deliver(target_id, command, (f"{agent_id}|".encode('utf-8'), body))
+        if command == "XFER_OFFER":
+            state = "" if queued else " BUFFERED"
+            log_route("TRANSFER", f"[TRANSFER{state}] {agent_id} → {target_id}", Fore.MAGENTA if queued else Fore.YELLOW, not queued)
+        return
+
+    # Targets are an agent, comma-separated agents or a #channel
+    outgoing, label, color = RELAY_COMMANDS[command]
+    clear_typing(agent_id, target_id)
+    relay_to_targets(agent_id, target_id, outgoing, body, label, color)
+
+def process_packets(agent_id, packets, client):
+    """Route every packet decoded from one read"""
+    received = time.perf_counter()
+    for command, payload in packets:
+        metrics.count_packet("in", command, len(payload))
+        if client.limiter is not None:
+            wait = client.limiter.check(RATE_CLASS.get(command, command), len(payload), received)
+            if wait:
+                throttle(agent_id, command, wait, client, received)
+                continue
+        if command in RELAY_COMMANDS or command in TRANSFER_COMMANDS:
+            relay_packet(agent_id, command, payload)
+        else:
+            process_packet(agent_id, command, payload.decode('utf-8', errors='ignore'), client)
+        metrics.observe("route", time.perf_counter() - received)
+
+def parse_registration(packets):
+    """Extract (agent_id, pub_key_pem, codecs) from the first decoded packet
+
+    Clients that predate compression send no codec list.
+    """
+    command, payload = packets[0]
+    if command != "REGISTER":
+        raise ValueError(f"expected REGISTER, got {command}")
+    agent_id, pub_key_pem = payload.decode('utf-8').split("|", 1)
+    pub_key_pem, _, codecs = pub_key_pem.partition("|")
+    return agent_id, pub_key_pem, codecs
+
+def finish_drain(agent_id, client):
+    """Switch to live delivery once the mailbox is empty; returns False if more mail arrived"""
+    with client.ready:
+        if agent_id in offline_mailbox and not client.closed:
+            return False
+        client.draining = False
+    return True
+
+def deliver_offline(agent_id, client):
+    """Replay an agent's mailbox in pages, paced by its writer, then go live
+
+    Runs on its own thread so registration never waits for the backlog.
+    Live traffic is appended to the mailbox while draining, so it arrives
+    after the backlog in order.
+    """
+    print_centered(f"[*] DELIVERING {offline_mailbox.count(agent_id)} OFFLINE MESSAGES TO {agent_id}", Fore.YELLOW)
+    delivered = 0
+    while not client.closed:
+        for page in offline_mailbox.pages(agent_id, MAILBOX_PAGE_SIZE):
+            for msg_id, command, payload in page:
+                if not client.push_backlog(command, payload):
+                    # Connection dropped: keep the unsent rest of the page
+                    offline_mailbox.ack(agent_id, msg_id - 1)
+                    finish_drain(agent_id, client)
+                    return
+                delivered += 1
+                if not client.framed:
+                    # Legacy clients cannot split packets that arrive back to back
+                    time.sleep(0.2)
+        if finish_drain(agent_id, client):
+            break
+    logging.info(f"Delivered {delivered} offline packets to {agent_id}")
+
+def start_offline_delivery(agent_id, client):
+    """Begin draining the mailbox for a newly registered agent, if it has mail"""
+    if worker_name is not None:
+        # Other workers may have spilled mail this process has not seen
+        offline_mailbox.refresh(agent_id)
+    if agent_id not in offline_mailbox:
+        return
+    client.draining = True
+    if SERVER_MODE == "asyncio":
+        asyncio.ensure_future(deliver_offline_async(agent_id, client))
+    else:
+        threading.Thread(target=deliver_offline, args=(agent_id, client), daemon=True).start()
+
+def register_agent(agent_id, pub_key_pem, codecs, client, address):
+    """Record a freshly registered agent as online"""
+    client.agent_id = agent_id
+    client.start_writer()
+    start_offline_delivery(agent_id, client)
+    agents.attach_local(agent_id, client, NODE_NAME)
+    store_key(agent_id, pub_key_pem, codecs)
+    publish_presence(agent_id)
+    broadcast("PEER_REGISTER", f"{agent_id}|{NODE_NAME}|{codecs}|{pub_key_pem}")
+    metrics.increment("registrations")
+    watch_session(client)
+    
+    print_centered(f"[+] REGISTERED: {agent_id} ({address[0]})", Fore.GREEN)
+    logging.info(f"Agent registered: {agent_id} from {address[0]}")
+
+def unregister_agent(agent_id, client):
+    """Mark an agent offline once its connection has gone away"""
+    # A reconnect may already have replaced this connection
+    if agents.detach_local(agent_id, client):
+        publish_presence(agent_id)
+        unsubscribe_presence(agent_id)
+        broadcast("PEER_UNREGISTER", agent_id)
+    client.close()
+    metrics.increment("disconnects")
+    
+    # Anything the writer never flushed goes back to the mailbox
+    for command, payload in client.take_undelivered():
+        if command not in EPHEMERAL_COMMANDS:
+            buffer_offline(agent_id, command, payload)
+    
+    print_centered(f"[-] AGENT DISCONNECTED: {agent_id} (queue high-water {client.high_water})", Fore.RED)
+
+def handle_client(client, agent_id, decoder, pending=()):
+    """Handle client connections and route messages/files"""
+    try:
+        process_packets(agent_id, pending, client)
+    except Exception as e:
+        logging.error(f"Error handling client {agent_id}: {e}")
+    
+    while True:
+        try:
+            data = client.sock.recv(65536)
+            if not data: 
+                break
+            
+            client.last_active = time.monotonic()
+            process_packets(agent_id, decoder.feed(data), client)
+
+        except Exception as e:
+            logging.error(f"Error handling client {agent_id}: {e}")
+            break
+    
+    # Cleanup on disconnect
+    unregister_agent(agent_id, client)
+
+def create_listener():
+    """Create the listening TCP socket"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if worker_name is not None:
+        # Every worker binds the same port and the kernel spreads connections
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    listener.bind((HOST, PORT))
+    listener.listen(BACKLOG)
+    return listener
+
+def print_banner():
+    """Print the startup banner"""
+    if not HEADLESS:
+        os.system('cls' if os.name == 'nt' else 'clear')
+    print("\n" * 2)
+    print_centered("╔═══════════════════════════════════════════════╗", Fore.GREEN)
+    print_centered("║   G.I.D SECURE TERMINAL SERVER v3.0 (E2EE)    ║", Fore.GREEN)
+    print_centered("╚═══════════════════════════════════════════════╝", Fore.GREEN)
+    print_centered("-" * 50, Fore.WHITE)
+    workers = f", {WORKERS} WORKERS" if WORKERS > 1 else ""
+    print_centered(f"[*] LISTENING ON {HOST}:{PORT} ({SERVER_MODE.upper()}{workers})", Fore.CYAN)
+    if METRICS["port"]:
+        print_centered(f"[*] METRICS ON http://{METRICS['host']}:{METRICS['port']}/metrics", Fore.CYAN)
+    if NODE_PEERS:
+        print_centered(f"[*] FEDERATION NODE {NODE_NAME} ON {FEDERATION['listen']} → {', '.join(NODE_PEERS)}", Fore.CYAN)
+    print_centered("[*] WAITING FOR SECURE HANDSHAKES...", Fore.CYAN)
+    print_centered("-" * 50, Fore.WHITE)
+    print("\n")
+    logging.info(f"Server started on {HOST}:{PORT} in {SERVER_MODE} mode")
+
+def handshake_dropped(address, reason):
+    """A connection was closed before it registered (timed out, evicted or sent garbage)"""
+    metrics.increment("handshakes_dropped")
+    if reason == "invalid":
+        logging.error(f"Error during registration: invalid data from {address[0]}")
+
+def pending_handshakes():
+    return len(handshake_stage) if handshake_stage is not None else len(async_handshakes)
+
+def complete_handshake(sock, address, decoder, packets):
+    """Register a connection whose first packets have arrived and give it a reader thread"""
+    try:
+        agent_id, pub_key_pem, codecs = parse_registration(packets)
+    except Exception as e:
+        logging.error(f"Error during registration: {e}")
+        metrics.increment("handshakes_dropped")
+        sock.close()
+        return
+    conn = AgentConnection(sock, decoder.framed)
+    register_agent(agent_id, pub_key_pem, codecs, conn, address)
+    
+    thread = threading.Thread(target=handle_client, args=(conn, agent_id, decoder, packets[1:]))
+    thread.daemon = True
+    thread.start()
+
+def receive():
+    """Main server loop to accept connections"""
+    global server, handshake_stage
+    restore_snapshot()
+    server = create_listener()
+    join_peers()
+    start_metrics()
+    start_heartbeats()
+    start_typing()
+    start_receipts()
+    start_mailbox_sweeper()
+    start_snapshots()
+    # Signal handlers can only be installed from the main thread
+    if threading.current_thread() is threading.main_thread():
+        signal.signal(signal.SIGTERM, stop_accepting)
+    if worker_name is None:
+        print_banner()
+    
+    # Handshakes run on their own stage, so accepting never waits on a client
+    handshake_stage = HandshakeStage(complete_handshake, HANDSHAKE["timeout"], HANDSHAKE["max_pending"],
+                                     MAX_FRAME, on_drop=handshake_dropped)
+    handshake_stage.start()
+    while not shutting_down.is_set():
+        try:
+            client, address = server.accept()
+            handshake_stage.add(client, address)
+        except Exception as e:
+            if not shutting_down.is_set():
+                logging.error(f"Error accepting connection: {e}")
+    
+    handshake_stage.close()
+    finish_shutdown(drain_sessions())
+
+# ==================== ASYNCIO SERVER ====================
+
+class AsyncAgentConnection(AgentConnection):
+    """Agent connection whose outbound queue is drained by a writer task on the event loop"""
+    __slots__ = ("writer", "wakeup", "room")
+
+    def __init__(self, writer, framed=True):
+        super().__init__(writer.get_extra_info("socket"), framed)
+        self.writer = writer
+        self.wakeup = asyncio.Event()
+        self.room = asyncio.Event()
+
+    def send_packet(self, command, payload="", encoded=None):
+        queued = super().send_packet(command, payload, encoded)
+        self.wakeup.set()
+        return queued
+
+    async def push_backlog(self, command, payload):
+        """Queue a mailbox packet, waiting until the writer has made room"""
+        data, size = self.encode(command, payload)
+        while not self.closed and not self.has_room(size):
+            self.room.clear()
+            await self.room.wait()
+        if self.closed:
+            return False
+        with self.ready:
+            self.append(command, payload, data, size)
+        self.wakeup.set()
+        return True
+
+    def flushed(self):
+        return not self.queue and not self.writer.transport.get_write_buffer_size()
+
+    def start_writer(self):
+        asyncio.ensure_future(self.write_loop())
+
+    async def write_loop(self):
+        """Writer task: owns the transport and waits for it to drain between batches"""
+        try:
+            while not self.closed:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.queue and not self.closed:
+                    with self.ready:
+                        batch, stamps = self.take_batch()
+                    self.writer.writelines(batch)
+                    await self.writer.drain()
+                    record_flush(stamps)
+                    self.room.set()
+        except (ConnectionError, OSError) as e:
+            logging.error(f"Write error for {self.agent_id}: {e}")
+            self.abort()
+
+    def abort(self):
+        self.writer.transport.abort()
+
+    def close(self):
+        with self.ready:
+            self.closed = True
+        self.wakeup.set()
+        self.room.set()
+        self.writer.close()
+
+async def deliver_offline_async(agent_id, client):
+    """Event-loop version of deliver_offline"""
+    print_centered(f"[*] DELIVERING {offline_mailbox.count(agent_id)} OFFLINE MESSAGES TO {agent_id}", Fore.YELLOW)
+    delivered = 0
+    while not client.closed:
+        for page in offline_mailbox.pages(agent_id, MAILBOX_PAGE_SIZE):
+            for msg_id, command, payload in page:
+                if not await client.push_backlog(command, payload):
+                    offline_mailbox.ack(agent_id, msg_id - 1)
+                    finish_drain(agent_id, client)
+                    return
+                delivered += 1
+                if not client.framed:
+                    await asyncio.sleep(0.2)
+        if finish_drain(agent_id, client):
+            break
+    logging.info(f"Delivered {delivered} offline packets to {agent_id}")
+
+async def read_handshake(reader, decoder):
+    """Read until the first packets decode; [] if the peer closes first"""
+    packets = []
+    while not packets:
+        data = await reader.read(65536)
+        if not data:
+            return []
+        packets = decoder.feed(data)
+    return packets
+
+async def handle_async_client(reader, writer):
+    """Register an agent and route its packets on the shared event loop"""
+    address = writer.get_extra_info("peername") or ("unknown", 0)
+    client = AsyncAgentConnection(writer)
+    decoder = PacketDecoder(MAX_FRAME)
+    
+    # Keep at most max_pending handshakes, dropping the oldest to make room
+    if len(async_handshakes) >= HANDSHAKE["max_pending"]:
+        oldest = next(iter(async_handshakes))
+        del async_handshakes[oldest]
+        oldest.transport.abort()
+        metrics.increment("handshakes_dropped")
+    async_handshakes[writer] = None
+    try:
+        packets = await asyncio.wait_for(read_handshake(reader, decoder), HANDSHAKE["timeout"])
+        if not packets:
+            client.close()  # Closed before registering, e.g. a health check probe
+            return
+        agent_id, pub_key_pem, codecs = parse_registration(packets)
+        client.framed = decoder.framed
+        register_agent(agent_id, pub_key_pem, codecs, client, address)
+    except asyncio.TimeoutError:
+        metrics.increment("handshakes_dropped")
+        client.close()
+        return
+    except Exception as e:
+        logging.error(f"Error during registration: {e}")
+        metrics.increment("handshakes_dropped")
+        client.close()
+        return
+    finally:
+        async_handshakes.pop(writer, None)
+    
+    try:
+        process_packets(agent_id, packets[1:], client)
+    except Exception as e:
+        logging.error(f"Error handling client {agent_id}: {e}")
+    
+    while True:
+        try:
+            data = await reader.read(65536)
+            if not data: 
+                break
+            
+            client.last_active = time.monotonic()
+            process_packets(agent_id, decoder.feed(data), client)
+        except Exception as e:
+            logging.error(f"Error handling client {agent_id}: {e}")
+            break
+    
+    unregister_agent(agent_id, client)
+
+def raise_fd_limit():
+    """Lift the open-file soft limit so one process can hold many agents"""
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        target = hard if hard != resource.RLIM_INFINITY else 1 << 20
+        if soft < target:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (target, hard))
+    except (ImportError, ValueError, OSError) as e:
+        logging.warning(f"Could not raise file descriptor limit: {e}")
+
+async def serve_async():
+    """Serve every agent from a single asyncio event loop"""
+    global event_loop, async_stop
+    raise_fd_limit()
+    restore_snapshot()
+    listener = create_listener()
+    listener.setblocking(False)
+    event_loop = asyncio.get_running_loop()
+    join_peers()
+    start_metrics()
+    start_heartbeats()
+    start_typing()
+    start_receipts()
+    start_mailbox_sweeper()
+    start_snapshots()
+    
+    stop = async_stop = asyncio.Event()
+    if threading.current_thread() is threading.main_thread():
+        try:
+            event_loop.add_signal_handler(signal.SIGTERM, stop.set)
+        except NotImplementedError:
+            pass  # No loop signal handlers on Windows
+    async_server = await asyncio.start_server(handle_async_client, sock=listener, backlog=BACKLOG)
+    if worker_name is None:
+        print_banner()
+    async with async_server:
+        await stop.wait()
+        stop_accepting()
+        async_server.close()
+        flushed = await drain_sessions_async()
+    finish_shutdown(flushed)
+
+# ==================== CLUSTER AND FEDERATION ====================
+
+def worker_socket(name):
+    return os.path.join(CLUSTER["socket_dir"], f"worker-{name}.sock")
+
+def parse_address(address):
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+def is_node(name):
+    """True for links to other federated nodes, False for workers of this node"""
+    return name in NODE_PEERS
+
+def next_hop(node):
+    """Link that leads towards node: a direct federation link, or the gateway worker"""
+    if node in peers:
+        return node
+    if worker_name not in (None, GATEWAY_WORKER):
+        return GATEWAY_WORKER
+    return None
+
+def may_route(arrived_from, hop):
+    """Forwarded packets only cross once between workers and nodes, so they cannot loop"""
+    return arrived_from is None or is_node(arrived_from) != is_node(hop)
+
+def broadcast(command, payload=""):
+    """Send a directory update to every linked worker and node"""
+    for link in list(peers.values()):
+        link.send(command, payload)
+
+def relay_update(source, command, payload):
+    """Pass a directory update from a worker on to other nodes, or from a node on to our workers"""
+    for name, link in list(peers.items()):
+        if is_node(name) != is_node(source):
+            link.send(command, payload)
+
+def route_to_peer(peer, tid, command, payload):
+    """Forward a packet over the link to peer; returns False if the link is missing or full"""
+    link = peers.get(peer)
+    if link is None:
+        return False
+    head = f"{tid}|{command}|".encode('utf-8')
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    parts = payload if isinstance(payload, tuple) else (payload,)
+    return link.send("PEER_ROUTE", (head, *parts))
+
+def peer_greeting(target):
+    """Frames sent whenever a link to target (re)connects: our name, the agents we reach and channels"""
+    if is_node(target):
+        frames = [encode_frame("PEER_HELLO", f"{NODE_NAME}|{FEDERATION['secret']}")]
+    else:
+        frames = [encode_frame("PEER_HELLO", worker_name)]
+    for aid, _ in agents.local_agents():
+        frames.append(encode_frame("PEER_REGISTER", f"{aid}|{NODE_NAME}|{key_fields(aid)}"))
+    for aid, holder, node in agents.remote_agents():
+        if is_node(holder) != is_node(target):
+            frames.append(encode_frame("PEER_REGISTER", f"{aid}|{node or ''}|{key_fields(aid)}"))
+    with channel_lock:
+        for name, members in channels.items():
+            for aid in members:
+                frames.append(encode_frame("PEER_CHANNEL", f"CHANNEL_JOIN|{name}|{aid}"))
+    return frames
+
+def handle_peer_packet(peer, command, payload):
+    """Apply a directory update or routed packet received from a worker or node"""
+    try:
+        if command == "PEER_ROUTE":
+            first = payload.index(b"|")
+            second = payload.index(b"|", first + 1)
+            deliver(payload[:first].decode('utf-8'), payload[first + 1:second].decode('utf-8'),
+                    memoryview(payload)[second + 1:], arrived_from=peer)
+            return
+        
+        text = payload.decode('utf-8', errors='ignore')
+        if command == "PEER_REGISTER":
+            aid, node, codecs, pub_key_pem = text.split("|", 3)
+            agents.attach_remote(aid, peer, node)
+            if pub_key_pem:
+                store_key(aid, pub_key_pem, codecs)
+            publish_presence(aid)
+            relay_update(peer, command, payload)
+            # Mail spilled here before we learned where aid lives
+            if aid in offline_mailbox and offline_mailbox.refresh(aid):
+                if is_node(peer):
+                    hand_off_mailbox(aid, peer)
+                else:
+                    peers[peer].send("PEER_NUDGE", aid)
+        elif command == "PEER_UNREGISTER":
+            if agents.detach_remote(text, peer):
+                publish_presence(text)
+                relay_update(peer, command, payload)
+        elif command == "PEER_CHANNEL":
+            apply_channel_update(*text.split("|", 2))
+            relay_update(peer, command, payload)
+        elif command == "PEER_NUDGE":
+            conn = agents.connection(text)
+            holder = agents.holder(text)
+            if conn is not None:
+                if not conn.draining:
+                    start_offline_delivery(text, conn)
+            elif is_node(holder):
+                hand_off_mailbox(text, holder)
+    except Exception as e:
+        logging.error(f"Error handling {command} from {peer}: {e}")
+
+def drop_peer_agents(peer):
+    """Mark every agent reached through a link that went away as offline"""
+    for aid in agents.detach_holder(peer):
+        publish_presence(aid)
+        relay_update(peer, "PEER_UNREGISTER", aid)
+    logging.warning(f"Lost link from {peer}")
+
+def hand_off_mailbox(agent_id, node):
+    """Forward mail queued here to the node an agent has reconnected on"""
+    if agent_id in mailbox_handoffs:
+        return
+    mailbox_handoffs.add(agent_id)
+    threading.Thread(target=forward_mailbox, args=(agent_id, node), daemon=True).start()
+
+def forward_mailbox(agent_id, node):
+    """Move an agent's mailbox over the link to node, page by page"""
+    moved = 0
+    try:
+        for page in offline_mailbox.pages(agent_id, MAILBOX_PAGE_SIZE):
+            for msg_id, command, payload in page:
+                if agents.holder(agent_id) != node or not route_to_peer(node, agent_id, command, payload):
+                    # Agent moved again or the link is backed up: keep the rest
+                    offline_mailbox.ack(agent_id, msg_id - 1)
+                    return
+                moved += 1
+    finally:
+        mailbox_handoffs.discard(agent_id)
+        print_centered(f"[FEDERATION] HANDED {moved} OFFLINE MESSAGES FOR {agent_id} TO {node}", Fore.YELLOW)
+
+def dispatch(handler, *args):
+    """Run a callback from a background thread on the event loop in asyncio mode, inline otherwise"""
+    if event_loop is not None:
+        event_loop.call_soon_threadsafe(handler, *args)
+    else:
+        handler(*args)
+
+def join_peers():
+    """Listen for, and open links to, the other workers of this node and federated nodes"""
+    on_packet = lambda peer, command, payload: dispatch(handle_peer_packet, peer, command, payload)
+    on_close = lambda peer: dispatch(drop_peer_agents, peer)
+    
+    if worker_name is not None:
+        serve_peers(worker_socket(worker_name), on_packet, on_close, PEER_FRAME_SIZE)
+        for index in range(WORKERS):
+            name = str(index)
+            if name != worker_name:
+                peers[name] = PeerLink(worker_socket(name), lambda name=name: peer_greeting(name))
+                peers[name].start()
+    
+    # Only one process per node talks to other nodes
+    if NODE_PEERS and worker_name in (None, GATEWAY_WORKER):
+        serve_peers(parse_address(FEDERATION["listen"]), on_packet, on_close, PEER_FRAME_SIZE, FEDERATION["secret"])
+        for node, address in NODE_PEERS.items():
+            peers[node] = PeerLink(parse_address(address), lambda node=node: peer_greeting(node))
+            peers[node].start()
+        logging.info(f"Federation node {NODE_NAME} linking to {', '.join(NODE_PEERS)}")
+
+def run_worker(index):
+    """Entry point of one forked worker process"""
+    global worker_name, offline_mailbox, key_directory, state_snapshot
+    worker_name = str(index)
+    offline_mailbox = MailboxStore(MAILBOX_PATH)
+    key_directory = KeyStore(KEYS_PATH)
+    state_snapshot = StateSnapshot(SNAPSHOT["path"])
+    logging.info(f"Worker {worker_name} started (pid {os.getpid()})")
+    try:
+        if SERVER_MODE == "asyncio":
+            asyncio.run(serve_async())
+        else:
+            receive()
+    except KeyboardInterrupt:
+        pass
+
+def run_cluster():
+    """Fork one worker per configured core, all accepting on the same port, and restart any that die"""
+    os.makedirs(CLUSTER["socket_dir"], exist_ok=True)
+    # SQLite connections must not cross fork; each worker opens its own
+    offline_mailbox.close()
+    state_snapshot.close()
+    key_directory.close()
+    print_banner()
+    
+    context = multiprocessing.get_context("fork")
+    workers = []
+    for index in range(WORKERS):
+        workers.append(context.Process(target=run_worker, args=(index,), daemon=True))
+        workers[index].start()
+    
+    # Workers drain their own sessions on SIGTERM; the parent passes it on and waits
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutting_down.set())
+    try:
+        while not shutting_down.wait(1):
+            for index, process in enumerate(workers):
+                if not process.is_alive():
+                    print_centered(f"[!] WORKER {index} EXITED ({process.exitcode}), RESTARTING", Fore.RED)
+                    workers[index] = context.Process(target=run_worker, args=(index,), daemon=True)
+                    workers[index].start()
+    finally:
+        for process in workers:
+            process.terminate()
+        for process in workers:
+            process.join(SNAPSHOT["drain_timeout"] + DRAIN_GRACE + 5)
+    print_centered("[!] SERVER SHUTDOWN", Fore.RED)
+
+def run_server():
+    """Start the server in the configured mode"""
+    if WORKERS > 1 and hasattr(socket, "SO_REUSEPORT"):
+        run_cluster()
+        return
+    if WORKERS > 1:
+        logging.warning("SO_REUSEPORT is not available, running a single process")
+    if SERVER_MODE == "asyncio":
+        asyncio.run(serve_async())
+    else:
+        receive()
+
+if __name__ == "__main__":
+    try:
+        run_server()
+    except KeyboardInterrupt:
+        print_centered("\n[!] SERVER SHUTDOWN", Fore.RED)
         logging.info("Server shutdown by user")
\ No newline at end of file
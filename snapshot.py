@@ -0,0 +1,76 @@
+"""Snapshots of the G.I.D server's in-memory state
+
+Public keys and offline mail already live in their own SQLite stores.
+What is left is the agent registry (each agent's home node and last-seen
+time) and channel memberships, which are written here so that a restart
+knows every agent and channel it knew before. The server tracks which
+agents and channels changed and each snapshot writes only those rows in
+one transaction, so its cost follows churn rather than the number of
+known agents. Loading is two table scans.
+"""
+import os
+import sqlite3
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS agents (
+    agent_id TEXT PRIMARY KEY,
+    node TEXT,
+    last_seen REAL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS channels (
+    channel TEXT NOT NULL,
+    agent_id TEXT NOT NULL,
+    PRIMARY KEY (channel, agent_id)
+) WITHOUT ROWID;
+"""
+
+class StateSnapshot:
+    """Disk-backed copy of agent records and channel members, updated incrementally"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+
+    def load(self):
+        """Returns ([(agent_id, node, last_seen)], {channel: set of members})"""
+        with self.lock:
+            agents = self.db.execute("SELECT agent_id, node, last_seen FROM agents").fetchall()
+            channels = {}
+            for channel, agent_id in self.db.execute("SELECT channel, agent_id FROM channels"):
+                channels.setdefault(channel, set()).add(agent_id)
+        return agents, channels
+
+    def save(self, agents, channels):
+        """Upsert agents [(agent_id, node, last_seen)] and replace the members of channels {channel: members}
+
+        A channel with no members is removed.
+        """
+        if not agents and not channels:
+            return
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                self.db.executemany(
+                    "INSERT INTO agents (agent_id, node, last_seen) VALUES (?, ?, ?) "
+                    "ON CONFLICT(agent_id) DO UPDATE SET node = excluded.node, last_seen = excluded.last_seen",
+                    agents)
+                for channel, members in channels.items():
+                    self.db.execute("DELETE FROM channels WHERE channel = ?", (channel,))
+                    self.db.executemany("INSERT INTO channels (channel, agent_id) VALUES (?, ?)",
+                                        [(channel, agent_id) for agent_id in members])
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,58 @@
+"""Hashed timing wheel for the G.I.D server
+
+Timers are dropped into one of a fixed ring of slots by expiry tick, so
+scheduling is O(1) and each tick only looks at the slot under the cursor.
+Delays longer than one turn of the wheel carry a round count that is
+decremented each time the cursor passes. Timers cannot be cancelled:
+callers re-check their own state when an item comes due, which keeps the
+per-packet cost of "activity happened" to a single timestamp store.
+"""
+import math
+import threading
+import time
+import logging
+
+class TimerWheel:
+    """Ring of slots advanced once per tick by a background thread"""
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [[] for _ in range(slots)]
+        self.cursor = 0
+        self.lock = threading.Lock()
+
+    def schedule(self, delay, item):
+        """Make item come due after roughly delay seconds (rounded up to whole ticks)"""
+        ticks = max(1, math.ceil(delay / self.tick))
+        rounds, offset = divmod(ticks - 1, len(self.slots))
+        with self.lock:
+            self.slots[(self.cursor + offset + 1) % len(self.slots)].append([rounds, item])
+
+    def __len__(self):
+        return sum(len(slot) for slot in self.slots)
+
+    def advance(self):
+        """Move the cursor one tick and return the items that came due"""
+        with self.lock:
+            self.cursor = (self.cursor + 1) % len(self.slots)
+            slot = self.slots[self.cursor]
+            due = [item for rounds, item in slot if rounds == 0]
+            waiting = [[rounds - 1, item] for rounds, item in slot if rounds > 0]
+            self.slots[self.cursor] = waiting
+        return due
+
+    def run(self, on_due):
+        """Tick forever, calling on_due(items) for every non-empty batch"""
+        deadline = time.monotonic()
+        while True:
+            deadline += self.tick
+            time.sleep(max(0.0, deadline - time.monotonic()))
+            due = self.advance()
+            if due:
+                try:
+                    on_due(due)
+                except Exception as e:
+                    logging.error(f"Timer callback failed: {e}")
+
+    def start(self, on_due):
+        threading.Thread(target=self.run, args=(on_due,), daemon=True).start()